@@ -0,0 +1,57 @@
+'''
+Time and peak memory of loading a random follower graph with
+bitter.analysis, and of every metric of `extractor analyze`. Most of the
+memory of small graphs is taken by the chunk of edges being read.
+
+Edges are generated in chunks (the same ones in every read), with
+followed users chosen with a power law, as in Twitter.
+
+    python benchmarks/bench_analysis.py --edges 10000000 --users 1000000
+'''
+import time
+import resource
+import argparse
+
+import numpy
+
+from bitter import analysis
+
+
+def rss():
+    '''Peak resident memory, in MB'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def random_chunks(edges, users, chunksize, seed=0):
+    def chunks():
+        for (i, start) in enumerate(range(0, edges, chunksize)):
+            rng = numpy.random.default_rng(seed + i)
+            size = min(chunksize, edges - start)
+            src = rng.integers(0, users, size) * 1000
+            dst = (rng.zipf(1.5, size) % users) * 1000
+            yield src, dst
+    return chunks
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--edges', type=int, default=10000000)
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--chunksize', type=int, default=analysis.CHUNKSIZE)
+    args = parser.parse_args()
+
+    base = rss()
+    tic = time.time()
+    graph = analysis.Graph.load(random_chunks(args.edges, args.users, args.chunksize))
+    print('Loaded {} users and {} edges in {:.1f} s, {:.0f} MB'.format(len(graph), graph.edges,
+                                                                      time.time() - tic, rss() - base))
+    for (name, func) in (('degrees', analysis.degrees),
+                         ('reciprocity', analysis.reciprocity),
+                         ('k-core', analysis.core_number),
+                         ('pagerank', analysis.pagerank),
+                         ('overlaps', analysis.overlaps)):
+        tic = time.time()
+        func(graph)
+        print('{:>12}: {:.1f} s'.format(name, time.time() - tic))
+    print('Peak memory: {:.0f} MB ({:.1f} bytes per edge)'.format(rss() - base,
+                                                                  (rss() - base) * 2**20 / max(graph.edges, 1)))
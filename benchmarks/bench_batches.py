@@ -0,0 +1,46 @@
+'''
+Download a list of tweet ids from a local fake API with several
+credentials, with as many threads as CPUs allow (the old behaviour of
+parallel) and with threads sized to the credentials available.
+
+    python benchmarks/bench_batches.py --ids 20000 --workers 8 --latency 0.1
+'''
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+from bitter import utils
+from bitter.fakeapi import FakeAPI
+from bitter.crawlers import TwitterQueue
+
+
+def bench(wq, ids, **kwargs):
+    folder = tempfile.mkdtemp()
+    counter = utils.QuotaCounter()
+    try:
+        tic = time.time()
+        for _ in utils.download_list(wq, (str(i) for i in range(1, ids + 1)), folder, counter=counter,
+                                     **kwargs):
+            pass
+        return time.time() - tic, counter
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--ids', type=int, default=20000)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.1)
+    parser.add_argument('--missing', type=float, default=0.2)
+    args = parser.parse_args()
+
+    with FakeAPI(latency=args.latency, missing=args.missing) as api:
+        wq = TwitterQueue.from_config(config=api.config(args.workers), limits_cache='')
+        print('{} ids, {} workers, {}s latency'.format(args.ids, args.workers, args.latency))
+        for name, kwargs in [('cpu threads', {'max_threads': multiprocessing.cpu_count() * 2}),
+                             ('capacity', {})]:
+            took, counter = bench(wq, args.ids, **kwargs)
+            print('  {:12} {:6.2f}s {:8.0f} ids/s   {}'.format(name, took, args.ids / took, counter))
@@ -0,0 +1,51 @@
+'''
+Time until the first request can be issued with a large pool of credentials,
+using a local fake API with a fixed latency per request:
+
+- serial: every worker gets its limits before being used (the old behaviour)
+- background: limits are requested concurrently, in the background
+- cached: limits are read from the cache file of a previous run
+
+    python benchmarks/bench_bootstrap.py --workers 200 --latency 0.1
+'''
+import os
+import time
+import argparse
+import tempfile
+
+from bitter.fakeapi import FakeAPI
+from bitter.crawlers import TwitterQueue
+
+
+def first_call(api, workers, **kwargs):
+    tic = time.time()
+    wq = TwitterQueue.from_config(config=api.config(workers), **kwargs)
+    wq.users.lookup(user_id='1')
+    return wq, time.time() - tic
+
+
+def bench_serial(api, workers):
+    tic = time.time()
+    wq = TwitterQueue.from_config(config=api.config(workers))
+    for w in wq.queue:
+        w._limits = None
+        w.limits
+    wq.users.lookup(user_id='1')
+    return time.time() - tic
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--workers', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.1)
+    args = parser.parse_args()
+
+    cache = os.path.join(tempfile.mkdtemp(), 'limits.json')
+    with FakeAPI(latency=args.latency) as api:
+        serial = bench_serial(api, args.workers)
+        wq, background = first_call(api, args.workers, limits_cache=cache)
+        wq._bootstrap.join()
+        _, cached = first_call(api, args.workers, limits_cache=cache)
+
+    for name, took in [('serial', serial), ('background', background), ('cached', cached)]:
+        print('{:12} {:8.3f}s'.format(name, took))
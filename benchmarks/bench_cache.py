@@ -0,0 +1,68 @@
+'''
+Write and lookup throughput of the cache backends (see bitter.cache).
+
+Lookups follow the old filter step of download_list: a get per id and,
+for the ids that are not cached, a failed check. Checks use Cache.check
+on batches of 1000 ids, as download_list does now. Half of the ids looked
+up are not in the cache.
+
+    python benchmarks/bench_cache.py --ids 10000000 --backend sqlite --backend lmdb
+'''
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+from bitter import cache
+from bitter.fakeapi import fake_tweet
+
+
+def bench(backend, ids, lookups, folder):
+    obj = fake_tweet(1)
+    store = cache.get_cache(folder, backend)
+    tic = time.time()
+    for i in range(ids):
+        store.put(i, obj)
+    store.flush()
+    write = ids / (time.time() - tic)
+
+    sample = random.sample(range(2 * ids), lookups)
+    tic = time.time()
+    for i in sample:
+        if store.get(i) is None:
+            store.failed(i)
+    lookup = lookups / (time.time() - tic)
+    store.close()
+
+    # A new instance, so that building the index is included
+    store = cache.get_cache(folder, backend)
+    tic = time.time()
+    for start in range(0, lookups, 1000):
+        store.check(sample[start:start+1000])
+    check = lookups / (time.time() - tic)
+    store.close()
+    return write, lookup, check
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--ids', type=int, default=100000, help='Objects written to each cache')
+    parser.add_argument('--lookups', type=int, default=100000)
+    parser.add_argument('--backend', action='append', choices=sorted(cache.BACKENDS),
+                        help='Backend to test. It can be used several times (default: all of them)')
+    parser.add_argument('--folder', default=None, help='Where to create the caches (default: a temporary folder)')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(dir=args.folder)
+    try:
+        print('{} ids, {} lookups'.format(args.ids, args.lookups))
+        for backend in args.backend or ['folder', 'sharded', 'sqlite', 'lmdb']:
+            folder = os.path.join(root, backend)
+            write, lookup, check = bench(backend, args.ids, min(args.lookups, args.ids), folder)
+            print('  {:8} write: {:10.0f} ids/s   lookup: {:10.0f} ids/s   check: {:10.0f} ids/s'.format(
+                backend, write, lookup, check))
+            shutil.rmtree(folder)
+    finally:
+        shutil.rmtree(root)
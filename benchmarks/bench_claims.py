@@ -0,0 +1,73 @@
+'''
+Cost of claiming the next pending extractor entries, with the old
+join-and-order query (one entry at a time) and with WorkQueue.claim
+(a batch, using the claim index), for databases of different sizes.
+
+Most entries are pending, as at the start of a large crawl.
+
+    python benchmarks/bench_claims.py --claims 200
+'''
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+from bitter.models import make_session, User, ExtractorEntry
+from bitter.workqueue import WorkQueue
+
+
+def fill(dburi, n):
+    session = make_session(dburi)
+    session.bulk_insert_mappings(User, [{'id': i, 'followers_count': random.randint(0, 10000)}
+                                        for i in range(n)])
+    session.bulk_insert_mappings(ExtractorEntry, [{'id': i + 1, 'user': i, 'pending': True, 'busy': False}
+                                                  for i in range(n)])
+    session.commit()
+    session.close()
+
+
+def bench_join(dburi, claims):
+    session = make_session(dburi)
+    tic = time.time()
+    for i in range(claims):
+        candidate, entry = session.query(User, ExtractorEntry).\
+                        filter(ExtractorEntry.user == User.id).\
+                        filter(ExtractorEntry.pending == True).\
+                        filter(ExtractorEntry.busy == False).\
+                        order_by(User.followers_count).first()
+        entry.busy = True
+        session.add(entry)
+        session.commit()
+    return (time.time() - tic) / claims
+
+
+def bench_lease(dburi, claims, batchsize):
+    work = WorkQueue(dburi, batchsize=batchsize)
+    tic = time.time()
+    for i in range(claims // batchsize):
+        work.claim()
+    return (time.time() - tic) / claims
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--claims', type=int, default=200)
+    parser.add_argument('--batchsize', type=int, default=10)
+    args = parser.parse_args()
+
+    random.seed(0)
+    folder = tempfile.mkdtemp()
+    try:
+        print('{:>10} {:>14} {:>14}'.format('entries', 'join (ms)', 'lease (ms)'))
+        for n in (10000, 100000, 1000000):
+            join = 'sqlite:///{}'.format(os.path.join(folder, 'join{}.db'.format(n)))
+            lease = 'sqlite:///{}'.format(os.path.join(folder, 'lease{}.db'.format(n)))
+            fill(join, n)
+            shutil.copy(join[len('sqlite:///'):], lease[len('sqlite:///'):])
+            print('{:>10} {:>14.2f} {:>14.2f}'.format(n,
+                                                      bench_join(join, args.claims)*1e3,
+                                                      bench_lease(lease, args.claims, args.batchsize)*1e3))
+    finally:
+        shutil.rmtree(folder)
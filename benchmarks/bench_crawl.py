@@ -0,0 +1,82 @@
+'''
+Crawl the followers of a synthetic account through a local fake API, and
+store them in one or more databases.
+
+It also compares the old ingestion (one SELECT and one add per follower)
+with add_followers on a few pages of 5000 followers.
+
+    python benchmarks/bench_crawl.py --followers 1000000 \
+        --db sqlite:////tmp/bench.db --db postgresql://localhost/bench
+'''
+import time
+import argparse
+
+from bitter import utils
+from bitter.fakeapi import FakeAPI
+from bitter.crawlers import TwitterQueue
+from bitter.models import make_session, User, ExtractorEntry, Following
+
+UID = 42
+
+
+def old_add_followers(session, uid, ids):
+    now = int(time.time())
+    for i in ids:
+        existing_user = session.query(Following).\
+                        filter(Following.isfollowed == uid).\
+                        filter(Following.follower == i).first()
+        if existing_user:
+            existing_user.created_at_stamp = now
+        else:
+            session.add(Following(isfollowed=uid, follower=i, created_at_stamp=now))
+
+
+def reset(session):
+    session.query(Following).delete()
+    session.query(ExtractorEntry).delete()
+    session.query(User).delete()
+    session.commit()
+
+
+def bench_ingest(session, func, pages):
+    reset(session)
+    tic = time.time()
+    for page in range(pages):
+        func(session, UID, list(range(page*5000, (page+1)*5000)))
+        session.commit()
+    return pages*5000 / (time.time() - tic)
+
+
+def bench_crawl(session, wq, followers):
+    reset(session)
+    user = User(id=UID, name='user', screen_name='user', followers_count=followers)
+    session.add(user)
+    session.commit()
+    tic = time.time()
+    utils.crawl_user(wq, session, user, max_followers=followers)
+    took = time.time() - tic
+    assert session.query(Following).count() == followers
+    return took
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--followers', type=int, default=1000000)
+    parser.add_argument('--pages', type=int, default=2, help='Pages used to compare ingestion methods')
+    parser.add_argument('--db', action='append', help='Database URI. It can be used several times.')
+    args = parser.parse_args()
+
+    with FakeAPI(followers={UID: args.followers}) as api:
+        wq = TwitterQueue.from_config(config=api.config(1))
+        for db in args.db or ['sqlite:////tmp/bitter-bench-crawl.db']:
+            session = make_session(db)
+            print(db)
+            print('  ingestion, old:          {:10.0f} followers/s'.format(
+                bench_ingest(session, old_add_followers, args.pages)))
+            print('  ingestion, bulk:         {:10.0f} followers/s'.format(
+                bench_ingest(session, utils.add_followers, args.pages)))
+            took = bench_crawl(session, wq, args.followers)
+            print('  crawl {} followers: {:8.2f}s ({:.0f} followers/s)'.format(
+                args.followers, took, args.followers/took))
+            reset(session)
+            session.close()
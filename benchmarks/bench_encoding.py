@@ -0,0 +1,71 @@
+'''
+Throughput of download_list when the API is not the bottleneck: a fake
+batch method returns tweet-sized objects (~2.6KB of JSON) instantly, and
+they are stored in a cache and written to /dev/null as JSON lines.
+
+It compares the standard json module and orjson (if installed), with
+the objects encoded and stored in the main process and in a pool.
+
+    python benchmarks/bench_encoding.py --objects 1000000 --processes 4
+'''
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+from bitter import utils, encoding
+from bitter.fakeapi import fake_tweet
+
+
+def make_tweet(tid):
+    tweet = fake_tweet(tid)
+    tweet['user']['description'] = 'x' * 160
+    tweet['retweeted_status'] = fake_tweet(int(tid) + 1)
+    tweet['extended_entities'] = {'media': list({'id': i, 'url': 'http://t.co/{}'.format(i),
+                                                 'sizes': {'small': {'w': 100, 'h': 100}}}
+                                                for i in range(4))}
+    for k in range(20):
+        tweet['field{}'.format(k)] = {'a': k, 'b': 'text {}'.format(k), 'c': [1, 2, 3]}
+    return tweet
+
+
+def fake_batch(wq, batch):
+    for tid in batch:
+        yield tid, make_tweet(tid)
+
+
+def bench(objects, folder, backend, processes, ordered):
+    ids = (str(i) for i in range(objects))
+    tic = time.time()
+    results = utils.download_list(None, ids, folder, batch_method=fake_batch, cache_backend=backend,
+                                  processes=processes, ordered=ordered)
+    utils.serialized((obj for (_, obj) in results), os.devnull, outformat='jsonlines')
+    return objects / (time.time() - tic)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--objects', type=int, default=1000000)
+    parser.add_argument('--processes', type=int, action='append',
+                        help='Size of the pool. It can be used several times (default: 0 and 2)')
+    parser.add_argument('--backend', default='sharded')
+    parser.add_argument('--unordered', action='store_true')
+    parser.add_argument('--folder', default=None, help='Where to create the caches (default: a temporary folder)')
+    args = parser.parse_args()
+
+    orjson = encoding.orjson
+    libs = [('json', None)]
+    if orjson:
+        libs.append(('orjson', orjson))
+    print('{} objects, {} cache, {} CPUs'.format(args.objects, args.backend, os.cpu_count()))
+    for name, lib in libs:
+        encoding.orjson = lib
+        for processes in args.processes or [0, 2]:
+            root = tempfile.mkdtemp(dir=args.folder)
+            try:
+                rate = bench(args.objects, os.path.join(root, 'cache'), args.backend, processes,
+                             not args.unordered)
+            finally:
+                shutil.rmtree(root)
+            print('  {:7} processes={}: {:10.0f} objects/s'.format(name, processes, rate))
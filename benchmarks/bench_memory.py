@@ -0,0 +1,61 @@
+'''
+Peak memory of download_file on a large input when downloads are slower
+than reading the file (which is the usual case).
+
+A fake batch method takes `latency` seconds per batch of 100 ids. The
+download is stopped after `seconds`, and the peak RSS of the process
+is reported.
+
+    python benchmarks/bench_memory.py --ids 20000000 --seconds 60
+'''
+import os
+import time
+import shutil
+import resource
+import argparse
+import tempfile
+
+from bitter import utils
+
+
+def rss():
+    '''Peak resident memory, in MB'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def make_input(path, ids):
+    with open(path, 'w') as f:
+        for start in range(0, ids, 100000):
+            f.write(''.join('{}\n'.format(i) for i in range(start, min(start + 100000, ids))))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--ids', type=int, default=20000000)
+    parser.add_argument('--seconds', type=float, default=60)
+    parser.add_argument('--latency', type=float, default=0.05)
+    args = parser.parse_args()
+
+    def fake_batch(wq, batch):
+        time.sleep(args.latency)
+        for tid in batch:
+            yield tid, {'id': int(tid), 'text': 'x' * 140}
+
+    folder = tempfile.mkdtemp()
+    try:
+        infile = os.path.join(folder, 'ids.csv')
+        make_input(infile, args.ids)
+        print('{} ids ({:.0f} MB). Peak RSS before downloading: {:.0f} MB'.format(
+            args.ids, os.path.getsize(infile) / 2**20, rss()))
+        tic = time.time()
+        done = 0
+        results = utils.download_file(None, infile, os.path.join(folder, 'cache'), batch_method=fake_batch,
+                                      cache=False)
+        for res in results:
+            done += 1
+            if time.time() - tic > args.seconds:
+                break
+        results.close()
+        print('Downloaded {} ids in {:.0f}s. Peak RSS: {:.0f} MB'.format(done, time.time() - tic, rss()))
+    finally:
+        shutil.rmtree(folder)
@@ -0,0 +1,50 @@
+'''
+Throughput of the threaded TwitterQueue vs the AsyncTwitterQueue, using a
+local fake API with a fixed latency per request.
+
+    python benchmarks/bench_queues.py --workers 4 --calls 400 --latency 0.05
+'''
+import time
+import asyncio
+import argparse
+
+from multiprocessing.pool import ThreadPool
+
+from bitter.fakeapi import FakeAPI
+from bitter.crawlers import TwitterQueue
+from bitter.aiocrawlers import AsyncTwitterQueue
+
+
+def bench_threaded(api, workers, calls):
+    wq = TwitterQueue.from_config(config=api.config(workers))
+    for w in wq.queue:
+        w.limits
+    pool = ThreadPool(workers)
+    tic = time.time()
+    list(pool.imap_unordered(lambda i: wq.users.lookup(user_id=str(i+1)), range(calls)))
+    return time.time() - tic
+
+
+def bench_async(api, workers, calls, max_in_flight):
+    wq = AsyncTwitterQueue.from_config(config=api.config(workers), max_in_flight=max_in_flight)
+
+    async def run():
+        async with wq:
+            tic = time.time()
+            await asyncio.gather(*(wq.users.lookup(user_id=str(i+1)) for i in range(calls)))
+            return time.time() - tic
+    return asyncio.get_event_loop().run_until_complete(run())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--calls', type=int, default=400)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--max_in_flight', type=int, default=10)
+    args = parser.parse_args()
+
+    with FakeAPI(latency=args.latency) as api:
+        for name, took in [('threaded', bench_threaded(api, args.workers, args.calls)),
+                           ('async', bench_async(api, args.workers, args.calls, args.max_in_flight))]:
+            print('{:10} {:8.2f}s {:10.1f} calls/s'.format(name, took, args.calls/took))
@@ -0,0 +1,74 @@
+'''
+Cost of picking the next available worker, with the old shuffle-and-scan
+approach and with the WorkerScheduler, for different numbers of workers.
+
+Most workers are throttled, which is the common case in long crawls.
+
+    python benchmarks/bench_scheduler.py --calls 2000
+'''
+import time
+import random
+import argparse
+
+from bitter.crawlers import RestWorker, WorkerScheduler, RateLimitTable
+
+ENDPOINTS = ['statuses/lookup', 'users/lookup', 'followers/ids', 'friends/ids',
+             'search/tweets', 'statuses/user_timeline', 'followers/list', 'friends/list']
+
+
+def make_workers(n, throttled=0.9):
+    workers = []
+    now = time.time()
+    for i in range(n):
+        w = RestWorker('worker{}'.format(i), {})
+        w._limits = RateLimitTable()
+        # Fill the limits with many endpoints, like rate_limit_status does
+        for j in range(10):
+            for ep in ENDPOINTS:
+                w.update_limits('{}{}'.format(ep, j if j else '').split('/'),
+                                remaining=900, reset=now+900, limit=900)
+        remaining = 0 if (i and random.random() < throttled) else 900
+        w.update_limits(['users', 'lookup'], remaining=remaining, reset=now+900, limit=900)
+        workers.append(w)
+    return workers
+
+
+def shuffle_and_scan(workers, uriparts):
+    s = list(workers)
+    random.shuffle(s)
+    for worker in s:
+        if not worker.is_limited(uriparts) and not worker.busy:
+            return worker
+
+
+def bench_scan(workers, calls):
+    tic = time.time()
+    for i in range(calls):
+        shuffle_and_scan(workers, ['users', 'lookup'])
+    return (time.time() - tic) / calls
+
+
+def bench_scheduler(workers, calls):
+    scheduler = WorkerScheduler()
+    for w in workers:
+        scheduler.add(w)
+    scheduler.get_wait(['users', 'lookup'])
+    tic = time.time()
+    for i in range(calls):
+        w = scheduler.next(['users', 'lookup'])
+        scheduler.release(w, ['users', 'lookup'])
+    return (time.time() - tic) / calls
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--calls', type=int, default=2000)
+    args = parser.parse_args()
+
+    random.seed(0)
+    print('{:>8} {:>14} {:>14}'.format('workers', 'scan (us)', 'heap (us)'))
+    for n in (10, 100, 1000):
+        workers = make_workers(n)
+        print('{:>8} {:>14.1f} {:>14.1f}'.format(n,
+                                                 bench_scan(workers, args.calls)*1e6,
+                                                 bench_scheduler(workers, args.calls)*1e6))
@@ -0,0 +1,56 @@
+'''
+Time the thread that reads a stream spends storing each tweet: printing
+it (as `stream get` used to), or adding it to a StreamWriter. Also the
+total time until every tweet is on disk, with and without compression.
+
+    python benchmarks/bench_stream_writer.py --tweets 200000
+'''
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+from bitter.fakeapi import fake_tweet
+from bitter.streams import StreamWriter
+
+
+def bench_print(path, tweets):
+    tic = time.time()
+    with open(path, 'a') as f:
+        for tweet in tweets:
+            print(json.dumps(tweet), file=f)
+    total = time.time() - tic
+    return total, total
+
+
+def bench_writer(path, tweets, **kwargs):
+    tic = time.time()
+    with StreamWriter(path, maxsize=len(tweets), **kwargs) as writer:
+        for tweet in tweets:
+            writer.put(tweet)
+        reading = time.time() - tic
+    return reading, time.time() - tic
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tweets', type=int, default=200000)
+    args = parser.parse_args()
+
+    tweets = [fake_tweet(i) for i in range(args.tweets)]
+    folder = tempfile.mkdtemp()
+    try:
+        print('{:>10} {:>18} {:>12} {:>10}'.format('method', 'reader (us/tweet)', 'total (s)', 'MB'))
+        for (name, func, kwargs) in (('print', bench_print, {}),
+                                     ('writer', bench_writer, {}),
+                                     ('gzip', bench_writer, {'compression': 'gzip'})):
+            path = os.path.join(folder, '{}.jsonl'.format(name))
+            reading, total = func(path, tweets, **kwargs)
+            size = sum(os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder)
+                       if f.startswith(name) and not f.endswith('.idx'))
+            print('{:>10} {:>18.2f} {:>12.2f} {:>10.1f}'.format(name, reading / len(tweets) * 1e6,
+                                                               total, size / 2**20))
+    finally:
+        shutil.rmtree(folder)
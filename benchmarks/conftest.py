@@ -0,0 +1,46 @@
+'''
+Fixtures of the benchmark suite. Every benchmark runs against a local
+FakeAPI, so no credentials or network access are needed:
+
+    pip install pytest-benchmark
+    pytest benchmarks/ --benchmark-autosave
+    pytest benchmarks/ --benchmark-compare --benchmark-compare-fail=mean:10%
+'''
+import os
+import shutil
+import tempfile
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from bitter.fakeapi import FakeAPI
+from bitter.crawlers import TwitterQueue
+
+
+@pytest.fixture(scope='module')
+def api():
+    with FakeAPI(limit=10**9, followers={42: 20000}, results=2000, retry_after=0) as api:
+        yield api
+
+
+@pytest.fixture
+def wq(api):
+    return TwitterQueue.from_config(config=api.config(workers=4), limits_cache='')
+
+
+@pytest.fixture
+def folder():
+    folder = tempfile.mkdtemp()
+    yield folder
+    shutil.rmtree(folder)
+
+
+@pytest.fixture
+def conffile(api, folder):
+    '''A configuration file with the credentials of the fake API (for the CLI)'''
+    import yaml
+    path = os.path.join(folder, 'bitter.yaml')
+    with open(path, 'w') as f:
+        yaml.dump(api.config(workers=4), f)
+    return path
@@ -0,0 +1,101 @@
+'''
+Throughput of the main code paths of bitter, against a local FakeAPI.
+See conftest.py for how to run them and compare runs.
+'''
+import os
+import itertools
+
+from bitter import utils
+from bitter.models import make_session, User
+
+
+def test_dispatch(benchmark, wq):
+    '''One call through the TwitterQueue (worker checkout, call and limits update)'''
+    resp = benchmark(wq.users.lookup, user_id='1')
+    assert resp[0]['id'] == 1
+
+
+def test_dispatch_rate_limited(benchmark, api, wq):
+    '''A call that gets a 429 first, and is retried with another worker'''
+    def limit():
+        api.fail(429, endpoint='users/lookup')
+
+    resp = benchmark.pedantic(wq.users.lookup, kwargs={'user_id': '1'}, setup=limit, rounds=3)
+    assert resp[0]['id'] == 1
+
+
+def test_download_list(benchmark, wq, folder):
+    ids = list(str(i) for i in range(1, 2001))
+    rounds = itertools.count()
+
+    def download():
+        path = os.path.join(folder, str(next(rounds)))
+        return sum(1 for _ in utils.download_list(wq, ids, path, batch_timeout=0.1))
+
+    assert benchmark.pedantic(download, rounds=3) == len(ids)
+
+
+def test_crawl_user(benchmark, wq):
+    sessions = []
+
+    def setup():
+        session = make_session('sqlite://')
+        user = User(id=42, followers_count=20000)
+        session.add(user)
+        session.commit()
+        sessions.append(session)
+        return (wq, session, user), {}
+
+    benchmark.pedantic(utils.crawl_user, setup=setup, rounds=3)
+    entry = sessions[-1].query(utils.ExtractorEntry).first()
+    assert not entry.pending
+    assert not entry.errors
+
+
+def test_crawl_users(benchmark, conffile, folder):
+    from click.testing import CliRunner
+    from bitter import cli
+    usersfile = os.path.join(folder, 'users.txt')
+    with open(usersfile, 'w') as f:
+        f.write('\n'.join(str(i) for i in range(1, 1001)))
+    rounds = itertools.count()
+    dbs = []
+
+    def crawl():
+        db = os.path.join(folder, '{}.db'.format(next(rounds)))
+        dbs.append(db)
+        return CliRunner().invoke(cli.main, ['--config', conffile, '--limits_cache', '',
+                                             'users', 'crawl', '--db', db, '--threads', '4', usersfile])
+
+    res = benchmark.pedantic(crawl, rounds=3)
+    assert res.exit_code == 0
+    session = make_session('sqlite:///{}'.format(dbs[-1]))
+    assert session.query(User).count() == 1000
+    session.close()
+
+
+def test_consume_feed(benchmark, wq):
+    def search():
+        return sum(1 for _ in utils.consume_tweets(wq['search/tweets'], q='bitter', count=100, max_count=-1))
+
+    assert benchmark(search) == 2000
+
+
+def test_serialized(benchmark, folder):
+    from bitter.fakeapi import fake_tweet
+    tweets = list(fake_tweet(i) for i in range(10000))
+
+    def jsonlines():
+        utils.serialized(iter(tweets), os.devnull, outformat='jsonlines')
+
+    benchmark(jsonlines)
+
+
+def test_serialized_csv(benchmark, folder):
+    from bitter.fakeapi import fake_tweet
+    tweets = list(fake_tweet(i) for i in range(10000))
+
+    def csv():
+        utils.serialized(iter(tweets), os.devnull, outformat='csv', fields=['id', 'text', 'user.screen_name'])
+
+    benchmark(csv)
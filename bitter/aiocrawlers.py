@@ -0,0 +1,257 @@
+'''
+Asynchronous version of the TwitterQueue, built on asyncio and aiohttp.
+
+Calls use the same attribute-chaining API as TwitterQueue, but they return
+awaitables. Every worker may have several requests in flight at the same
+time, and all of them share a single pooled HTTP client. E.g.:
+
+    wq = AsyncTwitterQueue.from_config(conffile='~/.bitter.yaml')
+
+    async def main():
+        async with wq:
+            users = await wq.users.lookup(screen_name='balkian')
+
+aiohttp is an optional dependency (pip install bitter[async]).
+'''
+import io
+import json
+import time
+import asyncio
+import logging
+
+from collections import Counter
+
+try:
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import HTTPError
+
+from twitter import OAuth, TwitterHTTPError
+from twitter.api import build_uri, method_for_uri, wrap_response
+
+from . import config
+from . import metrics
+from .retry import RetryPolicy, LIMITED, classify
+from .crawlers import QueueMixin, QueueException, RestWorker, RateLimitTable
+from .crawlers import load_limits_cache, save_limits_cache
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncRestWorker(RestWorker):
+    api_version = '1.1'
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncRestWorker, self).__init__(*args, **kwargs)
+        self.max_in_flight = 10
+        self.active = 0
+        self.in_flight = Counter()
+        self._auth = OAuth(self.cred['token_key'],
+                           self.cred['token_secret'],
+                           self.cred['consumer_key'],
+                           self.cred['consumer_secret'])
+
+    @property
+    def limits(self):
+        # Limits are loaded asynchronously (see load_limits). Until then,
+        # the worker is considered to be available.
+        if self._limits is None:
+            self._limits = RateLimitTable()
+        return self._limits
+
+    @property
+    def full(self):
+        return self.active >= self.max_in_flight
+
+    def get_wait(self, uriparts):
+        limits = self.get_limit(uriparts)
+        pending = self.in_flight['/'.join(uriparts)]
+        if limits.get('remaining', 1) - pending > 0:
+            return 0
+        reset = limits.get('reset', 0)
+        now = time.time()
+        return max(0, (reset-now))
+
+    def acquire(self, uriparts):
+        self.active += 1
+        self.in_flight['/'.join(uriparts)] += 1
+
+    def release(self, uriparts):
+        self.active -= 1
+        self.in_flight['/'.join(uriparts)] -= 1
+
+    @property
+    def base_url(self):
+        args = self.client_args
+        scheme = 'https' if args.get('secure', True) else 'http'
+        return '{}://{}'.format(scheme, args.get('domain', 'api.twitter.com'))
+
+    async def load_limits(self, session):
+        try:
+            status = await self.request(session, ['application', 'rate_limit_status'])
+            self.limits.merge(status)
+        except Exception as ex:
+            logger.error('Could not get limits for {}: {}'.format(self.name, ex))
+
+    async def request(self, session, uriparts, **kwargs):
+        '''Perform a signed call to the API, the same way the twitter module does.'''
+        kwargs = dict(kwargs)
+        uri = build_uri([self.api_version, ] + list(uriparts), kwargs)
+        method = kwargs.pop('_method', None) or method_for_uri(uri)
+        _id = kwargs.pop('_id', None)
+        if _id:
+            kwargs['id'] = _id
+        url = '{}/{}.json'.format(self.base_url, uri)
+        arg_data = self._auth.encode_params(url, method, kwargs)
+        if method == 'GET':
+            opts = {'url': url + '?' + arg_data}
+        else:
+            opts = {'url': url,
+                    'data': arg_data.encode('utf-8'),
+                    'headers': {'Content-Type': 'application/x-www-form-urlencoded'}}
+        async with session.request(method, **opts) as resp:
+            data = await resp.read()
+            headers = resp.headers.copy()
+        # aiohttp has already decompressed the body
+        headers.popall('Content-Encoding', None)
+        if resp.status >= 400:
+            err = HTTPError(url, resp.status, resp.reason, headers, io.BytesIO(data))
+            raise TwitterHTTPError(err, uri, 'json', arg_data)
+        res = json.loads(data.decode('utf8')) if data else {}
+        return wrap_response(res, headers)
+
+
+class AsyncTwitterQueue(QueueMixin):
+    '''
+    A TwitterQueue that can be used from asyncio.
+
+    - max_in_flight: concurrent requests allowed for each worker.
+    - pool_size: maximum number of open connections in the HTTP pool.
+    - limits_cache: file used to persist the limits of the workers between
+      runs. It defaults to `config.LIMITS_CACHE`.
+    - retry: RetryPolicy for failed calls.
+    '''
+
+    worker_class = AsyncRestWorker
+
+    def __init__(self, wait=True, max_in_flight=10, pool_size=100, timeout=60, limits_cache=None, retry=None):
+        self.retry = retry or RetryPolicy()
+        self.max_in_flight = max_in_flight
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.limits_cache = limits_cache or config.LIMITS_CACHE
+        self._session = None
+        self._released = None
+        self._bootstrap = None
+        super(AsyncTwitterQueue, self).__init__(wait=wait)
+
+    def ready(self, worker):
+        worker.max_in_flight = self.max_in_flight
+        super(AsyncTwitterQueue, self).ready(worker)
+
+    async def start(self):
+        if self._session is not None:
+            return
+        import aiohttp
+        connector = aiohttp.TCPConnector(limit=self.pool_size)
+        self._session = aiohttp.ClientSession(connector=connector,
+                                              timeout=aiohttp.ClientTimeout(total=self.timeout))
+        self._released = asyncio.Event()
+        # Load the limits in the background, so requests can start right away
+        cached = load_limits_cache(self.limits_cache) if self.limits_cache else {}
+        missing = []
+        for worker in self.queue:
+            if worker.name in cached:
+                worker._limits = cached[worker.name]
+            else:
+                missing.append(worker)
+        self._bootstrap = asyncio.ensure_future(
+            asyncio.gather(*(w.load_limits(self._session) for w in missing)))
+
+    async def close(self):
+        if self._session is not None:
+            if not self._bootstrap.done():
+                self._bootstrap.cancel()
+                try:
+                    await self._bootstrap
+                except asyncio.CancelledError:
+                    pass
+            if self.limits_cache:
+                save_limits_cache(self.limits_cache, self.queue)
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def handle_call(self, uriparts, *args, **kwargs):
+        logger.debug('Called: {}'.format(uriparts))
+        logger.debug('With: {} {}'.format(args, kwargs))
+        await self.start()
+        ep = '/'.join(u for u in uriparts if u)
+        retry = self.retry.start(uriparts, patient=self.wait)
+        while True:
+            wait = retry.next_wait()
+            while wait:
+                with metrics.waiting(ep, 'backoff'):
+                    await asyncio.sleep(wait)
+                wait = retry.next_wait()
+            c = await self.next(uriparts)
+            c.acquire(uriparts)
+            ping = time.time()
+            try:
+                logger.debug('Next: {}'.format(c.name))
+                resp = await c.request(self._session, uriparts, **kwargs)
+                pong = time.time()
+                metrics.REQUEST_SECONDS.labels(ep).observe(pong-ping)
+                metrics.REQUESTS.labels(ep, 'ok').inc()
+                c.update_limits_from_headers(uriparts, resp.headers)
+                logger.debug('Took: {}'.format(pong-ping))
+                retry.success()
+                return resp
+            except Exception as ex:
+                metrics.REQUEST_SECONDS.labels(ep).observe(time.time()-ping)
+                metrics.REQUESTS.labels(ep, classify(ex) or 'error').inc()
+                if classify(ex) == LIMITED:
+                    logger.info('{} limited'.format(c.name))
+                    c.update_limits_from_headers(uriparts, ex.e.headers)
+                if not retry.failure(ex):
+                    raise
+            finally:
+                c.release(uriparts)
+                self._released.set()
+
+    def get_wait(self, uriparts):
+        waits = list(w.get_wait(uriparts) for w in self.queue if not w.full)
+        if not waits:
+            return 0
+        return min(waits)
+
+    def _next(self, uriparts):
+        available = list(w for w in self.queue
+                         if not w.full and w.get_wait(uriparts) == 0)
+        if not available:
+            raise QueueException('No worker is available')
+        return min(available, key=lambda w: w.active)
+
+    async def next(self, uriparts):
+        while True:
+            try:
+                return self._next(uriparts)
+            except QueueException:
+                if not self.wait:
+                    raise
+            # Wake up when a request finishes or when the first limit resets
+            diff = self.get_wait(uriparts)
+            if diff:
+                logger.info("All workers are throttled. Waiting up to %s seconds" % diff)
+            self._released.clear()
+            with metrics.waiting('/'.join(u for u in uriparts if u), 'limits' if diff else 'busy'):
+                try:
+                    await asyncio.wait_for(self._released.wait(), timeout=diff or None)
+                except asyncio.TimeoutError:
+                    pass
@@ -0,0 +1,368 @@
+'''
+Analysis of the follower graph of an extractor database
+(`bitter extractor analyze`).
+
+The edges (follower -> followed) are loaded into a sparse adjacency matrix
+in CSR format, with a row per follower, using NumPy and SciPy
+(`pip install bitter[analysis]`). Edges are read in chunks, three times:
+to collect the ids of the users, to count the edges of each user, and to
+fill the matrix. Only the matrix and a chunk of edges are in memory at a
+time, so memory does not depend on how the edges are stored: about 5
+bytes per edge and 8 per user for the matrix, twice that for the analysis,
+which also needs its transpose (i.e. ~5 GB for 500 million edges).
+
+From the matrix, it computes:
+
+- in-degree (followers) and out-degree (followed) of every user, and
+  their distributions.
+- reciprocity: fraction of edges that are reciprocated.
+- k-core number of every user, counting both followers and followed (as
+  networkx's core_number does for directed graphs).
+- PageRank, by power iteration.
+- shared followers (and their Jaccard similarity) of the `top` users with
+  most followers.
+
+E.g.:
+
+    graph = Graph.load(lambda: edge_chunks(session=session))
+    summary = analyze(graph, session=session)
+'''
+import os
+import logging
+
+from sqlalchemy import cast, BigInteger
+
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:
+    numpy = None
+    sparse = None
+
+from .idset import IdSet
+from .models import Following, NodeStats, FollowerOverlap
+
+logger = logging.getLogger(__name__)
+
+CHUNKSIZE = 1 << 20
+
+
+def require():
+    if numpy is None or sparse is None:
+        raise Exception('The analysis needs NumPy and SciPy. Install them with: pip install bitter[analysis]')
+
+
+def edge_chunks(session=None, store=None, since=None, chunksize=CHUNKSIZE):
+    '''
+    Stream the (follower, followed) edges of a database, or of an EdgeStore,
+    as pairs of int64 arrays of up to chunksize edges.
+    If since (a timestamp) is given, only edges added after it are included.
+    Edges in an EdgeStore have no timestamp: all the followers of the users
+    whose file was modified after it are included instead.
+    '''
+    if store is not None:
+        return _store_chunks(store, since, chunksize)
+    return _db_chunks(session, since, chunksize)
+
+
+def _db_chunks(session, since, chunksize):
+    query = session.query(Following.follower, Following.isfollowed)
+    if since is not None:
+        query = query.filter(cast(Following.created_at_stamp, BigInteger) >= since)
+    result = session.connection().execution_options(stream_results=True).execute(query.statement)
+    try:
+        while True:
+            rows = result.fetchmany(chunksize)
+            if not rows:
+                return
+            pairs = numpy.array(rows, dtype=numpy.int64)
+            yield pairs[:, 0], pairs[:, 1]
+    finally:
+        result.close()
+
+
+def _store_chunks(store, since, chunksize):
+    followers = []
+    followed = []
+    size = 0
+    for (follower, uid) in _store_arrays(store, since, chunksize):
+        followers.append(follower)
+        followed.append(numpy.full(len(follower), uid, dtype=numpy.int64))
+        size += len(follower)
+        # Users with few followers are grouped, to process fewer (and larger) chunks
+        if size >= chunksize:
+            yield numpy.concatenate(followers), numpy.concatenate(followed)
+            followers, followed, size = [], [], 0
+    if size:
+        yield numpy.concatenate(followers), numpy.concatenate(followed)
+
+
+def _store_arrays(store, since, chunksize):
+    for uid in store.users():
+        if since is not None and os.path.getmtime(store.path(uid)) < since:
+            continue
+        for data in store.iter_followers(uid, chunksize):
+            yield numpy.frombuffer(data, dtype=numpy.int64), uid
+
+
+class Graph(object):
+    '''
+    Follower graph. `nodes` is a sorted array of user ids, and `matrix` an
+    adjacency matrix (CSR) in which row i has the users followed by
+    nodes[i]. Duplicated edges and self-loops are removed.
+    '''
+
+    def __init__(self, nodes, matrix):
+        self.nodes = nodes
+        self.matrix = matrix
+        self._transpose = None
+
+    @property
+    def transpose(self):
+        '''Matrix in which row i has the followers of nodes[i]'''
+        if self._transpose is None:
+            self._transpose = self.matrix.T.tocsr()
+        return self._transpose
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @property
+    def edges(self):
+        return self.matrix.nnz
+
+    @classmethod
+    def load(cls, chunks):
+        '''
+        Build the graph from a function that returns a new iterator of edge
+        chunks every time it is called, e.g. `lambda: edge_chunks(session=s)`.
+        Edges added between the reads are ignored.
+        '''
+        require()
+        nodes = IdSet()
+        for (src, dst) in chunks():
+            nodes.update(src)
+            nodes.update(dst)
+        nodes = nodes.ids()
+        n = len(nodes)
+        logger.debug('Loading the edges of {} users'.format(n))
+
+        counts = numpy.zeros(n, dtype=numpy.int64)
+        for (src, dst) in chunks():
+            rows, cols = _positions(nodes, src, dst)
+            counts += numpy.bincount(rows, minlength=n)
+        indptr = numpy.zeros(n + 1, dtype=numpy.int64)
+        numpy.cumsum(counts, out=indptr[1:])
+        total = int(indptr[-1])
+        itype = numpy.int32 if max(n, total) < 2**31 else numpy.int64
+        indices = numpy.empty(total, dtype=itype)
+
+        # Next free position of every row
+        cursor = indptr[:-1].copy()
+        for (src, dst) in chunks():
+            rows, cols = _positions(nodes, src, dst)
+            # Rank of every edge among the ones of its row in this chunk
+            starts = numpy.flatnonzero(numpy.r_[True, rows[1:] != rows[:-1]])
+            lengths = numpy.diff(numpy.r_[starts, len(rows)])
+            rank = numpy.arange(len(rows)) - numpy.repeat(starts, lengths)
+            pos = cursor[rows] + rank
+            fits = pos < indptr[rows + 1]
+            indices[pos[fits]] = cols[fits]
+            cursor[rows[starts]] += lengths
+            numpy.minimum(cursor, indptr[1:], out=cursor)
+
+        if (cursor != indptr[1:]).any():
+            # Some edges were removed between the reads
+            filled = cursor - indptr[:-1]
+            offset = numpy.arange(total) - numpy.repeat(indptr[:-1], counts)
+            indices = indices[offset < numpy.repeat(filled, counts)]
+            numpy.cumsum(filled, out=indptr[1:])
+        indptr = indptr.astype(itype)
+
+        data = numpy.ones(len(indices), dtype=bool)
+        matrix = sparse.csr_matrix((data, indices, indptr), shape=(n, n))
+        # Sorts the followed users of every row, and merges duplicated edges
+        matrix.sum_duplicates()
+        return cls(nodes, matrix)
+
+
+def _positions(nodes, src, dst):
+    '''
+    Indices of the follower and followed ids of some edges, sorted by
+    follower, without the self-loops and the edges of unknown users
+    '''
+    if not len(nodes):
+        return numpy.empty(0, dtype=numpy.int64), numpy.empty(0, dtype=numpy.int64)
+    order = numpy.argsort(src)
+    src = src[order]
+    dst = dst[order]
+    rows = numpy.searchsorted(nodes, src)
+    # Searching sorted ids is several times faster
+    order = numpy.argsort(dst)
+    cols = numpy.empty_like(rows)
+    cols[order] = numpy.searchsorted(nodes, dst[order])
+    rows[rows == len(nodes)] = 0
+    cols[cols == len(nodes)] = 0
+    known = (nodes[rows] == src) & (nodes[cols] == dst) & (rows != cols)
+    if not known.all():
+        rows = rows[known]
+        cols = cols[known]
+    return rows, cols
+
+
+def degrees(graph):
+    '''In-degree (followers) and out-degree (followed) of every node'''
+    out_degree = numpy.diff(graph.matrix.indptr)
+    in_degree = numpy.bincount(graph.matrix.indices, minlength=len(graph))
+    return in_degree, out_degree
+
+
+def distribution(values):
+    '''Counts of values in logarithmic bins: 0, 1, 2-3, 4-7...'''
+    values = numpy.asarray(values)
+    bins = [{'min': 0, 'max': 0, 'count': int((values == 0).sum())}]
+    top = int(values.max()) if len(values) else 0
+    low = 1
+    while low <= top:
+        high = 2 * low - 1
+        bins.append({'min': low, 'max': high,
+                     'count': int(((values >= low) & (values <= high)).sum())})
+        low *= 2
+    return bins
+
+
+def reciprocity(graph, block=1 << 16):
+    '''Fraction of the edges whose reverse edge is also in the graph'''
+    if not graph.edges:
+        return 0.0
+    mutual = 0
+    for low in range(0, len(graph), block):
+        high = low + block
+        mutual += graph.matrix[low:high].multiply(graph.transpose[low:high]).nnz
+    return mutual / float(graph.edges)
+
+
+def core_number(graph):
+    '''
+    k-core number of every node, with its followers and followed as
+    neighbours. Nodes are removed a level at a time, all the nodes of
+    degree k at once.
+    '''
+    matrix = graph.matrix
+    transpose = graph.transpose
+    in_degree, out_degree = degrees(graph)
+    degree = (in_degree + out_degree).astype(numpy.int64)
+    core = numpy.zeros(len(graph), dtype=numpy.int64)
+    alive = numpy.ones(len(graph), dtype=bool)
+    k = 0
+    while alive.any():
+        k = max(k, int(degree[alive].min()))
+        peel = numpy.flatnonzero(alive & (degree <= k))
+        while len(peel):
+            core[peel] = k
+            alive[peel] = False
+            neighbours = numpy.concatenate((matrix[peel].indices, transpose[peel].indices))
+            neighbours, times = numpy.unique(neighbours, return_counts=True)
+            degree[neighbours] -= times
+            peel = neighbours[alive[neighbours] & (degree[neighbours] <= k)]
+    return core
+
+
+def pagerank(graph, damping=0.85, tol=1e-6, max_iter=100):
+    '''
+    PageRank of every node, by power iteration (as networkx's pagerank, the
+    rank of users that follow nobody is spread over every node).
+    '''
+    n = len(graph)
+    if not n:
+        return numpy.zeros(0)
+    out_degree = numpy.diff(graph.matrix.indptr).astype(numpy.float64)
+    dangling = out_degree == 0
+    inverse = numpy.zeros(n)
+    inverse[~dangling] = 1.0 / out_degree[~dangling]
+    transpose = graph.transpose
+    rank = numpy.full(n, 1.0 / n)
+    for i in range(max_iter):
+        previous = rank
+        rank = damping * transpose.dot(previous * inverse)
+        rank += (damping * previous[dangling].sum() + 1 - damping) / n
+        if numpy.abs(rank - previous).sum() < n * tol:
+            return rank
+    logger.warning('PageRank did not converge after {} iterations'.format(max_iter))
+    return rank
+
+
+def overlaps(graph, top=100):
+    '''
+    Followers shared by every pair of the `top` nodes with most followers.
+    Returns (user_a, user_b, shared, jaccard) tuples, for the pairs that
+    share some follower.
+    '''
+    in_degree = numpy.bincount(graph.matrix.indices, minlength=len(graph))
+    chosen = numpy.argsort(-in_degree, kind='stable')[:top]
+    chosen = chosen[in_degree[chosen] > 0]
+    followers = graph.transpose[chosen].astype(numpy.int32)
+    shared = followers.dot(followers.T).tocoo()
+    result = []
+    for (a, b, common) in zip(shared.row, shared.col, shared.data):
+        if a >= b:
+            continue
+        ia, ib = chosen[a], chosen[b]
+        union = in_degree[ia] + in_degree[ib] - common
+        result.append((int(graph.nodes[ia]), int(graph.nodes[ib]), int(common), float(common) / float(union)))
+    result.sort(key=lambda x: (-x[2], x[0], x[1]))
+    return result
+
+
+def save(session, graph, in_degree, out_degree, core, rank, pairs, chunksize=10000):
+    '''Replace the contents of the analysis tables'''
+    session.query(NodeStats).delete(synchronize_session=False)
+    session.query(FollowerOverlap).delete(synchronize_session=False)
+    table = NodeStats.__table__
+    for low in range(0, len(graph), chunksize):
+        high = low + chunksize
+        rows = [{'id': uid, 'in_degree': i, 'out_degree': o, 'core': c, 'pagerank': r}
+                for (uid, i, o, c, r) in zip(graph.nodes[low:high].tolist(),
+                                             in_degree[low:high].tolist(),
+                                             out_degree[low:high].tolist(),
+                                             core[low:high].tolist(),
+                                             rank[low:high].tolist())]
+        session.execute(table.insert(), rows)
+    if pairs:
+        session.execute(FollowerOverlap.__table__.insert(),
+                        [{'user_a': a, 'user_b': b, 'shared': s, 'jaccard': j}
+                         for (a, b, s, j) in pairs])
+    session.commit()
+
+
+def analyze(graph, session=None, top=100, damping=0.85):
+    '''
+    Compute every metric of a graph, save them in the analysis tables of a
+    session (if given), and return a summary.
+    '''
+    in_degree, out_degree = degrees(graph)
+    logger.debug('Computing reciprocity')
+    mutual = reciprocity(graph)
+    logger.debug('Computing k-cores')
+    core = core_number(graph)
+    logger.debug('Computing PageRank')
+    rank = pagerank(graph, damping=damping)
+    logger.debug('Computing shared followers')
+    pairs = overlaps(graph, top=top)
+    if session is not None:
+        save(session, graph, in_degree, out_degree, core, rank, pairs)
+    best = numpy.argsort(-rank, kind='stable')[:10]
+    return {
+        'nodes': len(graph),
+        'edges': int(graph.edges),
+        'reciprocity': mutual,
+        'max_core': int(core.max()) if len(core) else 0,
+        'in_degree': {'max': int(in_degree.max()) if len(graph) else 0,
+                      'mean': float(in_degree.mean()) if len(graph) else 0.0,
+                      'distribution': distribution(in_degree)},
+        'out_degree': {'max': int(out_degree.max()) if len(graph) else 0,
+                       'mean': float(out_degree.mean()) if len(graph) else 0.0,
+                       'distribution': distribution(out_degree)},
+        'pagerank': [[int(graph.nodes[i]), float(rank[i])] for i in best],
+        'overlaps': [list(pair) for pair in pairs[:10]],
+    }
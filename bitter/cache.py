@@ -0,0 +1,570 @@
+'''
+Stores for downloaded objects (tweets and users).
+
+Objects are kept as JSON, indexed by id (or alias, e.g. a screen name).
+Ids that could not be downloaded are marked as failed, so they are not
+requested again unless asked to.
+
+There are several backends:
+
+- `folder`: the original layout. A `<id>.json` file per object in a
+  single folder, symlinks for aliases, and `failed/<id>.failed` markers.
+- `sharded`: the same files, spread over `<folder>/ab/cd/` subfolders
+  (from a hash of the id), so that no folder holds more than a few
+  hundred files.
+- `sqlite`: a single SQLite database (`<folder>/cache.db`). Writes are
+  grouped in transactions of `batchsize` objects.
+- `lmdb`: a single LMDB environment (`<folder>/cache.lmdb`). Requires the
+  `lmdb` package (`pip install bitter[lmdb]`).
+
+E.g.:
+
+    with get_cache('tweets', 'sqlite') as cache:
+        cache.put('1', {'id': 1})
+        cache.get('1')  # -> {'id': 1}
+'''
+import os
+import sqlite3
+import hashlib
+import logging
+import threading
+
+from .encoding import dumps, loads
+from .idset import IdSet
+
+logger = logging.getLogger(__name__)
+
+
+class Cache(object):
+    '''Base class for the object stores'''
+
+    # Whether objects can be written from other processes (see encoding.EncodingPool)
+    parallel_writes = False
+
+    def get(self, oid):
+        '''The object with id (or alias) oid, or None'''
+        raise NotImplementedError
+
+    def put(self, oid, obj, aliases=[], data=None):
+        '''
+        Store an object (and clear its failure marker, if any).
+        `data` is the object already encoded as JSON, if available.
+        '''
+        raise NotImplementedError
+
+    def alias(self, alias, oid):
+        '''Make an object also available by another name'''
+        raise NotImplementedError
+
+    def failed(self, oid):
+        raise NotImplementedError
+
+    def fail(self, oid):
+        '''Mark an id as failed'''
+        raise NotImplementedError
+
+    def items(self):
+        '''Iterate over the (id, object) pairs in the cache, without aliases'''
+        raise NotImplementedError
+
+    def aliases(self):
+        '''Iterate over the (alias, id) pairs in the cache'''
+        raise NotImplementedError
+
+    def failures(self):
+        '''Iterate over the failed ids'''
+        raise NotImplementedError
+
+    def check(self, oids):
+        '''
+        Existence check for a batch of ids, without loading any object.
+        Returns two sets: the ids that are cached, and the ids marked as failed.
+        '''
+        cached = set()
+        failed = set()
+        for oid in oids:
+            if oid in self:
+                cached.add(oid)
+            elif self.failed(oid):
+                failed.add(oid)
+        return cached, failed
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+    def __contains__(self, oid):
+        return self.get(oid) is not None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FolderCache(Cache):
+    '''The original layout: every object in a file in the same folder'''
+
+    suffix = '.json'
+    fail_suffix = '.failed'
+    parallel_writes = True
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._dirs = set()
+        self._index = None
+
+    def __getstate__(self):
+        # The index is only kept up to date by the process that built it
+        state = self.__dict__.copy()
+        state['_index'] = None
+        return state
+
+    def _makedirs(self, folder):
+        if folder not in self._dirs:
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            self._dirs.add(folder)
+
+    def path(self, oid):
+        return os.path.join(self.folder, '{}{}'.format(oid, self.suffix))
+
+    def fail_path(self, oid):
+        return os.path.join(self.folder, 'failed', '{}{}'.format(oid, self.fail_suffix))
+
+    def get(self, oid):
+        try:
+            with open(self.path(oid), 'rb') as f:
+                return loads(f.read())
+        except (IOError, OSError):
+            # Not cached (or not a file)
+            return None
+        except ValueError as ex:
+            logger.error('Error getting cached version of {}: {}'.format(oid, ex))
+            return None
+
+    def put(self, oid, obj, aliases=[], data=None):
+        path = self.path(oid)
+        self._makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(data if data is not None else dumps(obj))
+        logger.info('Written {} to file {}'.format(oid, path))
+        try:
+            os.remove(self.fail_path(oid))
+        except OSError:
+            pass
+        if self._index is not None:
+            self._index[0].add(str(oid))
+            self._index[1].discard(str(oid))
+        for alias in aliases:
+            self.alias(alias, oid)
+
+    def alias(self, alias, oid):
+        link = self.path(alias)
+        self._makedirs(os.path.dirname(link))
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(os.path.relpath(self.path(oid), os.path.dirname(link)), link)
+        if self._index is not None:
+            self._index[0].add(str(alias))
+
+    def __contains__(self, oid):
+        return os.path.isfile(self.path(oid))
+
+    def failed(self, oid):
+        return os.path.isfile(self.fail_path(oid))
+
+    def fail(self, oid):
+        path = self.fail_path(oid)
+        self._makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            print('Object not found', file=f)
+        if self._index is not None:
+            self._index[1].add(str(oid))
+
+    def index(self):
+        '''
+        Names of the cached and failed ids (as IdSets), from a single listing
+        of the folder. It is built on the first call and kept up to date by
+        this instance.
+        '''
+        if self._index is None:
+            cached = IdSet(entry.name[:-len(self.suffix)] for entry in self._entries())
+            self._index = (cached, IdSet(self.failures()))
+            logger.debug('Indexed {} cached and {} failed ids'.format(*map(len, self._index)))
+        return self._index
+
+    def check(self, oids):
+        cached, failed = self.index()
+        found = cached.check(oids)
+        return found, failed.check(oid for oid in oids if oid not in found)
+
+    def _files(self, folder, suffix):
+        if not os.path.isdir(folder):
+            return
+        for entry in os.scandir(folder):
+            if entry.name.endswith(suffix):
+                yield entry
+
+    def _entries(self):
+        for entry in self._files(self.folder, self.suffix):
+            yield entry
+
+    def items(self):
+        for entry in self._entries():
+            if entry.is_symlink():
+                continue
+            oid = entry.name[:-len(self.suffix)]
+            with open(entry.path, 'rb') as f:
+                try:
+                    yield oid, loads(f.read())
+                except ValueError as ex:
+                    logger.error('Invalid cached object {}: {}'.format(oid, ex))
+
+    def aliases(self):
+        for entry in self._entries():
+            if entry.is_symlink():
+                target = os.path.basename(os.readlink(entry.path))
+                yield entry.name[:-len(self.suffix)], target[:-len(self.suffix)]
+
+    def failures(self):
+        for entry in self._files(os.path.join(self.folder, 'failed'), self.fail_suffix):
+            yield entry.name[:-len(self.fail_suffix)]
+
+
+class ShardedCache(FolderCache):
+    '''
+    Same files as FolderCache, in two levels of subfolders
+    (`<folder>/ab/cd/<id>.json`, from the md5 of the id).
+    '''
+
+    def shard(self, oid):
+        digest = hashlib.md5(str(oid).encode('utf-8')).hexdigest()
+        return os.path.join(self.folder, digest[:2], digest[2:4])
+
+    def path(self, oid):
+        return os.path.join(self.shard(oid), '{}{}'.format(oid, self.suffix))
+
+    def fail_path(self, oid):
+        return os.path.join(self.shard(oid), '{}{}'.format(oid, self.fail_suffix))
+
+    def _shards(self):
+        if not os.path.isdir(self.folder):
+            return
+        for first in sorted(os.listdir(self.folder)):
+            top = os.path.join(self.folder, first)
+            if len(first) != 2 or not os.path.isdir(top):
+                continue
+            for second in sorted(os.listdir(top)):
+                yield os.path.join(top, second)
+
+    def _entries(self):
+        for shard in self._shards():
+            for entry in self._files(shard, self.suffix):
+                yield entry
+
+    def failures(self):
+        for shard in self._shards():
+            for entry in self._files(shard, self.fail_suffix):
+                yield entry.name[:-len(self.fail_suffix)]
+
+
+class SQLiteCache(Cache):
+    '''
+    Every object in a row of a SQLite table.
+
+    Aliases are stored as copies of the object. Writes are committed every
+    `batchsize` objects (and on flush/close), so a crash may lose the last
+    batch of objects, which will simply be downloaded again.
+    '''
+
+    def __init__(self, folder, batchsize=1000, filename='cache.db'):
+        self.folder = folder
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.path = os.path.join(folder, filename)
+        self.batchsize = batchsize
+        self._pending = 0
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        # A rowid table: WITHOUT ROWID tables are slow with rows of a few KB
+        self._conn.execute('CREATE TABLE IF NOT EXISTS objects ('
+                           'id TEXT PRIMARY KEY, data TEXT, alias_of TEXT, failed INTEGER NOT NULL DEFAULT 0)')
+        self._conn.commit()
+
+    def _write(self, sql, params):
+        with self._lock:
+            self._conn.execute(sql, params)
+            self._pending += 1
+            if self._pending >= self.batchsize:
+                self.flush()
+
+    def _one(self, sql, params):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()
+
+    def get(self, oid):
+        row = self._one('SELECT data FROM objects WHERE id = ?', (str(oid), ))
+        if row and row[0] is not None:
+            return loads(row[0])
+        return None
+
+    def put(self, oid, obj, aliases=[], data=None):
+        if data is None:
+            data = dumps(obj)
+        self._write('INSERT OR REPLACE INTO objects (id, data) VALUES (?, ?)', (str(oid), data))
+        for alias in aliases:
+            self._write('INSERT OR REPLACE INTO objects (id, data, alias_of) VALUES (?, ?, ?)',
+                        (str(alias), data, str(oid)))
+
+    def alias(self, alias, oid):
+        self._write('INSERT OR REPLACE INTO objects (id, data, alias_of) '
+                    'SELECT ?, data, id FROM objects WHERE id = ?', (str(alias), str(oid)))
+
+    def __contains__(self, oid):
+        return self._one('SELECT 1 FROM objects WHERE id = ? AND data IS NOT NULL', (str(oid), )) is not None
+
+    def failed(self, oid):
+        row = self._one('SELECT failed FROM objects WHERE id = ?', (str(oid), ))
+        return bool(row and row[0])
+
+    def check(self, oids, chunksize=500):
+        oids = list(oids)
+        names = {}
+        for oid in oids:
+            names.setdefault(str(oid), []).append(oid)
+        cached = set()
+        failed = set()
+        keys = list(names)
+        # SQLite limits the number of variables in a query
+        for start in range(0, len(keys), chunksize):
+            part = keys[start:start+chunksize]
+            with self._lock:
+                rows = self._conn.execute('SELECT id, data IS NOT NULL, failed FROM objects '
+                                          'WHERE id IN ({})'.format(','.join('?' * len(part))),
+                                          part).fetchall()
+            for name, exists, fail in rows:
+                if exists:
+                    cached.update(names[name])
+                elif fail:
+                    failed.update(names[name])
+        return cached, failed
+
+    def fail(self, oid):
+        # Keep the object, if there is one (as the folder backends do)
+        self._write('INSERT OR IGNORE INTO objects (id) VALUES (?)', (str(oid), ))
+        self._write('UPDATE objects SET failed = 1 WHERE id = ?', (str(oid), ))
+
+    def _select(self, sql):
+        self.flush()
+        cursor = self._conn.cursor()
+        cursor.execute(sql)
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(self.batchsize)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+    def items(self):
+        for oid, data in self._select('SELECT id, data FROM objects '
+                                      'WHERE data IS NOT NULL AND alias_of IS NULL'):
+            yield oid, loads(data)
+
+    def aliases(self):
+        return self._select('SELECT id, alias_of FROM objects WHERE alias_of IS NOT NULL')
+
+    def failures(self):
+        for row in self._select('SELECT id FROM objects WHERE failed = 1'):
+            yield row[0]
+
+    def flush(self):
+        with self._lock:
+            if self._pending:
+                self._conn.commit()
+                self._pending = 0
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+
+class LMDBCache(Cache):
+    '''
+    Objects in an LMDB environment. Keys are prefixed with `o:` (objects),
+    `a:` (aliases) and `f:` (failures). Writes are committed every `batchsize`
+    operations (and on flush/close).
+    '''
+
+    def __init__(self, folder, batchsize=1000, map_size=2**40, filename='cache.lmdb'):
+        try:
+            import lmdb
+        except ImportError:
+            raise Exception('The lmdb backend requires the lmdb package. '
+                            'Install it with: pip install bitter[lmdb]')
+        self.folder = folder
+        self.path = os.path.join(folder, filename)
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.batchsize = batchsize
+        self._pending = 0
+        self._lock = threading.RLock()
+        self._env = lmdb.open(self.path, map_size=map_size, writemap=True, metasync=False)
+        self._txn = None
+        self._owner = None
+
+    @staticmethod
+    def _key(prefix, oid):
+        return '{}:{}'.format(prefix, oid).encode('utf-8')
+
+    def _writer(self):
+        if self._txn is None:
+            self._txn = self._env.begin(write=True)
+            self._owner = threading.current_thread()
+        return self._txn
+
+    def _done(self):
+        self._pending += 1
+        if self._pending >= self.batchsize:
+            self.flush()
+
+    def _read(self, key):
+        with self._lock:
+            # Write transactions can only be used by the thread that opened them.
+            # Other threads do not see the objects in the current batch.
+            if self._txn is not None and self._owner is threading.current_thread():
+                return self._txn.get(key)
+        with self._env.begin() as txn:
+            return txn.get(key)
+
+    def get(self, oid):
+        data = self._read(self._key('o', oid))
+        if data is None:
+            target = self._read(self._key('a', oid))
+            if target is None:
+                return None
+            data = self._read(b'o:' + target)
+            if data is None:
+                return None
+        return loads(data)
+
+    def put(self, oid, obj, aliases=[], data=None):
+        if data is None:
+            data = dumps(obj)
+        with self._lock:
+            txn = self._writer()
+            txn.put(self._key('o', oid), data.encode('utf-8'))
+            txn.delete(self._key('f', oid))
+            for alias in aliases:
+                txn.put(self._key('a', alias), str(oid).encode('utf-8'))
+            self._done()
+
+    def alias(self, alias, oid):
+        with self._lock:
+            self._writer().put(self._key('a', alias), str(oid).encode('utf-8'))
+            self._done()
+
+    def __contains__(self, oid):
+        return self._read(self._key('o', oid)) is not None or self._read(self._key('a', oid)) is not None
+
+    def failed(self, oid):
+        return self._read(self._key('f', oid)) is not None
+
+    def check(self, oids):
+        cached = set()
+        failed = set()
+        with self._lock:
+            if self._txn is not None and self._owner is threading.current_thread():
+                return Cache.check(self, oids)
+        # A single read transaction, and no copies of the values
+        with self._env.begin(buffers=True) as txn:
+            for oid in oids:
+                if txn.get(self._key('o', oid)) is not None or txn.get(self._key('a', oid)) is not None:
+                    cached.add(oid)
+                elif txn.get(self._key('f', oid)) is not None:
+                    failed.add(oid)
+        return cached, failed
+
+    def fail(self, oid):
+        with self._lock:
+            self._writer().put(self._key('f', oid), b'1')
+            self._done()
+
+    def _prefixed(self, prefix):
+        self.flush()
+        prefix = prefix.encode('utf-8') + b':'
+        with self._env.begin() as txn:
+            cursor = txn.cursor()
+            if not cursor.set_range(prefix):
+                return
+            for key, value in cursor:
+                if not key.startswith(prefix):
+                    return
+                yield key[len(prefix):].decode('utf-8'), value
+
+    def items(self):
+        for oid, data in self._prefixed('o'):
+            yield oid, loads(data)
+
+    def aliases(self):
+        for alias, oid in self._prefixed('a'):
+            yield alias, oid.decode('utf-8')
+
+    def failures(self):
+        for oid, _ in self._prefixed('f'):
+            yield oid
+
+    def flush(self):
+        with self._lock:
+            if self._txn is not None:
+                self._txn.commit()
+                self._txn = None
+                self._pending = 0
+
+    def close(self):
+        self.flush()
+        self._env.close()
+
+
+BACKENDS = {
+    'folder': FolderCache,
+    'sharded': ShardedCache,
+    'sqlite': SQLiteCache,
+    'lmdb': LMDBCache,
+}
+
+
+def get_cache(folder, backend=None, **kwargs):
+    '''
+    Cache for a folder. If folder is already a Cache, it is returned as is.
+    '''
+    if isinstance(folder, Cache):
+        return folder
+    backend = backend or 'folder'
+    if backend not in BACKENDS:
+        raise ValueError('Unknown cache backend: {}. Choose one of: {}'.format(backend,
+                                                                                ', '.join(BACKENDS)))
+    return BACKENDS[backend](folder, **kwargs)
+
+
+def migrate(source, target):
+    '''
+    Copy every object, alias and failure marker from one cache to another.
+    Returns the number of objects copied.
+    '''
+    copied = 0
+    for oid, obj in source.items():
+        target.put(oid, obj)
+        copied += 1
+    for alias, oid in source.aliases():
+        target.alias(alias, oid)
+    for oid in source.failures():
+        target.fail(oid)
+    target.flush()
+    return copied
@@ -5,16 +5,19 @@ import json
 import os
 import logging
 import time
+import datetime
 import sqlalchemy.types
 import threading
-import sqlite3
+import queue
 from tqdm import tqdm
 
 from sqlalchemy import exists
 
-from bitter import utils, models, crawlers
+from bitter import utils, models, crawlers, export, cache, metrics, profiling, analysis, streams
 from bitter import config as bconf
 from bitter.models import make_session, User, ExtractorEntry, Following
+from bitter.edges import EdgeStore
+from bitter.journal import Journal
 
 import sys
 if sys.version_info <= (3, 0):
@@ -26,6 +29,14 @@ else:
 
 logger = logging.getLogger(__name__)
 
+
+def shard_option(ctx, param, value):
+    try:
+        return utils.parse_shard(value)
+    except ValueError as ex:
+        raise click.BadParameter(str(ex))
+
+
 def serialize(function):
     '''Common options to serialize output to CSV or other formats'''
 
@@ -57,15 +68,32 @@ def serialize(function):
 @click.option("--logging_level", required=False, default='WARN')
 @click.option('--config', show_default=True, default=bconf.CONFIG_FILE)
 @click.option('--credentials', show_default=True, help="DEPRECATED: If specified, these credentials will be copied to the configuratation file.", default=bconf.CREDENTIALS)
+@click.option('--limits_cache', show_default=True, help="File to keep the rate limits of each credential between runs. Use an empty value to disable it.", default='~/.bitter-limits.json')
+@click.option('--metrics-port', type=int, default=None, help="Serve Prometheus metrics on this port (requires bitter[metrics]).")
+@click.option('--profile', type=click.Choice(profiling.PROFILERS), default=None,
+              help="Profile the command with cProfile (pstats output) or by sampling stacks (speedscope output).")
+@click.option('--profile-output', default=None,
+              help="File to save the profile to (default: bitter.prof or bitter.speedscope.json).")
+@click.option('--credential-shard', default=None, callback=shard_option,
+              help="Only use the I-th of every N credentials (I/N, counting from 0), to split them between processes.")
 @click.pass_context
-def main(ctx, verbose, logging_level, config, credentials):
+def main(ctx, verbose, logging_level, config, credentials, limits_cache, metrics_port, profile, profile_output,
+         credential_shard):
     logging.basicConfig(level=getattr(logging, logging_level))
     ctx.obj = {}
     ctx.obj['VERBOSE'] = verbose
     bconf.CONFIG_FILE = config
     bconf.CREDENTIALS = credentials
+    bconf.LIMITS_CACHE = limits_cache or None
+    bconf.CREDENTIAL_SHARD = credential_shard
     if os.path.exists(utils.get_config_path(credentials)):
       utils.copy_credentials_to_config(credentials, config)
+    if metrics_port:
+        metrics.serve(metrics_port)
+    if profile:
+        output = profile_output or profiling.default_output(profile)
+        profiling.start(profile)
+        ctx.call_on_close(lambda: profiling.stop(output))
 
 
 @main.group(invoke_without_command=True)
@@ -155,11 +183,13 @@ def tweet(ctx):
 @click.option('-d', '--dry_run', is_flag=True, default=False)
 @click.option('-f', '--folder', default="tweets")
 @click.option('-u', '--update', help="Update the file even if the tweet exists", is_flag=True, default=False)
+@click.option('--cache-backend', type=click.Choice(sorted(cache.BACKENDS)), default='folder', show_default=True,
+              help='How downloaded objects are stored in the folder. See `bitter cache migrate`.')
 @click.argument('tweetid')
 @serialize
-def get_tweet(tweetid, dry_run, folder, update):
+def get_tweet(tweetid, dry_run, folder, update, cache_backend):
     wq = crawlers.TwitterQueue.from_config(conffile=bconf.CONFIG_FILE)
-    yield from utils.download_tweet(wq, tweetid, not dry_run, folder, update)
+    yield from utils.download_tweet(wq, tweetid, not dry_run, folder, update, cache_backend=cache_backend)
 
 @tweet.command('get_all', help='''Download tweets from a list of tweets in a CSV file.
 The result is stored as individual json files in your folder of choice.''')
@@ -173,9 +203,23 @@ The result is stored as individual json files in your folder of choice.''')
 @click.option('--commentchar', help='Lines starting with this character will be ignored', default=None)
 @click.option('-q', '--quotechar', default='"')
 @click.option('-c', '--column', type=int, default=0)
+@click.option('--cache-backend', type=click.Choice(sorted(cache.BACKENDS)), default='folder', show_default=True,
+              help='How downloaded objects are stored in the folder. See `bitter cache migrate`.')
+@click.option('--only-new', is_flag=True, default=False,
+              help='Only output the objects that were not already in the cache (cached objects are not read)')
+@click.option('-j', '--journal', default=None,
+              help='Save the progress of the download to this file, and resume from it. See `bitter jobs`.')
+@click.option('--restart', is_flag=True, default=False, help='Ignore the progress saved in the journal')
+@click.option('-p', '--processes', type=int, default=0,
+              help='Encode and store the downloaded objects in this many processes (0: in the main process).')
+@click.option('--unordered', is_flag=True, default=False,
+              help='With --processes, output objects as soon as they are stored, instead of in download order.')
+@click.option('--max-pending', type=int, default=10000, show_default=True,
+              help='Ids read ahead of the download, and results waiting to be stored or written, at most.')
 @serialize
 @click.pass_context
-def get_tweets(ctx, tweetsfile, folder, update, retry, delimiter, nocache, skip, quotechar, commentchar, column):
+def get_tweets(ctx, tweetsfile, folder, update, retry, delimiter, nocache, skip, quotechar, commentchar, column,
+               cache_backend, only_new, journal, restart, processes, unordered, max_pending):
     if update and not click.confirm('This may overwrite existing tweets. Continue?'):
         click.echo('Cancelling')
         return
@@ -183,15 +227,21 @@ def get_tweets(ctx, tweetsfile, folder, update, retry, delimiter, nocache, skip,
 
     status = tqdm('Queried')
     failed = 0
+    counter = utils.QuotaCounter()
     for tid, obj in utils.download_tweets_file(wq, tweetsfile, folder, delimiter=delimiter, cache=not nocache,
                                                skip=skip, quotechar=quotechar, commentchar=commentchar,
-                                               column=column, update=update, retry_failed=retry):
+                                               column=column, update=update, retry_failed=retry,
+                                               cache_backend=cache_backend, emit_cached=not only_new,
+                                               journal=journal, restart=restart,
+                                               processes=processes, ordered=not unordered,
+                                               counter=counter, max_pending=max_pending):
         status.update(1)
         if not obj:
             failed += 1
             status.set_description('Failed: %s. Queried' % failed, refresh=True)
             continue
         yield obj
+    print('Quota usage: {}'.format(counter), file=sys.stderr)
 
 
 @tweet.command('search')
@@ -231,10 +281,12 @@ def list_users(ctx, db):
 @click.option('-d', '--dry_run', is_flag=True, default=False)
 @click.option('-f', '--folder', default="users")
 @click.option('-u', '--update', help="Update the file even if the user exists", is_flag=True, default=False)
+@click.option('--cache-backend', type=click.Choice(sorted(cache.BACKENDS)), default='folder', show_default=True,
+              help='How downloaded objects are stored in the folder. See `bitter cache migrate`.')
 @serialize
-def get_user(user, dry_run, folder, update):
+def get_user(user, dry_run, folder, update, cache_backend):
     wq = crawlers.TwitterQueue.from_config(conffile=bconf.CONFIG_FILE)
-    yield from utils.download_user(wq, user, not dry_run, folder, update)
+    yield from utils.download_user(wq, user, not dry_run, folder, update, cache_backend=cache_backend)
 
 @users.command('get_all', help='''Download users from a list of user ids/screen names in a CSV file.
                The result is stored as individual json files in your folder of choice.''')
@@ -249,142 +301,145 @@ def get_user(user, dry_run, folder, update):
 @click.option('-q', '--quotechar', default='"')
 @click.option('--commentchar', help='Lines starting with this character will be ignored', default=None)
 @click.option('-c', '--column', type=int, default=0)
+@click.option('--cache-backend', type=click.Choice(sorted(cache.BACKENDS)), default='folder', show_default=True,
+              help='How downloaded objects are stored in the folder. See `bitter cache migrate`.')
+@click.option('--only-new', is_flag=True, default=False,
+              help='Only output the objects that were not already in the cache (cached objects are not read)')
+@click.option('-j', '--journal', default=None,
+              help='Save the progress of the download to this file, and resume from it. See `bitter jobs`.')
+@click.option('--restart', is_flag=True, default=False, help='Ignore the progress saved in the journal')
+@click.option('-p', '--processes', type=int, default=0,
+              help='Encode and store the downloaded objects in this many processes (0: in the main process).')
+@click.option('--unordered', is_flag=True, default=False,
+              help='With --processes, output objects as soon as they are stored, instead of in download order.')
+@click.option('--max-pending', type=int, default=10000, show_default=True,
+              help='Ids read ahead of the download, and results waiting to be stored or written, at most.')
 @serialize
 @click.pass_context
-def get_users(ctx, usersfile, folder, update, retry, nocache, delimiter, skip, quotechar, commentchar, column):
+def get_users(ctx, usersfile, folder, update, retry, nocache, delimiter, skip, quotechar, commentchar, column,
+              cache_backend, only_new, journal, restart, processes, unordered, max_pending):
     if update and not click.confirm('This may overwrite existing users. Continue?'):
         click.echo('Cancelling')
         return
     wq = crawlers.TwitterQueue.from_config(conffile=bconf.CONFIG_FILE)
+    counter = utils.QuotaCounter()
     for i in utils.download_users_file(wq, usersfile, folder, delimiter=delimiter,
                                        update=update, retry_failed=retry,
                                        skip=skip, quotechar=quotechar,
                                        cache=not nocache,
                                        commentchar=commentchar,
-                                       column=column):
+                                       column=column,
+                                       cache_backend=cache_backend,
+                                       emit_cached=not only_new,
+                                       journal=journal,
+                                       restart=restart,
+                                       processes=processes,
+                                       ordered=not unordered,
+                                       counter=counter,
+                                       max_pending=max_pending):
         yield i
+    print('Quota usage: {}'.format(counter), file=sys.stderr)
 
 @users.command('crawl')
 @click.option('--db', required=True, help='Database to save all users.')
 @click.option('--skip', required=False, default=0, help='Skip N lines from the file.')
-@click.option('--until', required=False, type=str, default=0, help='Skip all lines until ID.')
-@click.option('--threads', required=False, type=str, default=20, help='Number of crawling threads.')
+@click.option('--until', required=False, type=str, default=None, help='Skip all lines until ID.')
+@click.option('--threads', required=False, type=int, default=20, help='Number of crawling threads.')
+@click.option('--shard', default=None, callback=shard_option,
+              help='Only crawl the ids that belong to shard I of N (I/N, counting from 0), i.e. id % N == I.')
+@click.option('--batch-size', type=int, default=1000, show_default=True,
+              help='Users written to the database at a time (and ids checked against it).')
+@click.option('--preload-ids', is_flag=True, default=False,
+              help='Load the ids already in the database in memory, instead of checking them in batches.')
+@click.option('--max-pending', type=int, default=10000, show_default=True,
+              help='Maximum ids (and users) waiting between the stages of the crawler.')
 @click.argument('usersfile')
 @click.pass_context
-def crawl_users(ctx, usersfile, skip, until, threads, db):
-    global dburl, ids_queue, skipped, enqueued, collected, lastid, db_lock
-
+def crawl_users(ctx, usersfile, skip, until, threads, db, shard, batch_size, preload_ids, max_pending):
     if '://' not in db:
         dburl = 'sqlite:///{}'.format(db)
-        db_lock = threading.Lock()
     else:
         dburl = db
-        def db_lock():
-            return ExitStack()
-
 
     wq = crawlers.TwitterQueue.from_config(conffile=bconf.CONFIG_FILE)
     logger.info('Starting Network crawler with {} threads and {} credentials.'.format(threads,
                                                                                       len(wq.queue)))
 
-    ids_queue = queue.Queue(1000)
     skipped = skip
-    enqueued = 0
-    collected = 0
-    statslock = threading.Lock()
-    lastid = -1
-
-    def fill_queue():
-        global enqueued, skipped
-        with open(usersfile, 'r') as f:
-            sqlite = sqlite3.connect(db)
-            engine = sqlalchemy.create_engine(dburl)
-            def user_filter(x):
-                global skipped, dburl
-                # keep = data['users'].find_one(id=x) is None
-                #keep = not session.query(exists().where(User.id == x)).scalar()
-                # keep = session.engine.execute
-                keep = not list(engine.execute('SELECT 1 from users where id=\'%s\'' % x))
-
-                if not keep:
-                    skipped += 1
-                return keep
-            for i in range(skip):
-                next(f)
-            ilist = map(lambda x: x.strip(), f)
-            logger.info('Skipping until {}'.format(until))
-            if not skip and until:
-                for uid in ilist:
-                    if uid == until:
-                        break
-                    else:
-                        skipped += 1
-            ilist = filter(user_filter, ilist)
+
+    def read_ids(f):
+        nonlocal skipped
+        for i in range(skip):
+            next(f)
+        ilist = filter(None, map(lambda x: x.strip(), f))
+        logger.info('Skipping until {}'.format(until))
+        if not skip and until:
             for uid in ilist:
-                ids_queue.put(uid)
-                enqueued += 1
-        for i in range(threads):
-            ids_queue.put(None)
-
-    def consume_queue():
-        global dburl, collected, ids_queue, lastid
-        local_collected = 0
-        logging.debug('Consuming!')
-        session = make_session(dburl)
-        q_iter = iter(ids_queue.get, None)
-        for user in utils.get_users(wq, q_iter):
-            dbuser = User(**user)
-            session.add(dbuser)
-            local_collected += 1
-            with statslock:
-                collected += 1
-                lastid = user['id']
-            if local_collected % 100 == 0:
-                with db_lock:
-                    session.commit()
-        session.commit()
-        logger.debug('Done consuming')
-
-    filler = threading.Thread(target=fill_queue)
-    filler.start()
-    consumers = [threading.Thread(target=consume_queue) for i in range(threads)]
-    logging.debug('Starting consumers')
-    for c in consumers:
-        c.start()
-    logging.debug('Joining filler')
-    counter = 0
-    speed = 0
-    lastcollected = collected
-    while True:
-        filler.join(1)
-        logger.info('########\n'
-                    '   Collected: {}\n'
-                    '   Speed: ~ {} profiles/s\n'
-                    '   Skipped: {}\n'
-                    '   Enqueued: {}\n'
-                    '   Queue size: {}\n'
-                    '   Last ID: {}'.format(collected, speed, skipped, enqueued, ids_queue.qsize(), lastid))
-        if not filler.isAlive():
-            if all(not i.isAlive() for i in consumers):
-                break
+                if uid == until:
+                    break
+                else:
+                    skipped += 1
+        if shard:
+            ilist = filter(lambda x: utils.in_shard(x, shard), ilist)
+        return ilist
+
+    with open(usersfile, 'r') as f:
+        stats = utils.crawl_users(wq, read_ids(f), dburl,
+                                  threads=threads,
+                                  batchsize=batch_size,
+                                  filter_batch=batch_size,
+                                  preload=preload_ids,
+                                  max_pending=max_pending)
+    logger.info('Done! Collected: {}. Skipped: {}'.format(stats['collected'], stats['skipped'] + skipped))
+
+@main.command('jobs', help='''Show the progress of the downloads saved in a journal
+               (with `get_all --journal`).''')
+@click.argument('journal', type=click.Path(exists=True, dir_okay=False))
+@click.pass_context
+def jobs(ctx, journal):
+    with Journal(journal) as j:
+        for job in j.jobs():
+            if job['finished']:
+                eta = 'finished'
+            elif job['eta'] is None:
+                eta = 'ETA unknown'
             else:
-                time.sleep(1)
-        counter += 1
-        if counter % 10 == 0:
-            speed = (collected-lastcollected)/10
-            with statslock:
-                lastcollected = collected
+                eta = 'ETA {}'.format(datetime.timedelta(seconds=int(job['eta'])))
+            print('{id}: {input} -> {target}'.format(**job))
+            print('\t{:.1%} ({} of {} bytes), {} downloaded, {} failed, {}'.format(
+                job['progress'], job['offset'], job['size'], job['done'], job['failed'], eta))
+
+@main.group('cache')
+@click.pass_context
+def cache_group(ctx):
+    pass
 
-    logger.info('Done!')
+@cache_group.command('migrate', help='''Copy the objects downloaded with `tweet get_all` or `users get_all` to a
+               different cache backend.''')
+@click.argument('source')
+@click.argument('target')
+@click.option('--from', 'source_backend', type=click.Choice(sorted(cache.BACKENDS)), default='folder', show_default=True)
+@click.option('--to', 'target_backend', type=click.Choice(sorted(cache.BACKENDS)), default='sharded', show_default=True)
+@click.pass_context
+def migrate_cache(ctx, source, target, source_backend, target_backend):
+    if source == target and source_backend in ('folder', 'sharded') and target_backend in ('folder', 'sharded'):
+        raise click.BadParameter('The target folder must be different from the source folder')
+    with cache.get_cache(source, source_backend) as src, cache.get_cache(target, target_backend) as dst:
+        copied = cache.migrate(src, dst)
+    click.echo('Copied {} objects from {} ({}) to {} ({})'.format(copied, source, source_backend,
+                                                                  target, target_backend))
 
 @main.group('extractor')
 @click.pass_context
 @click.option('--db', required=True, help='Database of users.')
-def extractor(ctx, db):
+@click.option('--edges', required=False, default=None,
+              help='Store the followers in this folder (as compact binary files) instead of the database.')
+def extractor(ctx, db, edges):
     if '://' not in db:
         db = 'sqlite:///{}'.format(db)
     ctx.obj['DBURI'] = db
     ctx.obj['SESSION'] = make_session(db)
+    ctx.obj['EDGES'] = EdgeStore(edges) if edges else None
 
 
 @extractor.command('status')
@@ -401,6 +456,9 @@ def status_extractor(ctx, with_followers, with_not_pending):
         for j in i.__dict__:
             print('\t{}: {}'.format(j, getattr(i,j)))
     followers = session.query(Following)
+    if ctx.obj['EDGES'] is not None:
+        print('Followers count: {}'.format(len(ctx.obj['EDGES'])))
+        return
     print('Followers count: {}'.format(followers.count()))
     if(with_followers):
         for i in followers:
@@ -409,34 +467,62 @@ def status_extractor(ctx, with_followers, with_not_pending):
                 print('\t{}: {}'.format(j, getattr(i,j)))
 
 @extractor.command('network')
-@click.option('--as_json', is_flag=True, default=False)
+@click.option('--as_json', is_flag=True, default=False, help='Same as --format json')
+@click.option('-f', '--format', 'fmt', type=click.Choice(export.EDGE_FORMATS), default='text', show_default=True)
+@click.option('--since', default=None, help='Only edges fetched since this date (YYYY-MM-DD or a timestamp).')
+@click.option('-o', '--outfile', type=click.File('w'), default='-', help='Output file. It defaults to STDOUT')
+@click.option('--chunksize', type=int, default=10000, show_default=True, help='Rows read from the database at a time.')
 @click.pass_context
-def network_extractor(ctx, as_json):
+def network_extractor(ctx, as_json, fmt, since, outfile, chunksize):
     session = ctx.obj['SESSION']
-    followers = session.query(Following)
-    follower_map = []
-    for i in followers:
-        if not as_json:
-            print('{} -> {}'.format(i.follower, i.isfollowed))
-        else:
-            follower_map.append({'source_id': i.follower,
-                                 'target_id': i.isfollowed,
-                                 'following': True})
+    since = export.parse_since(since)
     if as_json:
-        import json
-        print(json.dumps(follower_map, indent=4))
+        fmt = 'json'
+    nodes = None
+    if ctx.obj['EDGES'] is not None:
+        followers = ctx.obj['EDGES'].edges(since=since)
+    else:
+        followers = export.iter_edges(session, since=since, chunksize=chunksize)
+        if fmt in ('graphml', 'gexf'):
+            nodes = export.iter_nodes(session, since=since, chunksize=chunksize)
+    export.write_edges(followers, outfile, fmt=fmt, nodes=nodes)
 
 
 @extractor.command('users')
+@click.option('-f', '--format', 'fmt', type=click.Choice(export.USER_FORMATS), default='indented', show_default=True)
+@click.option('--since', default=None, help='Only users created since this date (YYYY-MM-DD or a timestamp).')
+@click.option('-o', '--outfile', type=click.File('w'), default='-', help='Output file. It defaults to STDOUT')
+@click.option('--chunksize', type=int, default=10000, show_default=True, help='Rows read from the database at a time.')
 @click.pass_context
-def users_extractor(ctx):
+def users_extractor(ctx, fmt, since, outfile, chunksize):
     session = ctx.obj['SESSION']
-    users = session.query(User)
-    import json
-    for i in users:
-        # print(json.dumps(i.as_dict(), indent=4))
-        dd = i.as_dict()
-        print(json.dumps(dd, indent=4))
+    users = export.iter_users(session, since=export.parse_since(since), chunksize=chunksize)
+    export.write_users(users, outfile, fmt=fmt)
+
+
+@extractor.command('analyze')
+@click.option('--since', default=None,
+              help='Only edges fetched since this date (YYYY-MM-DD or a timestamp). With --edges, edges '
+                   'have no dates: all the followers of the users whose file was written since then are included.')
+@click.option('--chunksize', type=int, default=analysis.CHUNKSIZE, show_default=True,
+              help='Edges read at a time.')
+@click.option('--top', type=int, default=100, show_default=True,
+              help='Compare the followers of this many users (the ones with most followers).')
+@click.option('--damping', type=float, default=0.85, show_default=True, help='Damping factor of PageRank.')
+@click.option('--no-save', is_flag=True, default=False,
+              help='Do not save the metrics of every user in the analysis-nodes and analysis-overlaps tables.')
+@click.option('-o', '--outfile', type=click.File('w'), default='-', help='Output file for the summary. It defaults to STDOUT')
+@click.pass_context
+def analyze_extractor(ctx, since, chunksize, top, damping, no_save, outfile):
+    analysis.require()
+    session = ctx.obj['SESSION']
+    since = export.parse_since(since)
+    chunks = lambda: analysis.edge_chunks(session=session, store=ctx.obj['EDGES'],
+                                          since=since, chunksize=chunksize)
+    graph = analysis.Graph.load(chunks)
+    summary = analysis.analyze(graph, session=None if no_save else session, top=top, damping=damping)
+    json.dump(summary, outfile, indent=2)
+    outfile.write('\n')
 
 
 @extractor.command()
@@ -444,8 +530,14 @@ def users_extractor(ctx):
 @click.option('-u', '--user', default=None)
 @click.option('-n', '--name', show_default=True, default='extractor')
 @click.option('-i', '--initfile', required=False, default=None, help='List of users to load')
+@click.option('--distributed', is_flag=True, default=False,
+              help='Claim users with leases, so that other processes can crawl the same database.')
+@click.option('--worker-id', default=None, help='Name of this worker (with --distributed). It defaults to hostname:pid.')
+@click.option('--lease', type=int, default=300, show_default=True,
+              help='Seconds a claimed user is kept without a renewal (with --distributed).')
+@click.option('--threads', type=int, default=None, help='Crawling threads (with --distributed). It defaults to the number of CPUs.')
 @click.pass_context
-def extract(ctx, recursive, user, name, initfile):
+def extract(ctx, recursive, user, name, initfile, distributed, worker_id, lease, threads):
     print(locals())
     wq = crawlers.TwitterQueue.from_config(conffile=bconf.CONFIG_FILE)
     dburi = ctx.obj['DBURI']
@@ -454,7 +546,12 @@ def extract(ctx, recursive, user, name, initfile):
                   user=user,
                   dburi=dburi,
                   initfile=initfile,
-                  extractor_name=name)
+                  extractor_name=name,
+                  edges=ctx.obj['EDGES'],
+                  distributed=distributed,
+                  worker=worker_id,
+                  lease=lease,
+                  threads=threads)
 
 @extractor.command('reset')
 @click.pass_context
@@ -511,31 +608,47 @@ def stream(ctx):
     pass
 
 @stream.command('get')
-@click.option('-l', '--locations', default=None)
-@click.option('-t', '--track', default=None)
-@click.option('-f', '--file', default=None, help='File to store the stream of tweets')
+@click.option('-l', '--locations', default=None, help='Bounding boxes (comma-separated coordinates)')
+@click.option('-t', '--track', default=None, help='Keywords (comma-separated)')
+@click.option('--follow', default=None, help='User ids (comma-separated)')
+@click.option('--track-file', type=click.File('r'), default=None, help='File with a keyword per line')
+@click.option('--follow-file', type=click.File('r'), default=None, help='File with a user id per line')
+@click.option('--dedup', type=int, default=100000, show_default=True,
+              help='Recent tweet ids remembered to drop the tweets received by several connections')
+@click.option('-f', '--file', default='-', help='File to store the stream of tweets. It defaults to STDOUT')
+@click.option('--compression', type=click.Choice(['gzip', 'zstd']), default=None, help='Compress the output file')
+@click.option('--rotate-size', type=int, default=None, help='Start a new file every N MB (of uncompressed tweets)')
+@click.option('--rotate-every', type=int, default=None, help='Start a new file every N seconds')
+@click.option('--buffer', type=int, default=100000, show_default=True,
+              help='Tweets kept in memory while they are written')
+@click.option('--drop', is_flag=True, default=False,
+              help='Drop the oldest tweets when the buffer is full, instead of waiting for the disk')
 @click.option('-p', '--politelyretry', help='Politely retry after a hangup/connection error', is_flag=True, default=True)
 @click.pass_context
-def get_stream(ctx, locations, track, file, politelyretry):
-    wq = crawlers.StreamQueue.from_config(conffile=bconf.CONFIG_FILE, max_workers=1)
-
-    query_args = {}
-    if locations:
-        query_args['locations'] = locations
-    if track:
-        query_args['track'] = track
-    if not file:
-        file = sys.stdout
-    else:
-        file = open(file, 'a')
+def get_stream(ctx, locations, track, follow, track_file, follow_file, dedup, file, compression,
+               rotate_size, rotate_every, buffer, drop, politelyretry):
+    '''
+    Filter the stream of tweets, or get a sample if no filter is given.
+    Filters that are too large for a connection are split across several
+    credentials, and tweets are written from a separate thread (see
+    bitter.streams).
+    '''
+    wq = crawlers.StreamQueue.from_config(conffile=bconf.CONFIG_FILE)
+
+    track = streams.split_terms(track)
+    if track_file:
+        track += streams.split_terms(line.strip() for line in track_file)
+    follow = streams.split_terms(follow)
+    if follow_file:
+        follow += streams.split_terms(line.strip() for line in follow_file)
+    writer = streams.StreamWriter(file, compression=compression,
+                                  rotate_size=rotate_size and rotate_size * 2**20,
+                                  rotate_interval=rotate_every, maxsize=buffer, drop=drop)
 
     def insist():
         lasthangup = time.time()
         while True:
-            if not query_args:
-                iterator = wq.statuses.sample()
-            else:
-                iterator = wq.statuses.filter(**query_args)#"-4.25,40.16,-3.40,40.75")
+            iterator = wq.statuses.sample()
             try:
               for i in iterator:
                   yield i
@@ -543,23 +656,42 @@ def get_stream(ctx, locations, track, file, politelyretry):
                   return
             except Exception:
                 if not politelyretry:
-                    raise ex
+                    raise
             thishangup = time.time()
             if thishangup - lasthangup < 60:
                 raise Exception('Too many hangups in a row.')
             time.sleep(3)
 
-    for tweet in tqdm(insist()):
-        print(json.dumps(tweet), file=file)
-    if file != sys.stdout:
-        file.close()
+    if track or follow or locations:
+        multiplexer = streams.StreamMultiplexer(wq, track=track, follow=follow,
+                                                locations=locations, dedup=dedup)
+        logger.info('Filtering with {} connections'.format(len(multiplexer.filters)))
+        tweets = multiplexer
+    else:
+        multiplexer = None
+        tweets = insist()
+    try:
+        with writer:
+            for tweet in tqdm(tweets):
+                writer.put(tweet)
+    finally:
+        if multiplexer is not None:
+            multiplexer.stop()
+        if writer.stats['dropped']:
+            logger.warning('{} tweets were dropped'.format(writer.stats['dropped']))
 
 @stream.command('read')
 @click.option('-f', '--file', help='File to read the stream of tweets from', required=True)
 @click.option('-t', '--tail', is_flag=True, help='Keep reading from the file, like tail', type=bool, default=False)
+@click.option('--since', default=None,
+              help='Start from the hour of this date (YYYY-MM-DD or a timestamp), using the index of the file.')
 @click.pass_context
-def read_stream(ctx, file, tail):
-    for tweet in utils.read_file(file, tail=tail):
+def read_stream(ctx, file, tail, since):
+    if tail or file == '-':
+        tweets = utils.read_file(file, tail=tail)
+    else:
+        tweets = streams.read(file, since=export.parse_since(since))
+    for tweet in tweets:
         try:
             print(u'{timestamp_ms}- @{screen_name}: {text}'.format(timestamp_ms=tweet['created_at'], screen_name=tweet['user']['screen_name'], text=tweet['text']))
         except (KeyError, TypeError):
@@ -570,7 +702,7 @@ def read_stream(ctx, file, tail):
 @click.argument('limit', required=False, default=None, type=int)
 @click.pass_context
 def tags_stream(ctx, file, limit):
-    c = utils.get_hashtags(utils.read_file(file))
+    c = utils.get_hashtags(utils.read_file(file) if file == '-' else streams.read(file))
     for count, tag in c.most_common(limit):
         print(u'{} - {}'.format(count, tag))
 
@@ -12,3 +12,21 @@ E.g.:
 '''
 CREDENTIALS = '~/.bitter-credentials.json'
 CONFIG_FILE = '~/.bitter.yaml'
+# File to persist the rate limits of each credential between runs (None to disable)
+LIMITS_CACHE = None
+# Only use the credentials i, i+n, i+2n... of the config file, as (i, n).
+# Processes that share a config file can use different credentials this way.
+CREDENTIAL_SHARD = None
+# Connections kept open to server databases (PostgreSQL, MySQL...) by each
+# process, and how many more can be opened when they are all in use.
+DB_POOL_SIZE = 10
+DB_MAX_OVERFLOW = 20
+# Pragmas for SQLite files (see models.get_engine)
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,
+    'temp_store': 'MEMORY',
+}
+# Seconds to wait for a locked SQLite database
+SQLITE_TIMEOUT = 30
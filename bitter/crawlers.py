@@ -2,14 +2,19 @@ import time
 import urllib
 import random
 import json
+import heapq
+import os
+import atexit
+import weakref
 
 import logging
 logger = logging.getLogger(__name__)
 
 from twitter import *
 from collections import OrderedDict
-from threading import Lock
-from itertools import islice
+from threading import Lock, Condition, Thread
+from multiprocessing.pool import ThreadPool
+from itertools import islice, count
 from functools import partial
 try:
     import itertools.ifilter as filter
@@ -18,6 +23,10 @@ except ImportError:
 
 from . import utils
 from . import config
+from . import config as bconf
+from . import metrics
+from . import profiling
+from .retry import RetryPolicy, LIMITED, classify
 
 
 class AttrToFunc(object):
@@ -51,28 +60,40 @@ class AttrToFunc(object):
 class FromCredentialsMixin(object):
 
     @classmethod
-    def from_credentials(cls, cred_file=None, max_workers=None):
-        wq = cls()
+    def from_credentials(cls, cred_file=None, max_workers=None, **kwargs):
+        wq = cls(**kwargs)
 
         for cred in islice(utils.get_credentials(cred_file), max_workers):
             wq.ready(cls.worker_class(cred["user"], cred))
+        wq.bootstrap()
         return wq
     
 class FromConfigMixin(object):
 
     @classmethod
-    def from_config(cls, config=None, conffile=None, max_workers=None):
-        wq = cls()
+    def from_config(cls, config=None, conffile=None, max_workers=None, shard=None, **kwargs):
+        '''
+        Queue with the credentials of a configuration. If shard is (i, n),
+        only the i-th of every n credentials is used (it defaults to
+        `config.CREDENTIAL_SHARD`).
+        '''
+        wq = cls(**kwargs)
 
         if not config:
           with utils.config(conffile) as c:
               config = c
-        for cred in islice(config['credentials'], max_workers):
+        shard = shard or bconf.CREDENTIAL_SHARD
+        credentials = config['credentials']
+        if shard:
+            credentials = islice(credentials, shard[0], None, shard[1])
+        for cred in islice(credentials, max_workers):
             wq.ready(cls.worker_class(cred["user"], cred))
+        wq.bootstrap()
         return wq
 
 class TwitterWorker(object):
     api_class = None
+    domain_key = 'domain'
 
     def __init__(self, name, creds):
         self.name = name
@@ -88,15 +109,216 @@ class TwitterWorker(object):
                        self.cred['token_secret'],
                        self.cred['consumer_key'],
                        self.cred['consumer_secret'])
-            self._client = self.api_class(auth=auth)
+            self._client = self.api_class(auth=auth, **self.client_args)
         return self._client
 
+    @property
+    def client_args(self):
+        '''
+        Extra arguments for the API client. Credentials may point to a
+        different domain (e.g. a local fake API for testing).
+        '''
+        args = {}
+        if self.cred.get(self.domain_key):
+            args['domain'] = self.cred[self.domain_key]
+        if 'secure' in self.cred:
+            args['secure'] = self.cred['secure']
+        return args
+
     def __repr__(self):
         msg = '<{} for {}>'.format(self.__class__.__name__, self.name)
         if self.busy:
             msg += ' [busy]'
         return msg
 
+class RateLimit(object):
+    '''Calls left for an endpoint, and when they will be reset.'''
+
+    __slots__ = ('limit', 'remaining', 'reset')
+
+    def __init__(self, limit=None, remaining=None, reset=None):
+        self.limit = limit
+        self.remaining = remaining
+        self.reset = reset
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None)
+        if value is None:
+            return default
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def items(self):
+        for key in self.__slots__:
+            value = getattr(self, key)
+            if value is not None:
+                yield key, value
+
+    def __eq__(self, other):
+        if isinstance(other, RateLimit):
+            other = dict(other.items())
+        return dict(self.items()) == other
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+def _template_matches(template, parts):
+    if len(parts) > len(template):
+        return False
+    for ix, t in enumerate(template):
+        if ix >= len(parts):
+            # Trailing parameters may be passed as arguments (e.g. _id)
+            if not t.startswith(':'):
+                return False
+        elif t != parts[ix] and not t.startswith(':'):
+            return False
+    return True
+
+
+class RateLimitTable(object):
+    '''
+    Rate limits of a worker, indexed by endpoint.
+
+    It is built once from the response of application/rate_limit_status and
+    updated in place. Endpoints with parameters (e.g. /users/show/:id) are
+    matched the first time a uri is used, and the result is cached.
+    '''
+
+    def __init__(self, status=None):
+        self.slots = {}
+        self.templates = {}
+        self._cache = {}
+        if status:
+            for resources in status.get('resources', {}).values():
+                for uri, value in resources.items():
+                    self.set(uri, **value)
+
+    @staticmethod
+    def key(uriparts):
+        if isinstance(uriparts, str):
+            uriparts = uriparts.split('/')
+        return '/' + '/'.join(u for u in uriparts if u)
+
+    def find(self, uriparts):
+        key = self.key(uriparts)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        slot = self.slots.get(key)
+        if slot is None:
+            parts = key[1:].split('/')
+            for template, tslot in self.templates.get(parts[0], []):
+                if _template_matches(template, parts):
+                    slot = tslot
+                    break
+        self._cache[key] = slot
+        return slot
+
+    def set(self, uriparts, **values):
+        slot = self.find(uriparts)
+        if slot is None:
+            key = self.key(uriparts)
+            slot = self.slots[key] = RateLimit()
+            self._cache[key] = slot
+            parts = key[1:].split('/')
+            if any(p.startswith(':') for p in parts):
+                self.templates.setdefault(parts[0], []).append((parts, slot))
+                # Uris that did not match anything may match this one
+                self._cache = dict((k, v) for (k, v) in self._cache.items() if v is not None)
+        for k, v in values.items():
+            if k in RateLimit.__slots__:
+                setattr(slot, k, v)
+        return slot
+
+    def merge(self, status):
+        '''
+        Update the table with a response from rate_limit_status, unless
+        we already have newer information (e.g. from the headers of a call).
+        '''
+        for resources in status.get('resources', {}).values():
+            for uri, value in resources.items():
+                slot = self.find(uri)
+                if (slot is None or slot.reset is None or
+                    value.get('reset', 0) > slot.reset or
+                    value.get('remaining', 0) < slot.get('remaining', 0)):
+                    self.set(uri, **value)
+
+    def dump(self):
+        return dict((key, [slot.limit, slot.remaining, slot.reset])
+                    for (key, slot) in self.slots.items() if slot.reset is not None)
+
+    @classmethod
+    def load(cls, data, now=None):
+        '''Create a table from a dump, discarding the windows that have already expired.'''
+        now = now or time.time()
+        table = cls()
+        for key, (limit, remaining, reset) in data.items():
+            if reset > now:
+                table.set(key, limit=limit, remaining=remaining, reset=reset)
+        return table
+
+    def __len__(self):
+        return len(self.slots)
+
+
+def load_limits_cache(path):
+    '''Read the limits of every worker from a cache file. Returns {worker name: RateLimitTable}'''
+    path = os.path.expanduser(path)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (IOError, ValueError) as ex:
+        logger.warning('Could not read the limits cache {}: {}'.format(path, ex))
+        return {}
+    now = time.time()
+    return dict((name, RateLimitTable.load(d['limits'], now=now)) for (name, d) in data.items())
+
+
+# Queues whose limits are saved when the interpreter exits. Weak, so
+# queues that are no longer used are not kept alive.
+_limits_queues = weakref.WeakSet()
+# Saving reads and rewrites the cache file
+_limits_lock = Lock()
+
+
+@atexit.register
+def _save_all_limits():
+    for queue in list(_limits_queues):
+        try:
+            queue.save_limits()
+        except Exception as ex:
+            logger.warning('Could not save the limits cache: {}'.format(ex))
+
+
+def save_limits_cache(path, workers):
+    '''Write the limits of these workers to a cache file, keeping the rest of the entries.'''
+    path = os.path.expanduser(path)
+    data = {}
+    if os.path.exists(path):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            pass
+    now = time.time()
+    for worker in workers:
+        if worker._limits is not None:
+            data[worker.name] = {'timestamp': now, 'limits': worker._limits.dump()}
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp, path)
+
+
 class RestWorker(TwitterWorker):
     api_class = Twitter
 
@@ -106,8 +328,8 @@ class RestWorker(TwitterWorker):
 
     @property
     def limits(self):
-        if not self._limits:
-            self._limits = self.client.application.rate_limit_status()
+        if self._limits is None:
+            self.load_limits()
         return self._limits
 
     def is_limited(self, uriparts):
@@ -121,28 +343,24 @@ class RestWorker(TwitterWorker):
         now = time.time()
         return max(0, (reset-now))
 
+    def load_limits(self):
+        '''Get the limits from the API, keeping any newer values we already have.'''
+        status = self.client.application.rate_limit_status()
+        if self._limits is None:
+            self._limits = RateLimitTable(status)
+        else:
+            self._limits.merge(status)
+        return self._limits
+
     def get_limit(self, uriparts):
-        uriparts = list(u for u in uriparts if u)
-        uri = '/'+'/'.join(uriparts)
-        for (ix, i) in self.limits.get('resources', {}).get(uriparts[0], {}).items():
-            if ix.startswith(uri):
-                return i
-        return {}
+        return self.limits.find(uriparts) or {}
 
     def set_limit(self, uriparts, value):
-        uri = '/'+'/'.join(uriparts)
-        if 'resources' not in self.limits:
-            self.limits['resources'] = {}
-        resources = self.limits['resources']
-        if uriparts[0] not in resources:
-            resources[uriparts[0]] = {}
-        resource = resources[uriparts[0]]
-        resource[uri] = value
+        self.limits.set(uriparts, **value)
 
     def update_limits(self, uriparts, remaining, reset, limit):
-        self.set_limit(uriparts, {'remaining': remaining,
-                                  'reset': reset,
-                                  'limit': limit})
+        self.limits.set(uriparts, remaining=remaining, reset=reset, limit=limit)
+        metrics.QUOTA_REMAINING.labels(self.name, WorkerScheduler.endpoint(uriparts)).set(remaining)
         
     def update_limits_from_headers(self, uriparts, headers):
         reset = float(headers.get('X-Rate-Limit-Reset', time.time() + 30))
@@ -155,6 +373,107 @@ class RestWorker(TwitterWorker):
 class QueueException(BaseException):
     pass
 
+
+class WorkerScheduler(object):
+    '''
+    Keeps, for every endpoint, a heap of idle workers sorted by the time
+    they will be available again and, then, by their remaining calls.
+
+    Workers are checked out with `next` and must be given back with
+    `release`. Both operations (and `get_wait`) are O(log n).
+    '''
+
+    def __init__(self):
+        self.workers = set()
+        self.busy = set()
+        self.heaps = {}
+        self.parked = {}
+        self._counter = count()
+        self._cond = Condition()
+
+    @staticmethod
+    def endpoint(uriparts):
+        return '/'.join(u for u in uriparts if u)
+
+    def add(self, worker):
+        with self._cond:
+            self.workers.add(worker)
+            for ep in self.heaps:
+                self._push(ep, worker)
+            self._cond.notify_all()
+
+    def _key(self, ep, worker):
+        if getattr(worker, '_limits', True) is None:
+            # Do not fetch the limits of a worker just to sort it.
+            # They will be updated the first time it is used.
+            return (0, 0)
+        limits = worker.get_limit(ep.split('/'))
+        remaining = limits.get('remaining', 1)
+        if remaining > 0:
+            return (0, -remaining)
+        return (limits.get('reset', 0), 0)
+
+    def _push(self, ep, worker):
+        ready, remaining = self._key(ep, worker)
+        heapq.heappush(self.heaps[ep], (ready, remaining, next(self._counter), worker))
+
+    def _top(self, ep):
+        if ep not in self.heaps:
+            self.heaps[ep] = []
+            for worker in self.workers:
+                self._push(ep, worker)
+        heap = self.heaps[ep]
+        # Busy workers are removed lazily, and put back on release
+        while heap and heap[0][-1] in self.busy:
+            worker = heapq.heappop(heap)[-1]
+            self.parked.setdefault(worker, set()).add(ep)
+        return heap[0] if heap else None
+
+    def next(self, uriparts):
+        ep = self.endpoint(uriparts)
+        with self._cond:
+            top = self._top(ep)
+            if not top:
+                raise QueueException('All workers are busy')
+            if top[0] > time.time():
+                raise QueueException('No worker is available')
+            worker = heapq.heappop(self.heaps[ep])[-1]
+            self.busy.add(worker)
+            return worker
+
+    def release(self, worker, uriparts):
+        ep = self.endpoint(uriparts)
+        with self._cond:
+            self.busy.discard(worker)
+            for other in self.parked.pop(worker, set()) | set([ep]):
+                if other in self.heaps:
+                    self._push(other, worker)
+            self._cond.notify_all()
+
+    def get_wait(self, uriparts):
+        '''
+        Seconds until a worker is available for this endpoint, or None
+        if all workers are busy.
+        '''
+        with self._cond:
+            top = self._top(self.endpoint(uriparts))
+            if not top:
+                return None
+            return max(0, top[0] - time.time())
+
+    def capacity(self, uriparts):
+        '''Number of workers (busy or not) that are not rate limited for this endpoint'''
+        ep = self.endpoint(uriparts)
+        now = time.time()
+        with self._cond:
+            return sum(1 for worker in self.workers if self._key(ep, worker)[0] <= now)
+
+    def wait(self, timeout=None):
+        '''Wait until a worker is released (or timeout seconds).'''
+        with self._cond:
+            self._cond.wait(timeout)
+
+
 class QueueMixin(AttrToFunc, FromCredentialsMixin, FromConfigMixin):
     def __init__(self, wait=True):
         logger.debug('Creating worker queue')
@@ -166,16 +485,92 @@ class QueueMixin(AttrToFunc, FromCredentialsMixin, FromConfigMixin):
     def ready(self, worker):
         self.queue.add(worker)
 
+    def bootstrap(self):
+        '''Called once all the workers have been added'''
+        pass
+
 class TwitterQueue(QueueMixin):
+    '''
+    Queue of REST workers.
+
+    - limits_cache: file used to persist the limits of the workers between
+      runs. It defaults to `config.LIMITS_CACHE`.
+    - bootstrap_threads: number of threads used to get the limits of
+      the workers that are not cached.
+    - retry: RetryPolicy for failed calls.
+    '''
 
     worker_class = RestWorker
 
+    def __init__(self, wait=True, limits_cache=None, bootstrap_threads=10, retry=None):
+        self.scheduler = WorkerScheduler()
+        self.retry = retry or RetryPolicy()
+        self.limits_cache = limits_cache or config.LIMITS_CACHE
+        self.bootstrap_threads = bootstrap_threads
+        self._bootstrap = None
+        super(TwitterQueue, self).__init__(wait=wait)
+
+    def ready(self, worker):
+        super(TwitterQueue, self).ready(worker)
+        self.scheduler.add(worker)
+
+    def bootstrap(self):
+        '''
+        Get the limits of all the workers without blocking.
+        Limits are read from the cache file, if there is one, and the
+        rest are requested to the API concurrently, in the background.
+        Until then, workers are considered available.
+        '''
+        cached = {}
+        if self.limits_cache:
+            cached = load_limits_cache(self.limits_cache)
+            _limits_queues.add(self)
+        missing = []
+        for worker in self.queue:
+            if worker._limits is not None:
+                continue
+            if worker.name in cached:
+                worker._limits = cached[worker.name]
+            else:
+                worker._limits = RateLimitTable()
+                missing.append(worker)
+        logger.debug('Limits of {} workers were cached'.format(len(self.queue)-len(missing)))
+        if missing:
+            self._bootstrap = Thread(target=self._load_limits, args=(missing, ), daemon=True)
+            self._bootstrap.start()
+
+    def _load_limits(self, workers):
+        def load(worker):
+            try:
+                worker.load_limits()
+            except Exception as ex:
+                logger.error('Could not get limits for {}: {}'.format(worker.name, ex))
+        pool = ThreadPool(min(self.bootstrap_threads, len(workers)))
+        try:
+            pool.map(load, workers)
+        finally:
+            pool.close()
+        self.save_limits()
+
+    def save_limits(self):
+        if self.limits_cache:
+            with _limits_lock:
+                save_limits_cache(self.limits_cache, self.queue)
+
     def handle_call(self, uriparts, *args, **kwargs):
+        with profiling.span('handle_call'):
+            return self._handle_call(uriparts, *args, **kwargs)
+
+    def _handle_call(self, uriparts, *args, **kwargs):
         logger.debug('Called: {}'.format(uriparts))
         logger.debug('With: {} {}'.format(args, kwargs))
-        patience = 1
-        while patience:
+        ep = WorkerScheduler.endpoint(uriparts)
+        retry = self.retry.start(uriparts, patient=self.wait)
+        while True:
+            with metrics.waiting(ep, 'backoff'):
+                retry.wait()
             c = None
+            ping = None
             try:
                 c = self.next(uriparts)
                 c._lock.acquire()
@@ -184,101 +579,166 @@ class TwitterQueue(QueueMixin):
                 ping = time.time()
                 resp = getattr(c.client, "/".join(uriparts))(*args, **kwargs)
                 pong = time.time()
+                metrics.REQUEST_SECONDS.labels(ep).observe(pong-ping)
+                metrics.REQUESTS.labels(ep, 'ok').inc()
                 c.update_limits_from_headers(uriparts, resp.headers)
                 logger.debug('Took: {}'.format(pong-ping))
+                retry.success()
                 return resp
-            except TwitterHTTPError as ex:
-                if ex.e.code in (429, 502, 503, 504):
+            except Exception as ex:
+                if ping:
+                    metrics.REQUEST_SECONDS.labels(ep).observe(time.time()-ping)
+                    metrics.REQUESTS.labels(ep, classify(ex) or 'error').inc()
+                if c and classify(ex) == LIMITED:
                     logger.info('{} limited'.format(c.name))
                     c.update_limits_from_headers(uriparts, ex.e.headers)
-                    continue
-                else:
+                if not retry.failure(ex):
                     raise
-            except urllib.error.URLError as ex:
-                time.sleep(5)
-                logger.info('Something fishy happened: {}'.format(ex))                
-                raise
             finally:
                 if c:
                     c.busy = False
                     c._lock.release()
-                if not self.wait:
-                    patience -= 1
+                    self.scheduler.release(c, uriparts)
 
     def get_wait(self, uriparts):
-        # Stop as soon as one is available to avoid initiating the rest
-        for i in self.queue:
-            if not i.busy and i.get_wait(uriparts) == 0:
-                return 0
-        # If None is available, let's see how much we have to wait
-        available = filter(lambda x: not x.busy, self.queue)
-        diff = min(worker.get_wait(uriparts) for worker in self.queue if not worker.busy)
+        diff = self.scheduler.get_wait(uriparts)
+        if diff is None:
+            return 0
         return diff
-        
+
+    def capacity(self, uriparts):
+        '''
+        How many calls to an endpoint can be made concurrently right now.
+        Each worker makes one call at a time, so it is the number of workers
+        that are not rate limited.
+        '''
+        return self.scheduler.capacity(uriparts)
+
+    def metrics(self):
+        '''
+        Current metrics of the calls to the API made in this process, and
+        the quota of the credentials of the queue (see bitter.metrics):
+
+            {'requests': {endpoint: {outcome: count}},
+             'latency': {endpoint: {'count': calls, 'sum': seconds}},
+             'remaining': {credential: {endpoint: calls}},
+             'wait': {endpoint: {reason: seconds}}}
+
+        They are empty if prometheus_client is not installed.
+        '''
+        names = set(w.name for w in self.queue)
+        res = {'requests': {}, 'latency': {}, 'remaining': {}, 'wait': {}}
+        for name, labels, value in metrics.snapshot():
+            if name == 'bitter_requests_total':
+                res['requests'].setdefault(labels['endpoint'], {})[labels['outcome']] = value
+            elif name in ('bitter_request_seconds_count', 'bitter_request_seconds_sum'):
+                key = name.rsplit('_', 1)[-1]
+                res['latency'].setdefault(labels['endpoint'], {})[key] = value
+            elif name == 'bitter_quota_remaining' and labels['credential'] in names:
+                res['remaining'].setdefault(labels['credential'], {})[labels['endpoint']] = value
+            elif name == 'bitter_wait_seconds_total':
+                res['wait'].setdefault(labels['endpoint'], {})[labels['reason']] = value
+        return res
 
     def _next(self, uriparts):
         logger.debug('Getting next available')
-        s = list(self.queue)
-        random.shuffle(s)
-        for worker in s:
-            if not worker.is_limited(uriparts) and not worker.busy:
-                return worker
-        raise QueueException('No worker is available')
+        return self.scheduler.next(uriparts)
 
     def next(self, uriparts):
+        '''
+        Check out the next available worker for an endpoint.
+        It should be given back with `self.scheduler.release`.
+        '''
         if not self.wait:
             return self._next(uriparts)
         while True:
             try:
                 return self._next(uriparts)
             except QueueException:
-                available = filter(lambda x: not x.busy, self.queue)
-                if available:
-                    diff = self.get_wait(uriparts)
-                    logger.info("All workers are throttled. Waiting %s seconds" % diff)
-                else:
+                diff = self.scheduler.get_wait(uriparts)
+                reason = 'limits'
+                if diff is None:
                     diff = 5
-                    logger.info("All workers are busy. Waiting %s seconds" % diff)
-                time.sleep(diff)
+                    reason = 'busy'
+                    logger.info("All workers are busy. Waiting up to %s seconds" % diff)
+                else:
+                    logger.info("All workers are throttled. Waiting %s seconds" % diff)
+                with metrics.waiting(WorkerScheduler.endpoint(uriparts), reason):
+                    self.scheduler.wait(diff)
 
 class StreamWorker(TwitterWorker):
     api_class = TwitterStream
+    domain_key = 'stream_domain'
 
     def __init__(self, *args, **kwargs):
         super(StreamWorker, self).__init__(*args, **kwargs)
 
 class StreamQueue(QueueMixin):
+    '''
+    Queue of stream workers. Streams that fail to connect, or that are
+    dropped with an error, are reconnected following the retry policy
+    (RetryPolicy.for_streams by default). If every credential is
+    streaming, new streams wait for one to be released (or fail, if wait
+    is False).
+    '''
     worker_class = StreamWorker
 
-    def __init__(self, wait=True):
+    def __init__(self, wait=True, retry=None):
         logger.debug('Creating worker queue')
         self.queue = set()
         self.index = 0
         self.wait = wait
+        self.retry = retry or RetryPolicy.for_streams()
+        self._lock = Lock()
+        self._released = Condition(self._lock)
         AttrToFunc.__init__(self, handler=self.handle_call)
 
     def handle_call(self, uriparts, *args, **kwargs):
         logger.debug('Called: {}'.format(uriparts))
         logger.debug('With: {} {}'.format(args, kwargs))
-        c = None
-        c = self.next(uriparts)
-        c._lock.acquire()
-        c.busy = True
-        logger.debug('Next: {}'.format(c.name))
-        ping = time.time()
-        resp = getattr(c.client, "/".join(uriparts))(*args, **kwargs)
-        for i in resp:
-            yield i
-        pong = time.time()
-        logger.debug('Listening for: {}'.format(pong-ping))
-        c.busy = False
-        c._lock.release()
+        retry = self.retry.start(uriparts, patient=self.wait)
+        while True:
+            retry.wait()
+            c = self.next(uriparts)
+            c._lock.acquire()
+            logger.debug('Next: {}'.format(c.name))
+            ping = time.time()
+            try:
+                resp = getattr(c.client, "/".join(uriparts))(*args, **kwargs)
+                retry.success()
+                for i in resp:
+                    yield i
+                return
+            except Exception as ex:
+                if not retry.failure(ex):
+                    raise
+            finally:
+                pong = time.time()
+                logger.debug('Listening for: {}'.format(pong-ping))
+                c._lock.release()
+                self.release(c)
 
     def next(self, uriparts):
+        '''
+        Pick a worker that is not streaming, and mark it as busy (a
+        credential can only keep one connection open).
+        '''
         logger.debug('Getting next available')
-        s = list(self.queue)
-        random.shuffle(s)
-        for worker in s:
-            if not worker.busy:
-                return worker
-        raise QueueException('No worker is available')
+        with self._released:
+            while True:
+                s = list(self.queue)
+                random.shuffle(s)
+                for worker in s:
+                    if not worker.busy:
+                        worker.busy = True
+                        return worker
+                if not self.wait or not self.queue:
+                    raise QueueException('No worker is available')
+                logger.info('All the credentials are streaming. Waiting for one to be released')
+                self._released.wait()
+
+    def release(self, worker):
+        '''Make a worker available again, and wake up a stream that waits for one'''
+        with self._released:
+            worker.busy = False
+            self._released.notify_all()
@@ -0,0 +1,128 @@
+'''
+Compact storage for the follower graph.
+
+Instead of a row per edge in the followers table, the followers of every
+crawled user are appended to a file of packed 64-bit integers
+(`<folder>/<user id>.edges`). A follower takes 8 bytes, files can be
+memory-mapped, and exporting the graph only requires reading them
+sequentially. E.g.:
+
+    store = EdgeStore('mydb.edges')
+    store.append(42, [1, 2, 3])
+    store.followers(42)  # -> memoryview of int64: [1, 2, 3]
+    for follower, followed in store.edges():
+        ...
+'''
+import os
+import sys
+import mmap
+import logging
+
+from array import array
+
+logger = logging.getLogger(__name__)
+
+SUFFIX = '.edges'
+ITEMSIZE = 8
+
+
+class EdgeStore(object):
+
+    def __init__(self, folder):
+        self.folder = folder
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def path(self, uid):
+        return os.path.join(self.folder, '{}{}'.format(int(uid), SUFFIX))
+
+    def append(self, uid, ids):
+        '''Add a batch of followers of a user. Returns the number of followers written'''
+        data = array('q', ids)
+        if sys.byteorder == 'big':
+            data.byteswap()
+        with open(self.path(uid), 'ab') as f:
+            data.tofile(f)
+        return len(data)
+
+    def truncate(self, uid, count=None):
+        '''
+        Keep only the first `count` followers of a user (by default, all
+        the complete ones, dropping the tail of an interrupted write).
+        Returns the number of followers left.
+        '''
+        path = self.path(uid)
+        if not os.path.exists(path):
+            return 0
+        size = os.path.getsize(path)
+        keep = size - size % ITEMSIZE
+        if count is not None:
+            keep = min(keep, int(count) * ITEMSIZE)
+        if keep < size:
+            logger.warning('Dropping %s bytes of followers of %s', size - keep, uid)
+            with open(path, 'r+b') as f:
+                f.truncate(keep)
+        return keep // ITEMSIZE
+
+    def reset(self, uid):
+        '''Remove all the followers of a user'''
+        if os.path.exists(self.path(uid)):
+            os.remove(self.path(uid))
+
+    def count(self, uid):
+        try:
+            return os.path.getsize(self.path(uid)) // ITEMSIZE
+        except OSError:
+            return 0
+
+    def users(self):
+        '''Ids of all the users with followers in the store'''
+        for fname in os.listdir(self.folder):
+            if fname.endswith(SUFFIX):
+                yield int(fname[:-len(SUFFIX)])
+
+    def followers(self, uid):
+        '''
+        Memory-mapped view of the followers of a user (a sequence of ints).
+        Files are written in little-endian order. A partial follower at
+        the end (an interrupted write) is ignored.
+        '''
+        path = self.path(uid)
+        if not os.path.exists(path) or os.path.getsize(path) < ITEMSIZE:
+            return memoryview(array('q'))
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mm)[:len(mm) - len(mm) % ITEMSIZE].cast('q')
+        if sys.byteorder == 'big':
+            data = array('q', view)
+            data.byteswap()
+            return memoryview(data)
+        return view
+
+    def iter_followers(self, uid, chunksize=65536):
+        '''Read the followers of a user in chunks, without mapping the whole file'''
+        with open(self.path(uid), 'rb') as f:
+            while True:
+                buf = f.read(chunksize * ITEMSIZE)
+                # Ignore a partial follower at the end
+                data = array('q', buf[:len(buf) - len(buf) % ITEMSIZE])
+                if not data:
+                    return
+                if sys.byteorder == 'big':
+                    data.byteswap()
+                yield data
+
+    def edges(self, chunksize=65536, since=None):
+        '''
+        Stream every (follower, followed) pair in the store.
+        If since (a timestamp) is given, only users updated after it are included.
+        '''
+        for uid in self.users():
+            if since is not None and os.path.getmtime(self.path(uid)) < since:
+                continue
+            for data in self.iter_followers(uid, chunksize):
+                for follower in data:
+                    yield follower, uid
+
+    def __len__(self):
+        return sum(self.count(uid) for uid in self.users())
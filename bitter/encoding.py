@@ -0,0 +1,108 @@
+'''
+JSON encoding for the objects bitter downloads and stores.
+
+`dumps` and `loads` use orjson if it is installed (`pip install bitter[fast]`),
+and the standard library otherwise. Objects that orjson cannot encode
+(e.g. integers over 64 bits) are encoded with the standard library.
+
+EncodingPool moves the encoding (and, for the folder caches, the writing)
+of downloaded objects to a pool of processes. See download_list.
+'''
+import json
+import logging
+import multiprocessing
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+BACKEND = 'orjson' if orjson else 'json'
+
+
+def dumps(obj, sort_keys=False, indent=None):
+    '''Encode an object as a JSON string'''
+    if orjson is not None and indent is None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0).decode('utf-8')
+        except TypeError:
+            pass
+    return json.dumps(obj, sort_keys=sort_keys, indent=indent)
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+
+# Cache of each worker process (see EncodingPool)
+_store = None
+
+
+def _init_worker(store):
+    global _store
+    _store = store
+
+
+def _encode(task):
+    '''
+    Encode an object, and store it if the worker has a cache.
+    Returns (seq, data, error), where data is None if the object has been stored.
+    '''
+    seq, oid, obj = task
+    if obj is None:
+        return seq, None, None
+    try:
+        data = dumps(obj)
+        if _store is None:
+            return seq, data, None
+        _store.put(oid, obj, data=data)
+        return seq, None, None
+    except Exception as ex:
+        return seq, None, '{}: {}'.format(type(ex).__name__, ex)
+
+
+class EncodingPool(object):
+    '''
+    Pool of processes that encode objects and, if the cache allows it
+    (i.e. Cache.parallel_writes), write them.
+
+    Results are returned in the same order as the tasks if ordered is True,
+    or as soon as they are ready otherwise.
+
+    Workers are started from a fork server (or spawned), not forked from
+    this process, which may be running other threads (e.g. the bootstrap
+    of a queue, or the metrics server).
+    '''
+
+    def __init__(self, processes=None, store=None, ordered=True, chunksize=64):
+        self.ordered = ordered
+        self.chunksize = chunksize
+        self.store = store if getattr(store, 'parallel_writes', False) else None
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        self._pool = context.Pool(processes, initializer=_init_worker, initargs=(self.store, ))
+
+    def imap(self, tasks):
+        '''Run (seq, oid, obj) tasks, and iterate over their (seq, data, error) results'''
+        if self.ordered:
+            return self._pool.imap(_encode, tasks, self.chunksize)
+        return self._pool.imap_unordered(_encode, tasks, self.chunksize)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        self._pool.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.terminate()
@@ -0,0 +1,161 @@
+'''
+Streaming exporters for extractor databases.
+
+Rows are read in chunks (with server-side cursors where the database
+supports them) and written as they arrive, so memory use does not depend
+on the size of the database.
+'''
+import csv
+import json
+import time
+import logging
+import datetime
+
+from itertools import islice
+
+from sqlalchemy import cast, BigInteger
+
+from .models import User, Following
+
+logger = logging.getLogger(__name__)
+
+EDGE_FORMATS = ['text', 'edgelist', 'csv', 'jsonlines', 'json', 'graphml', 'gexf']
+USER_FORMATS = ['indented', 'jsonlines', 'csv', 'json']
+
+
+def parse_since(since):
+    '''Timestamp from a date (YYYY-MM-DD[THH:MM:SS]) or a unix timestamp'''
+    if since is None:
+        return None
+    try:
+        return int(since)
+    except ValueError:
+        pass
+    for fmt in ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return int(time.mktime(datetime.datetime.strptime(since, fmt).timetuple()))
+        except ValueError:
+            continue
+    raise ValueError('Invalid date: {}'.format(since))
+
+
+def iter_edges(session, since=None, chunksize=10000):
+    '''Stream (follower, followed) pairs from the followers table'''
+    query = session.query(Following.follower, Following.isfollowed)
+    if since is not None:
+        query = query.filter(cast(Following.created_at_stamp, BigInteger) >= since)
+    for row in query.yield_per(chunksize):
+        yield row[0], row[1]
+
+
+def iter_nodes(session, since=None, chunksize=10000):
+    '''Stream the ids of every user in the followers table (deduplicated by the database)'''
+    followers = session.query(Following.follower.label('node'))
+    followed = session.query(Following.isfollowed.label('node'))
+    if since is not None:
+        ts = cast(Following.created_at_stamp, BigInteger)
+        followers = followers.filter(ts >= since)
+        followed = followed.filter(ts >= since)
+    for row in followers.union(followed).yield_per(chunksize):
+        yield row[0]
+
+
+def iter_users(session, since=None, chunksize=10000):
+    '''Stream users as dictionaries, without building ORM objects'''
+    columns = list(User.__table__.columns)
+    query = session.query(*columns)
+    if since is not None:
+        query = query.filter(cast(User.created_at_stamp, BigInteger) >= since)
+    names = list(c.name for c in columns)
+    for row in query.yield_per(chunksize):
+        user = dict(zip(names, row))
+        try:
+            user['entities'] = json.loads(user['entities'])
+        except (TypeError, ValueError):
+            pass
+        yield user
+
+
+def write_lines(out, lines, chunksize=10000):
+    '''Write lines in batches, to avoid a call to write per line'''
+    lines = iter(lines)
+    while True:
+        batch = list(islice(lines, chunksize))
+        if not batch:
+            break
+        out.write(''.join(batch))
+
+
+def write_json_array(objs, out, indent=None):
+    out.write('[')
+    first = True
+    for obj in objs:
+        if not first:
+            out.write(',')
+        out.write('\n')
+        out.write(json.dumps(obj, indent=indent))
+        first = False
+    out.write('\n]\n')
+
+
+def write_edges(edges, out, fmt='text', nodes=None):
+    '''
+    Write (follower, followed) pairs in one of EDGE_FORMATS.
+
+    GraphML and GEXF files include a node declaration for every id in
+    `nodes`, if it is given.
+    '''
+    if fmt == 'text':
+        write_lines(out, ('{} -> {}\n'.format(s, t) for (s, t) in edges))
+    elif fmt == 'edgelist':
+        write_lines(out, ('{} {}\n'.format(s, t) for (s, t) in edges))
+    elif fmt == 'csv':
+        out.write('source_id,target_id\n')
+        write_lines(out, ('{},{}\n'.format(s, t) for (s, t) in edges))
+    elif fmt == 'jsonlines':
+        write_lines(out, ('{{"source_id": {}, "target_id": {}, "following": true}}\n'.format(s, t)
+                          for (s, t) in edges))
+    elif fmt == 'json':
+        write_json_array(({'source_id': s, 'target_id': t, 'following': True} for (s, t) in edges),
+                         out, indent=4)
+    elif fmt == 'graphml':
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                  '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n'
+                  '<graph id="followers" edgedefault="directed">\n')
+        if nodes is not None:
+            write_lines(out, ('<node id="{}"/>\n'.format(n) for n in nodes))
+        write_lines(out, ('<edge source="{}" target="{}"/>\n'.format(s, t) for (s, t) in edges))
+        out.write('</graph>\n</graphml>\n')
+    elif fmt == 'gexf':
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                  '<gexf xmlns="http://www.gexf.net/1.2draft" version="1.2">\n'
+                  '<graph mode="static" defaultedgetype="directed">\n')
+        if nodes is not None:
+            out.write('<nodes>\n')
+            write_lines(out, ('<node id="{0}" label="{0}"/>\n'.format(n) for n in nodes))
+            out.write('</nodes>\n')
+        out.write('<edges>\n')
+        write_lines(out, ('<edge id="{}" source="{}" target="{}"/>\n'.format(ix, s, t)
+                          for (ix, (s, t)) in enumerate(edges)))
+        out.write('</edges>\n</graph>\n</gexf>\n')
+    else:
+        raise ValueError('Unknown format: {}'.format(fmt))
+
+
+def write_users(users, out, fmt='indented'):
+    '''Write user dictionaries in one of USER_FORMATS'''
+    if fmt == 'indented':
+        write_lines(out, (json.dumps(u, indent=4) + '\n' for u in users))
+    elif fmt == 'jsonlines':
+        write_lines(out, (json.dumps(u) + '\n' for u in users))
+    elif fmt == 'json':
+        write_json_array(users, out)
+    elif fmt == 'csv':
+        fields = list(c.name for c in User.__table__.columns)
+        writer = csv.DictWriter(out, fieldnames=fields, extrasaction='ignore')
+        writer.writeheader()
+        for u in users:
+            u['entities'] = json.dumps(u['entities'])
+            writer.writerow(u)
+    else:
+        raise ValueError('Unknown format: {}'.format(fmt))
@@ -0,0 +1,291 @@
+'''
+A local stand-in for the Twitter REST API, for tests and benchmarks.
+
+It only implements the endpoints bitter uses, returns made-up objects and
+keeps per-credential rate limits (with the usual X-Rate-Limit-* headers).
+E.g.:
+
+    from bitter.fakeapi import FakeAPI
+    from bitter.crawlers import TwitterQueue
+
+    with FakeAPI(latency=0.05) as api:
+        wq = TwitterQueue.from_config(config=api.config(workers=4))
+        wq.users.lookup(user_id='1,2,3')
+'''
+import json
+import time
+import threading
+import logging
+
+from collections import Counter
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qsl
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qsl
+
+logger = logging.getLogger(__name__)
+
+DATE = 'Mon Jan 01 00:00:00 +0000 2018'
+
+
+def fake_user(uid):
+    uid = int(uid)
+    return {
+        'id': uid,
+        'id_str': str(uid),
+        'screen_name': 'user{}'.format(uid),
+        'name': 'Fake user {}'.format(uid),
+        'created_at': DATE,
+        'description': 'A fake user',
+        'entities': {'description': {'urls': []}},
+        'followers_count': (uid * 7) % 5000,
+        'friends_count': (uid * 3) % 1000,
+        'statuses_count': (uid * 11) % 10000,
+        'lang': 'en',
+        'protected': False,
+        'verified': False,
+    }
+
+
+def fake_tweet(tid):
+    tid = int(tid)
+    return {
+        'id': tid,
+        'id_str': str(tid),
+        'created_at': DATE,
+        'text': 'Fake tweet number {}'.format(tid),
+        'lang': 'en',
+        'entities': {'hashtags': [{'text': 'fake'}], 'urls': [], 'user_mentions': []},
+        'user': fake_user(tid % 1000 + 1),
+    }
+
+
+class FakeAPI(object):
+    '''
+    Threaded HTTP server that emulates the parts of the REST API used by bitter.
+
+    - latency: seconds to wait before answering each request.
+    - limit/window: number of calls allowed per credential and endpoint
+      in each window (in seconds).
+    - missing: fraction of ids (0-1) that will not be found.
+    - followers: number of followers of some users ({user id: count}).
+      Followers of a user with N followers have ids 1..N.
+    - results: number of tweets found by any search. Their ids go from
+      `results` down to 1.
+
+    Errors can be injected with `fail` (e.g. `api.fail(503, times=2)`).
+    Injected 429 errors limit the credential for `retry_after` seconds.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, limit=900, window=15*60, missing=0,
+                 followers=None, results=1000, retry_after=1):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.limit = limit
+        self.window = window
+        self.missing = missing
+        self.followers = followers or {}
+        self.results = results
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self._limits = {}
+        self._errors = []
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+        self.endpoints = {
+            'application/rate_limit_status': self.rate_limit_status,
+            'users/lookup': self.users_lookup,
+            'statuses/lookup': self.statuses_lookup,
+            'followers/ids': self.followers_ids,
+            'search/tweets': self.search_tweets,
+        }
+
+    @property
+    def domain(self):
+        return '{}:{}'.format(self.host, self.port)
+
+    def credentials(self, workers=1):
+        return [{'user': 'fake{}'.format(i),
+                 'consumer_key': 'consumer{}'.format(i),
+                 'consumer_secret': 'secret{}'.format(i),
+                 'token_key': 'token{}'.format(i),
+                 'token_secret': 'tsecret{}'.format(i),
+                 'domain': self.domain,
+                 'stream_domain': self.domain,
+                 'secure': False} for i in range(workers)]
+
+    def config(self, workers=1):
+        return {'credentials': self.credentials(workers)}
+
+    def start(self):
+        self._server = _Server((self.host, self.port), _Handler)
+        self._server.api = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.debug('Fake API listening on {}'.format(self.domain))
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def fail(self, code=503, times=1, endpoint=None):
+        '''Answer the next `times` calls (to an endpoint, or to any) with an HTTP error'''
+        with self._lock:
+            self._errors.append([endpoint, code, times])
+
+    def error(self, endpoint):
+        '''HTTP error to answer a call with, if any (see fail)'''
+        with self._lock:
+            for err in self._errors:
+                if err[0] in (None, endpoint):
+                    err[2] -= 1
+                    if err[2] <= 0:
+                        self._errors.remove(err)
+                    self.calls[endpoint] += 1
+                    return err[1]
+
+    def is_missing(self, oid):
+        return (int(oid) % 100) < self.missing * 100
+
+    def consume(self, token, endpoint):
+        '''Count a call against the limits. Returns (remaining, reset, limit).'''
+        now = time.time()
+        with self._lock:
+            self.calls[endpoint] += 1
+            remaining, reset = self._limits.get((token, endpoint), (self.limit, now + self.window))
+            if reset <= now:
+                remaining, reset = self.limit, now + self.window
+            remaining -= 1
+            self._limits[(token, endpoint)] = (remaining, reset)
+        return remaining, reset, self.limit
+
+    def get_limit(self, token, endpoint):
+        now = time.time()
+        remaining, reset = self._limits.get((token, endpoint), (self.limit, now + self.window))
+        if reset <= now:
+            remaining, reset = self.limit, now + self.window
+        return {'limit': self.limit, 'remaining': remaining, 'reset': int(reset)}
+
+    def user(self, uid):
+        user = fake_user(uid)
+        if int(uid) in self.followers:
+            user['followers_count'] = self.followers[int(uid)]
+        return user
+
+    def rate_limit_status(self, params):
+        resources = {}
+        token = params.get('oauth_token')
+        for endpoint in self.endpoints:
+            family = endpoint.split('/')[0]
+            resources.setdefault(family, {})['/' + endpoint] = self.get_limit(token, endpoint)
+        return 200, {'resources': resources}
+
+    def users_lookup(self, params):
+        users = []
+        for uid in filter(None, params.get('user_id', '').split(',')):
+            if not self.is_missing(uid):
+                users.append(self.user(uid))
+        for name in filter(None, params.get('screen_name', '').split(',')):
+            uid = name.lower().replace('user', '')
+            if uid.isdigit() and not self.is_missing(uid):
+                users.append(self.user(uid))
+        if not users:
+            return 404, {'errors': [{'code': 17, 'message': 'No user matches for specified terms.'}]}
+        return 200, users
+
+    def statuses_lookup(self, params):
+        ids = list(filter(None, params.get('id', '').split(',')))
+        if params.get('map') in ('true', 'True', '1'):
+            return 200, {'id': {tid: (None if self.is_missing(tid) else fake_tweet(tid)) for tid in ids}}
+        return 200, [fake_tweet(tid) for tid in ids if not self.is_missing(tid)]
+
+    def search_tweets(self, params):
+        count = min(int(params.get('count', 15)), 100)
+        top = min(int(params.get('max_id', self.results)), self.results)
+        ids = range(top, max(top - count, 0), -1)
+        return 200, {'statuses': [fake_tweet(tid) for tid in ids],
+                     'search_metadata': {'count': count, 'query': params.get('q', '')}}
+
+    def followers_ids(self, params):
+        uid = params.get('user_id') or params.get('screen_name', '').lower().replace('user', '')
+        total = self.user(uid)['followers_count']
+        count = int(params.get('count', 5000))
+        start = max(int(params.get('cursor', -1)), 0)
+        end = min(start + count, total)
+        return 200, {'ids': list(range(start + 1, end + 1)),
+                     'next_cursor': end if end < total else 0,
+                     'previous_cursor': -start if start else 0}
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_api(None)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.handle_api(self.rfile.read(length).decode('utf-8'))
+
+    def handle_api(self, body):
+        api = self.server.api
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        if body:
+            params.update(parse_qsl(body))
+        endpoint = url.path.strip('/').split('/', 1)[-1].rsplit('.', 1)[0]
+        if api.latency:
+            time.sleep(api.latency)
+        if endpoint not in api.endpoints:
+            return self.reply(404, {'errors': [{'code': 34, 'message': 'Sorry, that page does not exist'}]})
+        error = api.error(endpoint)
+        if error == 429:
+            headers = {'X-Rate-Limit-Limit': api.limit,
+                       'X-Rate-Limit-Remaining': 0,
+                       'X-Rate-Limit-Reset': int(time.time() + api.retry_after + 1)}
+            return self.reply(429, {'errors': [{'code': 88, 'message': 'Rate limit exceeded'}]}, headers)
+        if error:
+            return self.reply(error, {'errors': [{'code': 131, 'message': 'Internal error'}]})
+        remaining, reset, limit = api.consume(params.get('oauth_token'), endpoint)
+        headers = {'X-Rate-Limit-Limit': limit,
+                   'X-Rate-Limit-Remaining': max(remaining, 0),
+                   'X-Rate-Limit-Reset': int(reset)}
+        if remaining < 0:
+            return self.reply(429, {'errors': [{'code': 88, 'message': 'Rate limit exceeded'}]}, headers)
+        code, data = api.endpoints[endpoint](params)
+        self.reply(code, data, headers)
+
+    def reply(self, code, data, headers={}):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json;charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, str(v))
+        self.end_headers()
+        self.wfile.write(body)
@@ -0,0 +1,269 @@
+'''
+Compact set of 64-bit ids (tweets, users...), to check which ids have
+been seen without a database query or a file lookup for each of them.
+
+Ids are kept in a sorted array of int64 (8 bytes per id, instead of the
+~70 of an int in a Python set), and looked up with a binary search. 500
+million ids take 4 GB. Ids added one at a time go to a small set first,
+which is merged into the array when it holds `buffer` ids. Keys that are
+not integers (e.g. screen names) are kept in a regular set.
+
+NumPy is used to sort, merge and search the ids if it is installed
+(`pip install bitter[fast]`), and the standard library otherwise.
+
+Sets can be built from a database query or a folder listing in a single
+scan, and saved to (or loaded from) files of little-endian int64, like
+the ones of `bitter.edges`. E.g.:
+
+    seen = IdSet.from_query(session.query(User.id))
+    seen.add(42)
+    42 in seen  # -> True
+    seen.save('users.ids')
+    seen = IdSet.load('users.ids')
+'''
+import os
+import sys
+import heapq
+import logging
+import threading
+
+from array import array
+from bisect import bisect_left
+from itertools import islice
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+ITEMSIZE = 8
+CHUNKSIZE = 1 << 20
+
+
+def as_id(key):
+    '''An id as an int, or None if it is not one (e.g. a screen name, or '007')'''
+    if isinstance(key, int):
+        return key
+    try:
+        oid = int(key)
+    except (TypeError, ValueError):
+        return None
+    if str(oid) != str(key):
+        return None
+    return oid
+
+
+class IdSet(object):
+    '''Set of ids (see the module documentation)'''
+
+    def __init__(self, ids=(), buffer=1 << 16):
+        self.buffer = buffer
+        self._sorted = self._empty()
+        self._unsorted = array('q')
+        self._recent = set()
+        self._removed = set()
+        self.names = set()
+        self._lock = threading.RLock()
+        self.update(ids)
+
+    @staticmethod
+    def _empty():
+        return numpy.empty(0, dtype=numpy.int64) if numpy is not None else array('q')
+
+    def add(self, key):
+        with self._lock:
+            oid = as_id(key)
+            if oid is None:
+                self.names.add(key)
+                return
+            self._removed.discard(oid)
+            self._recent.add(oid)
+            if len(self._recent) >= self.buffer:
+                self._unsorted.extend(self._recent)
+                self._recent = set()
+                self._merge()
+
+    def update(self, keys):
+        '''
+        Add many ids at once. They are sorted the next time the set is read
+        (or when there are as many of them as sorted ids, to bound memory).
+        NumPy arrays of ids are added without converting every id.
+        '''
+        with self._lock:
+            if numpy is not None and isinstance(keys, numpy.ndarray):
+                keys = numpy.ascontiguousarray(keys, dtype=numpy.int64)
+                if self._removed:
+                    self._removed.difference_update(keys.tolist())
+                self._unsorted.frombytes(keys.tobytes())
+                self._compact()
+                return
+            for batch in _chunks(keys, CHUNKSIZE):
+                ids = array('q')
+                for key in batch:
+                    oid = as_id(key)
+                    if oid is None:
+                        self.names.add(key)
+                    else:
+                        ids.append(oid)
+                if self._removed:
+                    self._removed.difference_update(ids)
+                self._unsorted.extend(ids)
+                self._compact()
+
+    def _compact(self):
+        if len(self._unsorted) > max(CHUNKSIZE, len(self._sorted)):
+            self._merge()
+
+    def discard(self, key):
+        with self._lock:
+            oid = as_id(key)
+            if oid is None:
+                self.names.discard(key)
+                return
+            self._recent.discard(oid)
+            if self._unsorted:
+                self._merge()
+            if self._find(oid):
+                self._removed.add(oid)
+
+    def _find(self, oid):
+        ids = self._sorted
+        if numpy is not None:
+            pos = int(numpy.searchsorted(ids, oid))
+        else:
+            pos = bisect_left(ids, oid)
+        return pos < len(ids) and ids[pos] == oid
+
+    def _merge(self):
+        '''Sort the ids added in bulk, and merge them (and the removals) into the array'''
+        added = self._unsorted
+        self._unsorted = array('q')
+        removed, self._removed = self._removed, set()
+        if numpy is not None:
+            # Much faster than numpy.union1d, which hashes the ids in NumPy 2
+            merged = numpy.concatenate((self._sorted, numpy.frombuffer(added, dtype=numpy.int64)))
+            merged.sort()
+            if len(merged):
+                merged = merged[numpy.r_[True, merged[1:] != merged[:-1]]]
+            if removed:
+                merged = merged[~numpy.isin(merged, numpy.fromiter(removed, dtype=numpy.int64))]
+            self._sorted = merged
+            return
+        merged = array('q')
+        last = None
+        for oid in heapq.merge(self._sorted, sorted(added)):
+            if oid != last and oid not in removed:
+                merged.append(oid)
+            last = oid
+        self._sorted = merged
+
+    def __contains__(self, key):
+        with self._lock:
+            oid = as_id(key)
+            if oid is None:
+                return key in self.names
+            if oid in self._recent:
+                return True
+            if self._unsorted:
+                self._merge()
+            return oid not in self._removed and self._find(oid)
+
+    def check(self, keys):
+        '''The keys of a batch that are in the set'''
+        with self._lock:
+            if numpy is None:
+                return set(key for key in keys if key in self)
+            if self._unsorted:
+                self._merge()
+            found = set()
+            numeric = []
+            for key in keys:
+                oid = as_id(key)
+                if oid is None:
+                    if key in self.names:
+                        found.add(key)
+                elif oid in self._recent:
+                    found.add(key)
+                else:
+                    numeric.append((oid, key))
+            if numeric and len(self._sorted):
+                oids = numpy.array([oid for (oid, key) in numeric], dtype=numpy.int64)
+                pos = numpy.searchsorted(self._sorted, oids)
+                pos[pos == len(self._sorted)] = 0
+                hits = self._sorted[pos] == oids
+                found.update(key for (oid, key), hit in zip(numeric, hits)
+                             if hit and oid not in self._removed)
+            return found
+
+    def __len__(self):
+        with self._lock:
+            if self._unsorted or self._removed:
+                self._merge()
+            return len(self._sorted) + sum(1 for oid in self._recent if not self._find(oid)) + len(self.names)
+
+    def ids(self):
+        '''Sorted array of all the ids (not the names)'''
+        with self._lock:
+            if self._recent:
+                self._unsorted.extend(self._recent)
+                self._recent = set()
+            if self._unsorted or self._removed:
+                self._merge()
+            return self._sorted
+
+    def __iter__(self):
+        for oid in self.ids():
+            yield int(oid)
+        for name in self.names:
+            yield name
+
+    def nbytes(self):
+        '''Approximate memory used by the ids'''
+        return ITEMSIZE * (len(self._sorted) + len(self._unsorted)) + 70 * (len(self._recent) + len(self.names))
+
+    def save(self, path):
+        '''Save the ids (not the names) to a file of sorted little-endian int64'''
+        ids = self.ids()
+        tmp = '{}.tmp'.format(path)
+        with open(tmp, 'wb') as f:
+            if numpy is not None:
+                ids.astype('<i8').tofile(f)
+            else:
+                data = ids
+                if sys.byteorder == 'big':
+                    data = array('q', ids)
+                    data.byteswap()
+                data.tofile(f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        '''Load a set saved with save. A missing file is an empty set.'''
+        idset = cls(**kwargs)
+        if not os.path.exists(path):
+            return idset
+        if numpy is not None:
+            idset._sorted = numpy.fromfile(path, dtype='<i8').astype(numpy.int64)
+            return idset
+        data = array('q')
+        with open(path, 'rb') as f:
+            data.frombytes(f.read())
+        if sys.byteorder == 'big':
+            data.byteswap()
+        idset._sorted = data
+        return idset
+
+    @classmethod
+    def from_query(cls, query, chunksize=10000, **kwargs):
+        '''Set of the first column of the rows of a query, read in chunks'''
+        return cls((row[0] for row in query.yield_per(chunksize)), **kwargs)
+
+    def __repr__(self):
+        return '<IdSet of {} ids>'.format(len(self))
+
+
+def _chunks(iterable, n):
+    it = iter(iterable)
+    return iter(lambda: list(islice(it, n)), [])
@@ -0,0 +1,224 @@
+'''
+Checkpoints for long downloads (`tweet get_all` / `users get_all`).
+
+A journal is a SQLite file with a row per job (an input file and the
+folder its objects are downloaded to). The row keeps the byte offset in
+the input file up to which every id has been downloaded and stored, so an
+interrupted job can seek to that offset and carry on. The outcome of each
+id is kept too. E.g.:
+
+    with Journal('downloads.journal') as journal:
+        job = journal.job('ids.csv', 'tweets')
+        job.offset  # -> where to resume
+        job.issue('1234', 10)  # '1234' ends at byte 10
+        job.complete('1234', True)
+        job.commit()
+'''
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+from collections import defaultdict, deque
+
+logger = logging.getLogger(__name__)
+
+
+class Journal(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                           'id INTEGER PRIMARY KEY, '
+                           'input TEXT NOT NULL, '
+                           'target TEXT NOT NULL, '
+                           'size INTEGER, '
+                           'offset INTEGER NOT NULL DEFAULT 0, '
+                           'done INTEGER NOT NULL DEFAULT 0, '
+                           'failed INTEGER NOT NULL DEFAULT 0, '
+                           'finished INTEGER NOT NULL DEFAULT 0, '
+                           'started REAL, '
+                           'start_offset INTEGER NOT NULL DEFAULT 0, '
+                           'updated REAL, '
+                           'UNIQUE (input, target))')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS outcomes ('
+                           'job INTEGER NOT NULL, '
+                           'oid TEXT NOT NULL, '
+                           'ok INTEGER NOT NULL, '
+                           'PRIMARY KEY (job, oid)) WITHOUT ROWID')
+        self._conn.commit()
+
+    def execute(self, sql, params=(), commit=False):
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+            if commit:
+                self._conn.commit()
+            return rows
+
+    def job(self, infile, target, restart=False):
+        '''
+        Job to download the ids in infile to target (e.g. a folder).
+        Jobs start where the last run left off, unless restart is True or
+        the input file is now smaller than the saved offset.
+        '''
+        infile = os.path.abspath(infile)
+        target = str(target)
+        size = os.path.getsize(infile)
+        with self._lock:
+            self.execute('INSERT OR IGNORE INTO jobs (input, target) VALUES (?, ?)', (infile, target))
+            jid, offset, done, failed = self.execute('SELECT id, offset, done, failed FROM jobs '
+                                                     'WHERE input = ? AND target = ?', (infile, target))[0]
+            if restart or offset > size:
+                if offset:
+                    logger.info('Restarting job {} ({})'.format(jid, infile))
+                offset = done = failed = 0
+                self.execute('DELETE FROM outcomes WHERE job = ?', (jid, ))
+            elif offset:
+                logger.info('Resuming job {} ({}) at byte {} of {}'.format(jid, infile, offset, size))
+            self.execute('UPDATE jobs SET size = ?, offset = ?, done = ?, failed = ?, finished = 0, '
+                         'started = ?, start_offset = ?, updated = ? WHERE id = ?',
+                         (size, offset, done, failed, time.time(), offset, time.time(), jid), commit=True)
+        return Job(self, jid, offset, done, failed)
+
+    def jobs(self):
+        '''Progress of every job in the journal (see Job.progress)'''
+        rows = self.execute('SELECT id, input, target, size, offset, done, failed, finished, '
+                            'started, start_offset, updated FROM jobs ORDER BY id')
+        for row in rows:
+            yield progress(*row)
+
+    def outcomes(self, jid, ok=None):
+        '''Ids processed by a job (only the successful ones, or the failed ones, if ok is given)'''
+        if ok is None:
+            rows = self.execute('SELECT oid, ok FROM outcomes WHERE job = ?', (jid, ))
+        else:
+            rows = self.execute('SELECT oid, ok FROM outcomes WHERE job = ? AND ok = ?', (jid, int(ok)))
+        for oid, res in rows:
+            yield oid, bool(res)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def progress(jid, infile, target, size, offset, done, failed, finished, started, start_offset, updated):
+    '''Progress of a job as a dictionary, with an estimate of the time left (in seconds)'''
+    eta = None
+    if finished:
+        eta = 0
+    elif started and updated and offset > start_offset:
+        rate = (offset - start_offset) / (updated - started)
+        eta = (size - offset) / rate
+    return {
+        'id': jid,
+        'input': infile,
+        'target': target,
+        'size': size,
+        'offset': offset,
+        'progress': (offset / size) if size else 1,
+        'done': done,
+        'failed': failed,
+        'finished': bool(finished),
+        'eta': eta,
+    }
+
+
+class Job(object):
+    '''
+    Tracks the ids of a job as they are issued (read from the input) and
+    completed (downloaded and stored, or failed).
+
+    Ids may complete in any order, and completing an id completes all the
+    copies of it that have been issued. The offset only moves forward to the end
+    of the last id such that all the ids before it have been completed.
+    It is saved on commit, which happens automatically every `batchsize`
+    completed ids or `interval` seconds. `flush` is called before every
+    commit, so that objects are stored before the offset moves past them.
+    '''
+
+    def __init__(self, journal, jid, offset=0, done=0, failed=0, batchsize=1000, interval=10, flush=None):
+        self.journal = journal
+        self.id = jid
+        self.offset = offset
+        self.done = done
+        self.failed = failed
+        self.batchsize = batchsize
+        self.interval = interval
+        self.flush = flush
+        self._lock = threading.RLock()
+        self._issued = 0
+        self._next = 0
+        self._ends = {}
+        self._completed = set()
+        self._pending = defaultdict(deque)
+        self._outcomes = []
+        self._last = time.time()
+
+    @staticmethod
+    def key(oid):
+        # Screen names are not case sensitive (and users are returned in lowercase)
+        return str(oid).lower()
+
+    def issue(self, oid, end):
+        '''An id has been read from the input. `end` is the offset right after it.'''
+        with self._lock:
+            self._pending[self.key(oid)].append(self._issued)
+            self._ends[self._issued] = end
+            self._issued += 1
+
+    def complete(self, oid, ok=True):
+        with self._lock:
+            # Every copy of the id issued so far. Batch methods return
+            # the ids that are repeated in a batch only once.
+            seqs = self._pending.pop(self.key(oid), None)
+            if not seqs:
+                logger.debug('Completed an id that was not issued: {}'.format(oid))
+                return
+            self._completed.update(seqs)
+            while self._next in self._completed:
+                self._completed.remove(self._next)
+                self.offset = self._ends.pop(self._next)
+                self._next += 1
+            self._outcomes.append((self.id, str(oid), int(bool(ok))))
+            if ok:
+                self.done += len(seqs)
+            else:
+                self.failed += len(seqs)
+            if len(self._outcomes) >= self.batchsize or time.time() - self._last > self.interval:
+                self.commit()
+
+    def commit(self, finished=False):
+        with self._lock:
+            if self.flush:
+                self.flush()
+            outcomes, self._outcomes = self._outcomes, []
+            self._last = time.time()
+            with self.journal._lock:
+                self.journal._conn.executemany('INSERT OR REPLACE INTO outcomes (job, oid, ok) VALUES (?, ?, ?)',
+                                               outcomes)
+                self.journal.execute('UPDATE jobs SET offset = ?, done = ?, failed = ?, finished = ?, updated = ? '
+                                     'WHERE id = ?',
+                                     (self.offset, self.done, self.failed, int(finished), self._last, self.id),
+                                     commit=True)
+
+    def finish(self, size=None):
+        '''Mark the job as finished (the whole input has been processed)'''
+        with self._lock:
+            if size is not None:
+                self.offset = size
+            self.commit(finished=True)
+
+    def progress(self):
+        row = self.journal.execute('SELECT id, input, target, size, offset, done, failed, finished, '
+                                   'started, start_offset, updated FROM jobs WHERE id = ?', (self.id, ))[0]
+        return progress(*row)
@@ -0,0 +1,173 @@
+'''
+Metrics of the queues, workers and pipelines, in the Prometheus format.
+
+- bitter_request_seconds: duration of the calls to the API, per endpoint.
+- bitter_requests_total: calls per endpoint and outcome (ok, limited,
+  server, network or error).
+- bitter_quota_remaining: calls left for each credential and endpoint.
+- bitter_wait_seconds_total: time spent waiting for a worker because of
+  the rate limits (limits) or because all of them were busy (busy), or
+  backing off after an error (backoff).
+- bitter_queue_depth: items waiting in each queue of a pipeline
+  (download_list, crawl_users).
+- bitter_objects_total: objects processed by each stage of a pipeline.
+  Objects per second are `rate(bitter_objects_total[1m])`.
+- bitter_db_commit_seconds: duration of the database commits.
+
+prometheus_client is an optional dependency (pip install bitter[metrics]).
+Without it, nothing is recorded. Metrics live in their own registry
+(REGISTRY). They can be pulled with `snapshot` or `TwitterQueue.metrics`,
+or scraped over HTTP once `serve` has been called
+(e.g. `bitter --metrics-port 9100 tweet get_all ...`).
+'''
+import time
+import logging
+import threading
+
+from contextlib import contextmanager
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+logger = logging.getLogger(__name__)
+
+ENABLED = prometheus_client is not None
+
+REGISTRY = prometheus_client.CollectorRegistry() if ENABLED else None
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class _Null(object):
+    '''Does nothing. Used for every metric if prometheus_client is not installed.'''
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def set_function(self, f):
+        pass
+
+    def remove(self, *labels):
+        pass
+
+
+def _metric(kind, name, doc, labels=(), **kwargs):
+    if not ENABLED:
+        return _Null()
+    return getattr(prometheus_client, kind)(name, doc, labels, registry=REGISTRY, **kwargs)
+
+
+REQUEST_SECONDS = _metric('Histogram', 'bitter_request_seconds', 'Duration of the calls to the API',
+                          ['endpoint'], buckets=LATENCY_BUCKETS)
+REQUESTS = _metric('Counter', 'bitter_requests', 'Calls to the API', ['endpoint', 'outcome'])
+QUOTA_REMAINING = _metric('Gauge', 'bitter_quota_remaining', 'Calls left in the rate limit window',
+                          ['credential', 'endpoint'])
+WAIT_SECONDS = _metric('Counter', 'bitter_wait_seconds', 'Time spent waiting to call the API',
+                       ['endpoint', 'reason'])
+QUEUE_DEPTH = _metric('Gauge', 'bitter_queue_depth', 'Items waiting in the queues of a pipeline',
+                      ['pipeline', 'queue'])
+OBJECTS = _metric('Counter', 'bitter_objects', 'Objects processed by a pipeline', ['pipeline', 'stage'])
+COMMIT_SECONDS = _metric('Histogram', 'bitter_db_commit_seconds', 'Duration of the database commits',
+                         buckets=LATENCY_BUCKETS)
+
+
+# Queues tracked under every (pipeline, queue) label. Pipelines that run
+# at the same time report the sum of their queues.
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def track_queue(pipeline, name, q):
+    '''Report the size of a queue (anything with a qsize method) when metrics are collected'''
+    key = (pipeline, name)
+    with _queues_lock:
+        if key not in _queues:
+            queues = _queues[key] = []
+            QUEUE_DEPTH.labels(pipeline, name).set_function(lambda: sum(q.qsize() for q in list(queues)))
+        _queues[key].append(q)
+
+
+def untrack_queue(pipeline, name, q):
+    '''Stop reporting a queue. The label is removed with the last queue'''
+    key = (pipeline, name)
+    with _queues_lock:
+        queues = _queues.get(key, [])
+        for (i, other) in enumerate(queues):
+            if other is q:
+                del queues[i]
+                break
+        if queues:
+            return
+        _queues.pop(key, None)
+        try:
+            QUEUE_DEPTH.remove(pipeline, name)
+        except KeyError:
+            pass
+
+
+@contextmanager
+def waiting(endpoint, reason):
+    '''Add the time spent in a block to bitter_wait_seconds'''
+    start = time.time()
+    try:
+        yield
+    finally:
+        waited = time.time() - start
+        if waited > 0.001:
+            WAIT_SECONDS.labels(endpoint, reason).inc(waited)
+
+
+def instrument_session(session_class):
+    '''Time the commits of the sessions of a sessionmaker'''
+    if not ENABLED:
+        return
+    from sqlalchemy import event
+
+    def before(session):
+        session.info['commit_start'] = time.time()
+
+    def after(session):
+        start = session.info.pop('commit_start', None)
+        if start is not None:
+            COMMIT_SECONDS.observe(time.time() - start)
+
+    event.listen(session_class, 'before_commit', before)
+    event.listen(session_class, 'after_commit', after)
+
+
+def serve(port, addr='0.0.0.0'):
+    '''Expose the metrics over HTTP (at any path), in a background thread'''
+    if not ENABLED:
+        raise Exception('Metrics require the prometheus_client package. '
+                        'Install it with: pip install bitter[metrics]')
+    logger.info('Serving metrics on {}:{}'.format(addr, port))
+    return prometheus_client.start_http_server(port, addr, registry=REGISTRY)
+
+
+def snapshot():
+    '''Current value of every metric, as a list of (name, labels, value)'''
+    if not ENABLED:
+        return []
+    res = []
+    for metric in REGISTRY.collect():
+        for sample in metric.samples:
+            res.append((sample.name, sample.labels, sample.value))
+    return res
+
+
+def render():
+    '''Metrics in the Prometheus text format'''
+    if not ENABLED:
+        return ''
+    return prometheus_client.generate_latest(REGISTRY).decode('utf-8')
@@ -1,16 +1,23 @@
+import os
 import time
 import json
+import threading
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.types import BigInteger, Integer, Text, Boolean
+from sqlalchemy.types import BigInteger, Integer, Text, Boolean, Float
 from sqlalchemy.schema import ForeignKey
-from sqlalchemy.pool import SingletonThreadPool
-from sqlalchemy import Column, Index
+from sqlalchemy.pool import StaticPool, QueuePool
+from sqlalchemy import Column, Index, inspect, event
 
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import sessionmaker, scoped_session
 from functools import wraps
 
+from . import config
+from . import metrics
+from . import profiling
+
 Base = declarative_base()
 
 
@@ -75,11 +82,11 @@ class Following(Base):
     __tablename__ = 'followers'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    isfollowed = Column(Integer)
-    follower = Column(Integer)
+    isfollowed = Column(BigInteger)
+    follower = Column(BigInteger)
     created_at_stamp = Column(Text)
 
-    follower_index = Index('isfollowed', 'follower')
+    __table_args__ = (Index('ix_followers_isfollowed_follower', 'isfollowed', 'follower'), )
 
 class ExtractorEntry(Base):
     __tablename__ = 'extractor-cursor'
@@ -90,6 +97,41 @@ class ExtractorEntry(Base):
     pending = Column(Boolean, default=False)
     errors = Column(Text, default="")
     busy = Column(Boolean, default=False)
+    # Worker that is crawling the entry, and until when (see bitter.workqueue)
+    lease_owner = Column(Text)
+    lease_expires = Column(Float)
+    # Copy of the followers_count of the user, so entries can be claimed
+    # in order with an index instead of a join. add_user, crawl_users and
+    # crawl_user keep it in sync. Other writes to users can leave it stale,
+    # which only changes the order in which entries are claimed.
+    followers_count = Column(BigInteger)
+    # Followers in the EdgeStore when the cursor was committed, so a
+    # resumed crawl can drop the pages written after it
+    edges = Column(BigInteger)
+
+    __table_args__ = (Index('ix_extractor_claim', 'pending', 'followers_count', 'lease_expires'), )
+
+
+class NodeStats(Base):
+    '''Metrics of a user in the follower graph (see bitter.analysis)'''
+    __tablename__ = 'analysis-nodes'
+
+    id = Column(BigInteger, primary_key=True)
+    in_degree = Column(Integer)
+    out_degree = Column(Integer)
+    core = Column(Integer)
+    pagerank = Column(Float)
+
+
+class FollowerOverlap(Base):
+    '''Followers shared by two of the most followed users (see bitter.analysis)'''
+    __tablename__ = 'analysis-overlaps'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_a = Column(BigInteger, index=True)
+    user_b = Column(BigInteger, index=True)
+    shared = Column(Integer)
+    jaccard = Column(Float)
 
 
 class Search(Base):
@@ -120,15 +162,148 @@ def memoize(f):
         return memo[key]
     return helper
 
-def make_session(url):
-    if not isinstance(url, str):
-        print(url)
-        raise Exception("FUCK")
-    engine = create_engine(url, poolclass=SingletonThreadPool)#, echo=True)
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def is_memory(url):
+    url = make_url(url)
+    return url.drivername.startswith('sqlite') and url.database in (None, '', ':memory:')
+
+
+def _set_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in config.SQLITE_PRAGMAS.items():
+        cursor.execute('PRAGMA {}={}'.format(pragma, value))
+    cursor.close()
+
+
+def _new_engine(url):
+    if is_memory(url):
+        # Every connection to an in-memory database gets a new database.
+        # Use a single connection, from any thread.
+        engine = create_engine(url, poolclass=StaticPool,
+                               connect_args={'check_same_thread': False})
+    elif make_url(url).drivername.startswith('sqlite'):
+        engine = create_engine(url, poolclass=QueuePool,
+                               pool_size=config.DB_POOL_SIZE,
+                               max_overflow=config.DB_MAX_OVERFLOW,
+                               connect_args={'check_same_thread': False,
+                                             'timeout': config.SQLITE_TIMEOUT})
+        event.listen(engine, 'connect', _set_pragmas)
+    else:
+        engine = create_engine(url,
+                               pool_size=config.DB_POOL_SIZE,
+                               max_overflow=config.DB_MAX_OVERFLOW,
+                               pool_pre_ping=True)
     Base.metadata.create_all(engine)
+    upgrade_schema(engine)
     Session = sessionmaker(bind=engine)
-    session = Session()
-    return session
+    metrics.instrument_session(Session)
+    profiling.instrument_session(Session)
+    return engine, Session, scoped_session(Session)
+
+
+def _registered(url):
+    if not isinstance(url, str):
+        raise ValueError('The database URL should be a string, not {}'.format(type(url)))
+    if is_memory(url):
+        # Not shared, as before: every call is a new database
+        return _new_engine(url)
+    with _engines_lock:
+        pid, shared = _engines.get(url, (None, None))
+        # Connections cannot be shared with forked processes
+        if pid != os.getpid():
+            shared = _new_engine(url)
+            _engines[url] = (os.getpid(), shared)
+        return shared
+
+
+def get_engine(url):
+    '''
+    Engine of a database URL, created (with the tables) the first time it
+    is used in a process, and shared afterwards.
+
+    SQLite files are used in WAL mode, with `config.SQLITE_PRAGMAS`, so
+    that they can be read while they are written. Server databases use a
+    pool of `config.DB_POOL_SIZE` connections. In-memory SQLite databases
+    are not shared: each call returns a new one.
+    '''
+    return _registered(url)[0]
+
+
+def make_session(url):
+    '''New session of the (shared) engine of a database URL'''
+    return _registered(url)[1]()
+
+
+def make_scoped_session(url):
+    '''
+    Thread-local sessions of a database URL (see sqlalchemy's
+    scoped_session). Call `remove` on it when a thread is done.
+    '''
+    return _registered(url)[2]
+
+
+def dispose_engines():
+    '''Close the connections of every shared engine, and forget them'''
+    with _engines_lock:
+        for pid, (engine, Session, scoped) in _engines.values():
+            if pid == os.getpid():
+                engine.dispose()
+        _engines.clear()
+
+
+def upgrade_schema(engine):
+    '''
+    Add the columns and indexes that are in the models but not in the
+    database (i.e. created by an older version). New columns are all
+    nullable.
+    '''
+    insp = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    for table in Base.metadata.sorted_tables:
+        existing = set(c['name'] for c in insp.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            engine.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(quote(table.name),
+                                                                    quote(column.name),
+                                                                    column.type.compile(engine.dialect)))
+        indexes = set(i['name'] for i in insp.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(engine)
+
+
+def upsert(session, table, rows, key='id'):
+    '''
+    Insert rows (dicts with the columns of a table), replacing the rows
+    with the same key. It uses the native upsert of the database:
+    ON CONFLICT in PostgreSQL, ON DUPLICATE KEY in MySQL and INSERT OR
+    REPLACE in SQLite. Other databases delete and insert the rows.
+    '''
+    if not rows:
+        return
+    table = getattr(table, '__table__', table)
+    columns = [c.name for c in table.columns]
+    rows = [dict((c, row.get(c)) for c in columns) for row in rows]
+    dialect = session.bind.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        stmt = insert(table)
+        stmt = stmt.on_conflict_do_update(index_elements=[key],
+                                          set_=dict((c, stmt.excluded[c]) for c in columns if c != key))
+    elif dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(table)
+        stmt = stmt.on_duplicate_key_update(**dict((c, stmt.inserted[c]) for c in columns if c != key))
+    elif dialect == 'sqlite':
+        stmt = table.insert().prefix_with('OR REPLACE')
+    else:
+        session.execute(table.delete().where(table.c[key].in_([row[key] for row in rows])))
+        stmt = table.insert()
+    session.execute(stmt, rows)
 
 
 def dict_to_str(args):
@@ -0,0 +1,269 @@
+'''
+Profiling of bitter commands (`bitter --profile cprofile|sample ...`).
+
+- cprofile: deterministic profile of every thread, saved as a pstats file
+  (open it with `python -m pstats` or snakeviz).
+- sample: samples the stack of every thread every few milliseconds, and
+  saves them in the speedscope format (https://www.speedscope.app).
+  It slows the program down much less than cProfile.
+
+While profiling is enabled, `span` blocks (e.g. around API calls, or
+database commits) are timed too, and a summary is printed at the end.
+When it is disabled, `span` returns a shared object that does nothing:
+
+    with profiling.span('dump_result'):
+        ...
+'''
+import os
+import sys
+import json
+import time
+import logging
+import cProfile
+import pstats
+import threading
+
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+ENABLED = False
+
+PROFILERS = ('cprofile', 'sample')
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Spans(object):
+    '''Number of calls, and total and maximum time of every span'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {}
+
+    def add(self, name, elapsed):
+        with self._lock:
+            calls, total, top = self.stats.get(name, (0, 0, 0))
+            self.stats[name] = (calls + 1, total + elapsed, max(top, elapsed))
+
+    def clear(self):
+        with self._lock:
+            self.stats = {}
+
+    def summary(self):
+        lines = ['{:<20} {:>10} {:>12} {:>10} {:>10}'.format('Span', 'Calls', 'Total (s)', 'Mean (ms)', 'Max (ms)')]
+        for name, (calls, total, top) in sorted(self.stats.items(), key=lambda x: -x[1][1]):
+            lines.append('{:<20} {:>10} {:>12.3f} {:>10.3f} {:>10.3f}'.format(
+                name, calls, total, 1000 * total / calls, 1000 * top))
+        return '\n'.join(lines)
+
+
+SPANS = Spans()
+
+
+class _Span(object):
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        SPANS.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def span(name):
+    '''Context manager that times a block, if profiling is enabled'''
+    if not ENABLED:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def instrument_session(session_class):
+    '''Time the commits of the sessions of a sessionmaker, if profiling is enabled'''
+    if not ENABLED:
+        return
+    from sqlalchemy import event
+
+    def before(session):
+        session.info['profile_commit'] = time.perf_counter()
+
+    def after(session):
+        start = session.info.pop('profile_commit', None)
+        if start is not None:
+            SPANS.add('commit', time.perf_counter() - start)
+
+    event.listen(session_class, 'before_commit', before)
+    event.listen(session_class, 'after_commit', after)
+
+
+class CProfiler(object):
+    '''cProfile for the current thread and every thread started after it'''
+
+    def __init__(self):
+        self.profiles = []
+        self._lock = threading.Lock()
+
+    def _new(self):
+        prof = cProfile.Profile()
+        with self._lock:
+            self.profiles.append(prof)
+        return prof
+
+    def _thread_hook(self, *args):
+        # Called once at the start of every thread. The profiler then
+        # replaces this hook for the thread.
+        self._new().enable()
+
+    def start(self):
+        threading.setprofile(self._thread_hook)
+        self._main = self._new()
+        self._main.enable()
+
+    def stop(self, path):
+        threading.setprofile(None)
+        self._main.disable()
+        stats = None
+        with self._lock:
+            for prof in self.profiles:
+                prof.snapshot_stats()
+                if not prof.stats:
+                    continue
+                if stats is None:
+                    stats = pstats.Stats(_Snapshot(prof.stats))
+                else:
+                    stats.add(_Snapshot(prof.stats))
+        if stats is not None:
+            stats.dump_stats(path)
+        return stats
+
+
+class _Snapshot(object):
+    '''What pstats.Stats expects of a profiler'''
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class Sampler(object):
+    '''
+    Takes the stack of every thread every `interval` seconds, in a
+    background thread.
+    '''
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.frames = {}
+        self.samples = {}
+        self.names = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _frame(self, code):
+        key = (code.co_name, code.co_filename, code.co_firstlineno)
+        if key not in self.frames:
+            self.frames[key] = len(self.frames)
+        return self.frames[key]
+
+    def _run(self):
+        me = threading.get_ident()
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            # Samples are weighted by the time since the last one, which may
+            # be longer than the interval if other threads hold the GIL
+            now = time.perf_counter()
+            elapsed, last = now - last, now
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._frame(frame.f_code))
+                    frame = frame.f_back
+                stack.reverse()
+                self.samples.setdefault(ident, Counter())[tuple(stack)] += elapsed
+                self.names[ident] = names.get(ident, str(ident))
+
+    def start(self):
+        self.started = time.time()
+        self._thread = threading.Thread(target=self._run, name='bitter-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self, path):
+        self._stop.set()
+        self._thread.join()
+        with open(path, 'w') as f:
+            json.dump(self.speedscope(time.time() - self.started), f)
+
+    def speedscope(self, duration):
+        frames = sorted(self.frames, key=self.frames.get)
+        profiles = []
+        for ident, times in sorted(self.samples.items(), key=lambda x: -sum(x[1].values())):
+            stacks = list(times)
+            profiles.append({
+                'type': 'sampled',
+                'name': self.names[ident],
+                'unit': 'seconds',
+                'startValue': 0,
+                'endValue': duration,
+                'samples': [list(s) for s in stacks],
+                'weights': [times[s] for s in stacks],
+            })
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'shared': {'frames': [{'name': name, 'file': filename, 'line': line}
+                                  for (name, filename, line) in frames]},
+            'profiles': profiles,
+            'name': 'bitter',
+            'exporter': 'bitter',
+        }
+
+
+_profiler = None
+
+
+def default_output(profiler):
+    return 'bitter.prof' if profiler == 'cprofile' else 'bitter.speedscope.json'
+
+
+def start(profiler='sample', interval=0.005):
+    '''Start profiling the process, and enable spans'''
+    global ENABLED, _profiler
+    if profiler not in PROFILERS:
+        raise ValueError('Unknown profiler: {}. Use one of: {}'.format(profiler, ', '.join(PROFILERS)))
+    SPANS.clear()
+    _profiler = CProfiler() if profiler == 'cprofile' else Sampler(interval)
+    ENABLED = True
+    _profiler.start()
+
+
+def stop(path, out=sys.stderr):
+    '''Stop profiling, save the profile to path and print a summary of the spans to out'''
+    global ENABLED, _profiler
+    if _profiler is None:
+        return
+    ENABLED = False
+    _profiler.stop(path)
+    _profiler = None
+    if out is not None:
+        if SPANS.stats:
+            print(SPANS.summary(), file=out)
+        print('Profile saved to {}'.format(os.path.abspath(path)), file=out)
@@ -0,0 +1,280 @@
+'''
+When and how long to wait before calling the API again after an error.
+
+Errors are classified as:
+
+- limited: the worker has used its quota (HTTP 420/429). REST calls are
+  retried right away, since the queue will pick a worker that is not
+  limited (or wait until one is). Streams back off.
+- server: the API failed (HTTP 500/502/503/504).
+- network: the API could not be reached (connection errors, timeouts...).
+
+Server and network errors are retried with exponential backoff and jitter,
+until the call has spent `max_elapsed` seconds (or `max_attempts` attempts)
+failing. They also count towards a circuit breaker for each endpoint: after
+`threshold` consecutive failures, no more calls to the endpoint are made for
+`reset_timeout` seconds. Then, a single trial call is let through. If it
+fails, the circuit stays open for twice as long (up to
+`max_reset_timeout`). Calls wait while the circuit is open, instead of
+hammering a failing API.
+
+Any other error is raised right away. E.g.:
+
+    policy = RetryPolicy()
+    retry = policy.start(['users', 'lookup'])
+    while True:
+        retry.wait()
+        try:
+            resp = call()
+        except Exception as ex:
+            if not retry.failure(ex):
+                raise
+        else:
+            retry.success()
+            return resp
+'''
+import time
+import random
+import logging
+import urllib.error
+import http.client
+
+from threading import Condition, Lock
+
+from twitter import TwitterHTTPError
+
+logger = logging.getLogger(__name__)
+
+LIMITED = 'limited'
+SERVER = 'server'
+NETWORK = 'network'
+
+LIMIT_CODES = (420, 429)
+SERVER_CODES = (500, 502, 503, 504)
+
+
+def classify(ex):
+    '''Kind of error (LIMITED, SERVER or NETWORK), or None if it should not be retried'''
+    if isinstance(ex, TwitterHTTPError):
+        if ex.e.code in LIMIT_CODES:
+            return LIMITED
+        if ex.e.code in SERVER_CODES:
+            return SERVER
+        return None
+    if isinstance(ex, (urllib.error.URLError, http.client.HTTPException, ConnectionError, TimeoutError)):
+        return NETWORK
+    return None
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    '''
+    Counts the consecutive failures of an endpoint, and tells callers how
+    long to wait before calling it (see the module documentation).
+    '''
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=5, reset_timeout=30, max_reset_timeout=10*60):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.timeout = reset_timeout
+        self.opened = 0
+        self._trial = None
+        self._cond = Condition()
+
+    def acquire(self):
+        '''
+        Seconds to wait before asking again, or 0 if a call can be made now.
+        When the circuit is half open, only one caller at a time gets a 0.
+        '''
+        with self._cond:
+            if self.state == self.CLOSED:
+                return 0
+            now = time.time()
+            if self.state == self.OPEN:
+                left = self.opened + self.timeout - now
+                if left > 0:
+                    return left
+                self.state = self.HALF_OPEN
+                logger.info('Circuit half open. Trying again')
+            # A trial that never reported back (e.g. it was interrupted) expires
+            if self._trial is not None and now - self._trial < self.timeout:
+                return self._trial + self.timeout - now
+            self._trial = now
+            return 0
+
+    def success(self):
+        with self._cond:
+            if self.state != self.CLOSED:
+                logger.info('Circuit closed')
+            self.state = self.CLOSED
+            self.failures = 0
+            self.timeout = self.reset_timeout
+            self._trial = None
+            self._cond.notify_all()
+
+    def failure(self):
+        with self._cond:
+            self.failures += 1
+            if self.state == self.HALF_OPEN:
+                self.timeout = min(self.timeout * 2, self.max_reset_timeout)
+                self._open()
+            elif self.state == self.CLOSED and self.failures >= self.threshold:
+                self._open()
+            self._trial = None
+            self._cond.notify_all()
+
+    def _open(self):
+        logger.warning('Circuit open after {} failures. Waiting {} seconds'.format(self.failures, self.timeout))
+        self.state = self.OPEN
+        self.opened = time.time()
+
+    def wait(self, timeout):
+        '''Wait up to timeout seconds, or until the state changes'''
+        with self._cond:
+            self._cond.wait(timeout)
+
+    def __repr__(self):
+        return '<CircuitBreaker {} ({} failures)>'.format(self.state, self.failures)
+
+
+class RetryPolicy(object):
+    '''
+    Retry settings, and the circuit breakers of every endpoint.
+
+    - server_delay/network_delay/limit_delay: initial backoff for each kind
+      of error, doubled after every failure up to `max_delay`. The wait is
+      picked at random between half and all of it, so that clients do not
+      retry at the same time.
+    - max_elapsed/max_attempts: budget for server and network errors of each
+      call (None for no limit). Limited calls are always retried.
+    - threshold/reset_timeout/max_reset_timeout: see CircuitBreaker.
+    '''
+
+    def __init__(self, server_delay=1, network_delay=1, limit_delay=0, max_delay=60,
+                 max_elapsed=15*60, max_attempts=None, jitter=True,
+                 threshold=5, reset_timeout=30, max_reset_timeout=10*60):
+        self.delays = {SERVER: server_delay, NETWORK: network_delay, LIMITED: limit_delay}
+        self.max_delay = max_delay
+        self.max_elapsed = max_elapsed
+        self.max_attempts = max_attempts
+        self.jitter = jitter
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.breakers = {}
+        self._lock = Lock()
+
+    @classmethod
+    def for_streams(cls, **kwargs):
+        '''Backoff recommended for the streaming API: longer, and also after 420/429'''
+        params = dict(server_delay=5, network_delay=0.25, limit_delay=60, max_delay=320, max_elapsed=None)
+        params.update(kwargs)
+        return cls(**params)
+
+    def delay(self, kind, attempt):
+        '''Seconds to wait after `attempt` (1 for the first one) failures of a kind'''
+        delay = min(self.max_delay, self.delays[kind] * 2 ** (attempt - 1))
+        if self.jitter:
+            delay = random.uniform(delay / 2, delay)
+        return delay
+
+    def breaker(self, uriparts):
+        key = uriparts if isinstance(uriparts, str) else '/'.join(u for u in uriparts if u)
+        with self._lock:
+            if key not in self.breakers:
+                self.breakers[key] = CircuitBreaker(self.threshold, self.reset_timeout, self.max_reset_timeout)
+            return self.breakers[key]
+
+    def start(self, uriparts, patient=True):
+        '''
+        State of a new call to an endpoint. If patient is False, errors are
+        not retried and calls to an open circuit fail right away.
+        '''
+        return Retry(self, self.breaker(uriparts), patient=patient)
+
+
+class Retry(object):
+    '''Attempts of a single call. See RetryPolicy.start.'''
+
+    def __init__(self, policy, breaker, patient=True):
+        self.policy = policy
+        self.breaker = breaker
+        self.patient = patient
+        self.attempts = {SERVER: 0, NETWORK: 0, LIMITED: 0}
+        self.since = None
+        self.resume = 0
+
+    def elapsed(self):
+        return time.time() - self.since if self.since else 0
+
+    def over_budget(self, wait=0):
+        policy = self.policy
+        if policy.max_attempts is not None and self.attempts[SERVER] + self.attempts[NETWORK] >= policy.max_attempts:
+            return True
+        return policy.max_elapsed is not None and self.elapsed() + wait > policy.max_elapsed
+
+    def next_wait(self):
+        '''
+        Seconds to wait before the next attempt, or 0 to make it now.
+        Raises CircuitOpen if the circuit will not close in time.
+        '''
+        now = time.time()
+        if self.resume > now:
+            return self.resume - now
+        wait = self.breaker.acquire()
+        if wait:
+            if self.since is None:
+                self.since = now
+            if not self.patient or self.over_budget(wait):
+                raise CircuitOpen('Too many errors. Circuit open for {:.0f} more seconds'.format(wait))
+        return wait
+
+    def wait(self):
+        '''Block until the next attempt can be made'''
+        while True:
+            wait = self.next_wait()
+            if not wait:
+                return
+            self.breaker.wait(wait)
+
+    def success(self):
+        self.breaker.success()
+        self.attempts = dict.fromkeys(self.attempts, 0)
+        self.since = None
+
+    def failure(self, ex):
+        '''Record an error. Returns True if the call should be tried again.'''
+        kind = classify(ex)
+        if kind is None:
+            if isinstance(ex, TwitterHTTPError):
+                # The API answered. It is up.
+                self.breaker.success()
+            return False
+        self.attempts[kind] += 1
+        if kind == LIMITED:
+            self.breaker.success()
+        else:
+            self.breaker.failure()
+            if self.since is None:
+                self.since = time.time()
+        if not self.patient:
+            return False
+        delay = self.policy.delay(kind, self.attempts[kind])
+        if kind != LIMITED and self.over_budget(delay):
+            logger.info('Giving up after {} attempts in {:.0f} seconds: {}'.format(
+                self.attempts[SERVER] + self.attempts[NETWORK], self.elapsed(), ex))
+            return False
+        if delay:
+            logger.info('{} error ({}). Retrying in {:.1f} seconds'.format(kind.capitalize(), ex, delay))
+        self.resume = time.time() + delay
+        return True
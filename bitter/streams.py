@@ -0,0 +1,567 @@
+'''
+Streams of tweets that follow more keywords, users or locations than a
+single connection to the streaming API allows.
+
+A filter connection can track up to 400 keywords, follow 5000 users and
+25 location boxes (TRACK_LIMIT, FOLLOW_LIMIT and LOCATIONS_LIMIT). The
+filter is split into as few connections as possible, and each of them is
+opened with a different credential of a StreamQueue, in its own thread.
+Connections that are dropped, or that fail with an error that the retry
+policy considers transient (see bitter.retry), are reopened, waiting longer
+if they keep dropping. Any other error stops every connection, and is
+raised to the reader. Their tweets are merged into a single stream, in which tweets
+that match the filters of several connections appear only once. E.g.:
+
+    wq = StreamQueue.from_config(conffile='~/.bitter.yaml')
+    with StreamMultiplexer(wq, track=keywords, follow=user_ids) as stream:
+        for tweet in stream:
+            ...
+
+StreamWriter stores a stream without slowing down the thread that reads
+it: tweets are added to a bounded buffer in memory, and a background
+thread encodes and writes them in batches. Files can be rotated by size
+or time, and compressed with gzip or zstd. Next to every file, an index
+(<file>.idx) keeps the byte offset at which the tweets written in each
+hour start. In compressed files, every hour starts a new gzip member (or
+zstd frame), so that they can be read from there (see read). E.g.:
+
+    with StreamWriter('tweets.jsonl', compression='gzip', rotate_interval=24*3600) as writer:
+        for tweet in stream:
+            writer.put(tweet)
+'''
+import io
+import os
+import json
+import sys
+import gzip
+import time
+import queue
+import logging
+import threading
+
+from collections import Counter, deque
+
+from . import metrics
+from .encoding import loads
+from .utils import put_until, get_until, Stopped
+from .crawlers import QueueException
+from .retry import classify, CircuitOpen
+
+logger = logging.getLogger(__name__)
+
+TRACK_LIMIT = 400
+FOLLOW_LIMIT = 5000
+LOCATIONS_LIMIT = 25
+
+
+def split_terms(terms):
+    '''List of terms from a comma-separated string or an iterable, without blanks or repetitions'''
+    if not terms:
+        return []
+    if isinstance(terms, str):
+        terms = terms.split(',')
+    terms = (str(t).strip() for t in terms)
+    return list(dict.fromkeys(t for t in terms if t))
+
+
+def split_locations(locations):
+    '''
+    List of bounding boxes (tuples of 4 coordinates, as strings) from a
+    comma-separated string of coordinates, or an iterable of boxes
+    '''
+    if not locations:
+        return []
+    if isinstance(locations, str):
+        coords = [c.strip() for c in locations.split(',')]
+    else:
+        coords = []
+        for box in locations:
+            coords.extend(str(c).strip() for c in (box.split(',') if isinstance(box, str) else box))
+    coords = [c for c in coords if c]
+    if len(coords) % 4:
+        raise ValueError('Locations should be boxes of 4 coordinates (sw longitude, sw latitude, '
+                         'ne longitude, ne latitude), got {} coordinates'.format(len(coords)))
+    return list(dict.fromkeys(tuple(coords[i:i + 4]) for i in range(0, len(coords), 4)))
+
+
+def partition(track=None, follow=None, locations=None,
+              track_limit=TRACK_LIMIT, follow_limit=FOLLOW_LIMIT, locations_limit=LOCATIONS_LIMIT):
+    '''
+    Split a filter into the parameters of as few connections to
+    statuses/filter as possible, within the limits of each connection.
+    '''
+    track = split_terms(track)
+    follow = split_terms(follow)
+    locations = split_locations(locations)
+    parts = max(-(-len(track) // track_limit),
+                -(-len(follow) // follow_limit),
+                -(-len(locations) // locations_limit))
+    filters = []
+    for i in range(parts):
+        params = {}
+        if track[i * track_limit:(i + 1) * track_limit]:
+            params['track'] = ','.join(track[i * track_limit:(i + 1) * track_limit])
+        if follow[i * follow_limit:(i + 1) * follow_limit]:
+            params['follow'] = ','.join(follow[i * follow_limit:(i + 1) * follow_limit])
+        boxes = locations[i * locations_limit:(i + 1) * locations_limit]
+        if boxes:
+            params['locations'] = ','.join(c for box in boxes for c in box)
+        filters.append(params)
+    return filters
+
+
+class RecentIds(object):
+    '''
+    Ids seen lately, to drop repeated tweets. It remembers at least the
+    last `size` ids (and up to twice as many).
+    '''
+
+    def __init__(self, size=100000):
+        self.size = size
+        self.current = set()
+        self.previous = set()
+
+    def seen(self, oid):
+        '''Whether an id was seen before. It is remembered from now on.'''
+        if oid in self.current or oid in self.previous:
+            return True
+        self.current.add(oid)
+        if len(self.current) >= self.size:
+            self.previous = self.current
+            self.current = set()
+        return False
+
+
+class StreamMultiplexer(object):
+    '''
+    Merged stream of the tweets of several filter connections (see the
+    module documentation).
+
+    - wq: a StreamQueue, with at least as many credentials as connections.
+    - track, follow, locations: the filter, as comma-separated strings or
+      lists.
+    - dedup: number of recent tweet ids remembered to drop duplicates.
+    - maxsize: tweets buffered before the connections wait for the reader.
+    - reconnect, max_reconnect: seconds to wait before reopening a dropped
+      connection, doubled (up to max_reconnect) while it keeps dropping.
+
+    A stopped multiplexer can be started again. Connections of the
+    previous run that do not close within the timeout of stop keep their
+    credentials until the next message arrives. The new ones wait for
+    them, unless wq does not wait (see StreamQueue.next).
+
+    Other keyword arguments are sent to every connection (e.g.
+    language='en').
+    '''
+
+    def __init__(self, wq, track=None, follow=None, locations=None, dedup=100000, maxsize=10000,
+                 reconnect=5, max_reconnect=320, endpoint='statuses/filter', **kwargs):
+        self.wq = wq
+        self.endpoint = endpoint
+        self.filters = partition(track=track, follow=follow, locations=locations)
+        if not self.filters:
+            raise ValueError('The filter is empty')
+        if len(self.filters) > len(wq.queue):
+            raise QueueException('The filter needs {} connections, but there are only {} '
+                                 'credentials'.format(len(self.filters), len(wq.queue)))
+        for params in self.filters:
+            params.update(kwargs)
+        self.recent = RecentIds(dedup)
+        self.reconnect = reconnect
+        self.max_reconnect = max_reconnect
+        self.stats = Counter()
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._stop = threading.Event()
+        self._error = None
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        if not self._stop.is_set() and any(t.is_alive() for t in self._threads):
+            raise RuntimeError('The multiplexer is already running')
+        # Threads of a previous run that did not stop in time are not
+        # tracked anymore (see stop)
+        self._threads = []
+        # Every run has its own event, so that the threads of a previous
+        # run that are still reading do not carry on
+        self._stop = threading.Event()
+        self._error = None
+        metrics.track_queue('stream', 'tweets', self._queue)
+        for (i, params) in enumerate(self.filters):
+            t = threading.Thread(target=self._listen, args=(i, params, self._stop),
+                                 name='bitter-stream-{}'.format(i), daemon=True)
+            t.start()
+            self._threads.append(t)
+        logger.info('Listening with {} connections'.format(len(self.filters)))
+
+    def _listen(self, i, params, stop):
+        delay = self.reconnect
+        while not stop.is_set():
+            connected = time.time()
+            stream = None
+            try:
+                stream = self.wq[self.endpoint](**params)
+                for msg in stream:
+                    if stop.is_set():
+                        return
+                    if not msg or msg.get('timeout'):
+                        continue
+                    if msg.get('hangup'):
+                        break
+                    if not put_until(self._queue, msg, stop):
+                        return
+            except QueueException as ex:
+                # No credential left
+                self._fail(i, ex, stop)
+                return
+            except Exception as ex:
+                if not isinstance(ex, CircuitOpen) and classify(ex) is None:
+                    self._fail(i, ex, stop)
+                    return
+                # Transient, even if the queue gave up retrying it
+                logger.warning('Connection {} failed: {}'.format(i, ex))
+                with self._lock:
+                    self.stats['errors'] += 1
+            finally:
+                # Give the credential back
+                if stream is not None:
+                    stream.close()
+            if time.time() - connected > 60:
+                delay = self.reconnect
+            with self._lock:
+                self.stats['reconnections'] += 1
+            logger.info('Connection {} was closed. Reconnecting in {} seconds'.format(i, delay))
+            stop.wait(delay)
+            delay = min(2 * delay, self.max_reconnect)
+
+    def _fail(self, i, ex, stop):
+        '''Stop every connection, and raise ex to the reader'''
+        logger.error('Connection {} failed: {}'.format(i, ex))
+        if not stop.is_set():
+            self._error = ex
+            stop.set()
+
+    def __iter__(self):
+        '''
+        Tweets (and other messages, such as limit notices) of every
+        connection, until the multiplexer is stopped. Errors of the
+        connections are raised here.
+        '''
+        if not self._threads:
+            self.start()
+        while True:
+            try:
+                msg = get_until(self._queue, self._stop)
+            except Stopped:
+                break
+            oid = msg.get('id')
+            if oid is not None and self.recent.seen(oid):
+                self.stats['duplicates'] += 1
+                continue
+            self.stats['tweets'] += 1
+            metrics.OBJECTS.labels('stream', 'collected').inc()
+            yield msg
+        if self._error is not None:
+            raise self._error
+
+    def stop(self, timeout=5):
+        '''
+        Stop the connections, and wait up to timeout seconds for them to
+        close. Threads reading from a stream only stop when the next
+        message (or keep-alive) arrives.
+        '''
+        self._stop.set()
+        metrics.untrack_queue('stream', 'tweets', self._queue)
+        deadline = time.time() + timeout
+        for t in self._threads:
+            t.join(max(0, deadline - time.time()))
+        alive = sum(1 for t in self._threads if t.is_alive())
+        if alive:
+            logger.warning('{} connections are still open. They will be closed '
+                           'when they get a message'.format(alive))
+        self._threads = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+        return False
+
+
+COMPRESSION = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+HOUR = 3600
+
+
+def _compressor(compression, raw):
+    '''
+    File-like object that compresses what is written to raw, as a new gzip
+    member or zstd frame. Closing it does not close raw.
+    '''
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6)
+    if compression == 'zstd':
+        return _zstd().ZstdCompressor(level=3).stream_writer(raw, closefd=False)
+    raise ValueError('Unknown compression: {}'.format(compression))
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception('zstd compression requires the zstandard package. '
+                        'Install it with: pip install bitter[zstd]')
+    return zstandard
+
+
+def compression_of(path):
+    '''Compression of a file, from its extension'''
+    for (compression, suffix) in COMPRESSION.items():
+        if suffix and path.endswith(suffix):
+            return compression
+    return None
+
+
+class StreamWriter(object):
+    '''
+    Writes tweets (or any JSON object) to files of JSON lines from a
+    background thread (see the module documentation).
+
+    - path: output file, or '-' for the standard output. When files are
+      rotated, the start time of every file is added to its name, e.g.
+      tweets-20180101-120000.jsonl.gz.
+    - compression: None, 'gzip' or 'zstd' (`pip install bitter[zstd]`).
+    - rotate_size: start a new file after this many bytes (of JSON, before
+      compression).
+    - rotate_interval: start a new file after this many seconds.
+    - index: write a sidecar index (<file>.idx) with the byte offset at
+      which the lines of every hour start.
+    - maxsize: tweets buffered in memory before put blocks (or, with drop,
+      before the oldest tweets are dropped).
+    - batch, flush_interval: tweets are written in batches of up to this
+      size, at least every flush_interval seconds.
+    '''
+
+    def __init__(self, path, compression=None, rotate_size=None, rotate_interval=None, index=True,
+                 maxsize=100000, batch=1000, flush_interval=1.0, drop=False):
+        if compression not in COMPRESSION:
+            raise ValueError('Unknown compression: {}'.format(compression))
+        if compression == 'zstd':
+            _zstd()
+        if path == '-' and (compression or rotate_size or rotate_interval):
+            raise ValueError('The standard output cannot be compressed or rotated')
+        self.path = path
+        self.compression = compression
+        self.rotate_size = rotate_size
+        self.rotate_interval = rotate_interval
+        self.index = index and path != '-'
+        self.maxsize = maxsize
+        self.batch = batch
+        self.flush_interval = flush_interval
+        self.drop = drop
+        self.files = []
+        self.stats = Counter()
+        self._buffer = deque()
+        self._changed = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+        self._error = None
+        self._raw = None
+        self._out = None
+        self._index = None
+
+    def qsize(self):
+        return len(self._buffer)
+
+    def put(self, obj):
+        '''
+        Add an object (or a line of JSON) to the buffer. If the buffer is
+        full, it waits for the writer, or drops the oldest object.
+        '''
+        with self._changed:
+            if self._error is not None:
+                raise self._error
+            while len(self._buffer) >= self.maxsize:
+                if self.drop:
+                    self._buffer.popleft()
+                    self.stats['dropped'] += 1
+                    break
+                self._changed.wait(self.flush_interval)
+                if self._error is not None:
+                    raise self._error
+            self._buffer.append(obj)
+            if len(self._buffer) >= self.batch:
+                self._changed.notify_all()
+
+    def start(self):
+        self._stop.clear()
+        metrics.track_queue('stream', 'writer', self)
+        self._thread = threading.Thread(target=self._run, name='bitter-stream-writer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''Write everything that is buffered, and close the file'''
+        self._stop.set()
+        with self._changed:
+            self._changed.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        metrics.untrack_queue('stream', 'writer', self)
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+        return False
+
+    def _run(self):
+        try:
+            while True:
+                with self._changed:
+                    if len(self._buffer) < self.batch and not self._stop.is_set():
+                        self._changed.wait(self.flush_interval)
+                    items = [self._buffer.popleft() for i in range(min(self.batch, len(self._buffer)))]
+                    self._changed.notify_all()
+                if items:
+                    self._write(items)
+                elif self._stop.is_set():
+                    break
+        except Exception as ex:
+            logger.exception('Could not write the stream')
+            with self._changed:
+                self._error = ex
+                self._changed.notify_all()
+        finally:
+            self._close()
+
+    def _write(self, items, now=None):
+        # Not encoding.dumps: the files should not depend on whether orjson is installed
+        data = ''.join((item if isinstance(item, str) else json.dumps(item)) + '\n'
+                       for item in items).encode('utf-8')
+        now = now or time.time()
+        if self._raw is None or self._should_rotate(now):
+            self._close()
+            self._open(now)
+        hour = int(now // HOUR) * HOUR
+        if hour != self._hour:
+            self._start_hour(hour)
+        self._out.write(data)
+        self._out.flush()
+        self._size += len(data)
+        self.stats['written'] += len(items)
+        self.stats['bytes'] += len(data)
+        metrics.OBJECTS.labels('stream', 'written').inc(len(items))
+
+    def _should_rotate(self, now):
+        if self.rotate_size and self._size >= self.rotate_size:
+            return True
+        return bool(self.rotate_interval and now - self._opened >= self.rotate_interval)
+
+    def filename(self, now):
+        '''Name of a new file started at a time'''
+        if self.rotate_size or self.rotate_interval:
+            root, ext = os.path.splitext(self.path)
+            if ext in COMPRESSION.values():
+                root, ext = os.path.splitext(root)
+            name = '{}-{}'.format(root, time.strftime('%Y%m%d-%H%M%S', time.gmtime(now)))
+            path = name + ext + COMPRESSION[self.compression]
+            n = 0
+            while os.path.exists(path) or path in self.files:
+                n += 1
+                path = '{}-{}{}{}'.format(name, n, ext, COMPRESSION[self.compression])
+            return path
+        if self.compression and not self.path.endswith(COMPRESSION[self.compression]):
+            return self.path + COMPRESSION[self.compression]
+        return self.path
+
+    def _open(self, now):
+        self._opened = now
+        self._size = 0
+        self._hour = None
+        if self.path == '-':
+            self._raw = self._out = sys.stdout.buffer
+            return
+        path = self.filename(now)
+        self._raw = open(path, 'ab')
+        self._out = self._raw
+        self.files.append(path)
+        self.stats['files'] += 1
+        if self.index:
+            self._index = open(path + '.idx', 'a')
+        logger.info('Writing the stream to {}'.format(path))
+
+    def _start_hour(self, hour):
+        '''
+        Start the lines of a new hour. Compressed files start a new gzip
+        member (or zstd frame), so that they can be read from that offset.
+        '''
+        self._hour = hour
+        if self.compression:
+            if self._out is not self._raw:
+                self._out.close()
+            self._raw.flush()
+            offset = self._raw.tell()
+            self._out = _compressor(self.compression, self._raw)
+        else:
+            offset = self._raw.tell()
+        if self._index is not None:
+            self._index.write(json.dumps({'hour': hour, 'offset': offset}) + '\n')
+            self._index.flush()
+
+    def _close(self):
+        if self._raw is None:
+            return
+        if self._out is not self._raw:
+            self._out.close()
+        if self._raw is sys.stdout.buffer:
+            self._raw.flush()
+        else:
+            self._raw.close()
+        if self._index is not None:
+            self._index.close()
+        self._raw = self._out = self._index = None
+
+
+def read_index(path):
+    '''Entries ({'hour', 'offset'}) of the index of a file written by StreamWriter'''
+    entries = []
+    if os.path.exists(path + '.idx'):
+        with open(path + '.idx') as f:
+            entries = [loads(line) for line in f if line.strip()]
+    return entries
+
+
+def read(path, since=None):
+    '''
+    Objects in a file written by StreamWriter. If since (a timestamp) is
+    given, the file is read from the start of the hour of since, according
+    to the index.
+    '''
+    offset = 0
+    if since is not None:
+        for entry in read_index(path):
+            if entry['hour'] > since:
+                break
+            offset = entry['offset']
+    compression = compression_of(path)
+    with open(path, 'rb') as raw:
+        raw.seek(offset)
+        if compression == 'gzip':
+            f = gzip.GzipFile(fileobj=raw, mode='rb')
+        elif compression == 'zstd':
+            f = io.BufferedReader(_zstd().ZstdDecompressor().stream_reader(raw, read_across_frames=True))
+        else:
+            f = raw
+        try:
+            for line in f:
+                if line.strip():
+                    yield loads(line)
+        except EOFError:
+            # The last member is still being written
+            pass
@@ -13,7 +13,6 @@ import sqlalchemy
 import os
 import multiprocessing
 from multiprocessing.pool import ThreadPool
-from multiprocessing import Queue
 
 import queue
 import threading
@@ -26,7 +25,7 @@ from functools import partial, reduce
 from tqdm import tqdm
 
 from itertools import islice, chain
-from contextlib import contextmanager
+from contextlib import contextmanager, closing
 
 from collections import Counter
 from random import choice
@@ -35,9 +34,17 @@ from builtins import map, filter
 
 from twitter import TwitterHTTPError
 
-from bitter.models import Following, User, ExtractorEntry, make_session
+from bitter.models import Following, User, ExtractorEntry, make_session, make_scoped_session, upsert
 
 from bitter import config
+from bitter import metrics
+from bitter import profiling
+from bitter.cache import get_cache
+from bitter.journal import Journal
+from bitter.encoding import EncodingPool
+from bitter.retry import classify
+from bitter.workqueue import WorkQueue
+from bitter.idset import IdSet
 
 # Fix Python 2.x.
 try:
@@ -67,12 +74,196 @@ def parallel(func, source, chunksize=1, numcpus=multiprocessing.cpu_count()):
             return func(*args, **kwargs)
         except Exception as ex:
             print('Exception on parallel thread: {}'.format(ex), file=sys.stderr)
+            return []
 
     results = p.imap_unordered(wrapped_func, source)
     for i in chain.from_iterable(results):
         yield i
 
 
+class Stopped(Exception):
+    '''A pipeline was stopped while waiting on one of its queues'''
+    pass
+
+
+def put_until(q, item, stop, interval=0.5):
+    '''
+    Put an item in a bounded queue, waiting for a free slot unless the
+    event stop is set. Returns False if it was.
+    '''
+    while stop is None or not stop.is_set():
+        try:
+            q.put(item, timeout=interval)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def get_until(q, stop, timeout=None, interval=0.5):
+    '''
+    Get an item from a queue, waiting up to timeout seconds (forever if
+    None) unless the event stop is set. Raises queue.Empty on timeout, and
+    Stopped if stop is set.
+    '''
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        wait = interval if deadline is None else max(0, min(interval, deadline - time.time()))
+        try:
+            return q.get(timeout=wait)
+        except queue.Empty:
+            if stop is not None and stop.is_set():
+                raise Stopped()
+            if deadline is not None and time.time() >= deadline:
+                raise
+
+
+def coalesce(q, size=100, timeout=1, sentinel=None, stop=None):
+    '''
+    Group the items of a queue in tuples of `size`, until sentinel is found
+    (or the event stop is set). If a batch is not full `timeout` seconds
+    after its first item arrived, it is yielded as it is.
+    '''
+    batch = []
+    deadline = None
+    while True:
+        try:
+            if batch:
+                item = get_until(q, stop, timeout=max(0, deadline - time.time()))
+            else:
+                item = get_until(q, stop)
+        except queue.Empty:
+            yield tuple(batch)
+            batch = []
+            continue
+        except Stopped:
+            return
+        if item is sentinel:
+            if batch:
+                yield tuple(batch)
+            return
+        if not batch:
+            deadline = time.time() + timeout
+        batch.append(item)
+        if len(batch) >= size:
+            yield tuple(batch)
+            batch = []
+
+
+def parallel_batches(func, batches, capacity=None, max_threads=64):
+    '''
+    Like parallel, for batches that are already grouped (e.g. with coalesce).
+
+    Batches are handed to a pool of threads as they arrive. Before every
+    batch, the pool grows (up to max_threads) to the value of `capacity()`
+    (e.g. how many credentials can be used for an endpoint), or to twice
+    the number of CPUs if capacity is not given.
+
+    At most one result per thread is kept waiting to be consumed, so
+    threads stop downloading when the consumer falls behind.
+    '''
+    tasks = queue.Queue(1)
+    results = queue.Queue(max_threads)
+    threads = []
+    stop = threading.Event()
+
+    def work():
+        while True:
+            try:
+                batch = get_until(tasks, stop)
+            except Stopped:
+                return
+            if batch is None:
+                put_until(results, None, stop)
+                return
+            try:
+                res = func(batch)
+            except Exception as ex:
+                print('Exception on parallel thread: {}'.format(ex), file=sys.stderr)
+                continue
+            if not put_until(results, res, stop):
+                return
+
+    def grow(size):
+        while len(threads) < min(max(size, 1), max_threads):
+            t = threading.Thread(target=work, daemon=True)
+            t.start()
+            threads.append(t)
+
+    errors = []
+
+    def feed():
+        try:
+            for batch in batches:
+                grow(capacity() if capacity else multiprocessing.cpu_count() * 2)
+                if not put_until(tasks, batch, stop):
+                    return
+        except Exception as ex:
+            # Raised to the consumer, once the threads are done
+            errors.append(ex)
+        finally:
+            grow(1)
+            for t in threads:
+                if not put_until(tasks, None, stop):
+                    return
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    finished = 0
+    try:
+        while True:
+            res = results.get()
+            if res is None:
+                # Threads are only told to stop once they have all been started
+                finished += 1
+                if finished == len(threads):
+                    break
+                continue
+            for i in res:
+                yield i
+        if errors:
+            raise errors[0]
+    finally:
+        stop.set()
+
+
+class QuotaCounter(object):
+    '''
+    Ids requested and found in batch calls to the API. Every call uses one
+    unit of quota, so the goal of batching is to maximize the ids found per
+    call (`efficiency`).
+    '''
+
+    def __init__(self, batchsize=100):
+        self.batchsize = batchsize
+        self.calls = 0
+        self.requested = 0
+        self.found = 0
+        self._lock = threading.Lock()
+
+    def add(self, requested, found):
+        with self._lock:
+            self.calls += 1
+            self.requested += requested
+            self.found += found
+
+    @property
+    def efficiency(self):
+        '''Ids found per call'''
+        return self.found / self.calls if self.calls else 0
+
+    @property
+    def fill(self):
+        '''Average size of the batches, as a fraction of the maximum'''
+        return self.requested / (self.calls * self.batchsize) if self.calls else 0
+
+    def __repr__(self):
+        return ('{} calls, {} ids requested, {} found '
+                '({:.1f} ids per call, batches {:.0%} full)').format(self.calls, self.requested, self.found,
+                                                                     self.efficiency, self.fill)
+
+
 def get_config_path(conf=None):
     if not conf:
         if config.CONFIG_FILE:
@@ -208,20 +399,21 @@ def get_users(wq, ulist, by_name=False, queue=None, max_users=100):
         userslice = ",".join(str(i) for i in islice(ilist, max_users))
         if not userslice:
             break
-        try:
-            if by_name:
-                resp = wq.users.lookup(screen_name=userslice)
-            else:
-                resp = wq.users.lookup(user_id=userslice)
-        except TwitterHTTPError as ex:
-            if ex.e.code in (404,):
-                resp = []
-            else:
-                raise
-        if not resp:
-            logger.debug('Empty response')
-        for user in resp:
-            user = trim_user(user)
+        with profiling.span('get_users'):
+            try:
+                if by_name:
+                    resp = wq.users.lookup(screen_name=userslice)
+                else:
+                    resp = wq.users.lookup(user_id=userslice)
+            except TwitterHTTPError as ex:
+                if ex.e.code in (404,):
+                    resp = []
+                else:
+                    raise
+            if not resp:
+                logger.debug('Empty response')
+            users = [trim_user(user) for user in resp]
+        for user in users:
             if queue:
                 queue.put(user)
             else:
@@ -241,13 +433,177 @@ def trim_user(user):
     return user
 
 
+def existing_users(session, ids, column=User.id, chunksize=500):
+    '''Ids (or values of another column, e.g. screen names) of a list that are in the users table'''
+    found = set()
+    for ids_chunk in chunk(ids, chunksize):
+        found.update(i for (i, ) in session.query(column).filter(column.in_(ids_chunk)))
+    return found
+
+
+def crawl_users(wq, ids, dburi, threads=20, batchsize=1000, filter_batch=1000, preload=False,
+                max_pending=10000, report=10):
+    '''
+    Download the users of a list of ids into a database, skipping the ones
+    that are already in it. It is a pipeline of threads, connected by
+    queues of up to `max_pending` items:
+
+    - a filter checks the ids against the database in batches of
+      `filter_batch` (or against every id in the database, loaded in
+      memory beforehand, if preload is True).
+    - `threads` consumers look the users up in the API.
+    - a single writer stores them in batches of `batchsize`, with the
+      native upsert of the database. Only this thread writes, so SQLite
+      databases are not locked by the others.
+
+    Progress is logged every `report` seconds. Returns a Counter with the
+    ids skipped and enqueued, and the users collected.
+    '''
+    stats = Counter()
+    statslock = threading.Lock()
+    stop = threading.Event()
+    errors = []
+    ids_queue = queue.Queue(max_pending)
+    users_queue = queue.Queue(max_pending)
+    metrics.track_queue('crawl_users', 'ids', ids_queue)
+    metrics.track_queue('crawl_users', 'users', users_queue)
+
+    def add(key, n=1):
+        with statslock:
+            stats[key] += n
+
+    def failed(ex):
+        logger.exception('Error crawling users')
+        errors.append(ex)
+        stop.set()
+
+    def fill():
+        session = make_session(dburi)
+        try:
+            known = None
+            if preload:
+                known = IdSet.from_query(session.query(User.id))
+                logger.info('Loaded {} user ids'.format(len(known)))
+            for batch in chunk(ids, filter_batch):
+                valid = []
+                for uid in batch:
+                    try:
+                        valid.append(int(uid))
+                    except ValueError:
+                        if str(uid).strip():
+                            logger.warning('Invalid user id: {}'.format(uid))
+                add('skipped', len(batch) - len(valid))
+                batch = valid
+                found = known.check(batch) if known is not None else existing_users(session, batch)
+                session.commit()
+                new = [i for i in batch if i not in found]
+                add('skipped', len(batch) - len(new))
+                for uid in new:
+                    if not put_until(ids_queue, uid, stop):
+                        return
+                add('enqueued', len(new))
+        except Exception as ex:
+            failed(ex)
+        finally:
+            session.close()
+            for i in range(threads):
+                put_until(ids_queue, None, stop)
+
+    def queued_ids():
+        while True:
+            try:
+                uid = get_until(ids_queue, stop)
+            except Stopped:
+                return
+            if uid is None:
+                return
+            yield uid
+
+    def consume():
+        try:
+            for user in get_users(wq, queued_ids()):
+                if not put_until(users_queue, user, stop):
+                    return
+                metrics.OBJECTS.labels('crawl_users', 'collected').inc()
+        except Exception as ex:
+            failed(ex)
+
+    def write():
+        session = make_session(dburi)
+        try:
+            for batch in coalesce(users_queue, size=batchsize, timeout=1, sentinel=None, stop=stop):
+                upsert(session, User, batch)
+                sync_followers_count(session, [u['id'] for u in batch])
+                session.commit()
+                add('collected', len(batch))
+                with statslock:
+                    stats['lastid'] = batch[-1]['id']
+        except Exception as ex:
+            failed(ex)
+        finally:
+            session.close()
+
+    filler = threading.Thread(target=fill, name='crawl-users-filter', daemon=True)
+    consumers = [threading.Thread(target=consume, name='crawl-users-{}'.format(i), daemon=True)
+                 for i in range(threads)]
+    writer = threading.Thread(target=write, name='crawl-users-writer', daemon=True)
+    for t in [filler, writer] + consumers:
+        t.start()
+
+    lastcollected = 0
+    try:
+        while True:
+            deadline = time.time() + report
+            for c in consumers:
+                c.join(max(0, deadline - time.time()))
+            if not any(c.is_alive() for c in consumers):
+                break
+            with statslock:
+                speed = (stats['collected'] - lastcollected) / float(report)
+                lastcollected = stats['collected']
+            logger.info('########\n'
+                        '   Collected: {}\n'
+                        '   Speed: ~ {:.0f} profiles/s\n'
+                        '   Skipped: {}\n'
+                        '   Enqueued: {}\n'
+                        '   Queue sizes: {} ids, {} users\n'
+                        '   Last ID: {}'.format(stats['collected'], speed, stats['skipped'],
+                                                stats['enqueued'], ids_queue.qsize(),
+                                                users_queue.qsize(), stats['lastid']))
+        put_until(users_queue, None, stop)
+        writer.join()
+        filler.join()
+    finally:
+        stop.set()
+        metrics.untrack_queue('crawl_users', 'ids', ids_queue)
+        metrics.untrack_queue('crawl_users', 'users', users_queue)
+    if errors:
+        raise errors[0]
+    del stats['lastid']
+    return stats
+
+
+def sync_followers_count(session, ids):
+    '''Copy the followers_count of these users to their extractor entries (see ExtractorEntry)'''
+    count = sqlalchemy.select([User.followers_count]).where(User.id == ExtractorEntry.user).as_scalar()
+    for ids_chunk in chunk(ids, 500):
+        session.query(ExtractorEntry).\
+                filter(ExtractorEntry.user.in_(ids_chunk)).\
+                update({ExtractorEntry.followers_count: count}, synchronize_session=False)
+
+
 def add_user(user, dburi=None, session=None, update=False):
+    '''
+    Add a user to the database, with a pending extractor entry.
+    Existing users are only replaced if update is True.
+    '''
     if not session:
-        session = make_session(dburi)
+        with closing(make_session(dburi)) as session:
+            return add_user(user, session=session, update=update)
 
     user = trim_user(user)
     olduser = session.query(User).filter(User.id == user['id'])
-    if olduser:
+    if olduser.count():
         if not update:
             return
         olduser.delete()
@@ -255,34 +611,81 @@ def add_user(user, dburi=None, session=None, update=False):
     for key, value in user.items():
         setattr(nuser, key, value)
     user = nuser
-    if update:
-        session.add(user)
-        logger.debug('Adding entry')
-        entry = session.query(ExtractorEntry).filter(ExtractorEntry.user==user.id).first()
-        if not entry:
-            entry = ExtractorEntry(user=user.id)
-            session.add(entry)
-        logger.debug(entry.pending)
-        entry.pending = True
-        entry.cursor = -1
-        session.commit()
-    session.close()
+    session.add(user)
+    logger.debug('Adding entry')
+    entry = session.query(ExtractorEntry).filter(ExtractorEntry.user==user.id).first()
+    if not entry:
+        entry = ExtractorEntry(user=user.id)
+        session.add(entry)
+    logger.debug(entry.pending)
+    entry.pending = True
+    entry.cursor = -1
+    entry.followers_count = user.followers_count
+    session.commit()
 
 
-def download_entry(wq, entry_id, dburi=None, recursive=False):
-    session = make_session(dburi)
-    if not session:
-        raise Exception("Provide dburi or session")
+def download_entry(wq, entry_id, dburi=None, recursive=False, edges=None):
+    # Every crawling thread reuses its own session
+    session = make_scoped_session(dburi)()
     logger.info("Downloading entry: %s (%s)" % (entry_id, type(entry_id)))
-    entry = session.query(ExtractorEntry).filter(ExtractorEntry.id==entry_id).first()
-    user = session.query(User).filter(User.id == entry.user).first()
-    download_user(wq, session, user, entry, recursive)
-    session.close()
+    try:
+        entry = session.query(ExtractorEntry).filter(ExtractorEntry.id==entry_id).first()
+        user = session.query(User).filter(User.id == entry.user).first()
+        crawl_user(wq, session, user, entry, recursive, edges=edges)
+    finally:
+        session.close()
+
 
-def crawl_user(wq, session, user, entry=None, recursive=False, max_followers=50000):
+def add_followers(session, uid, ids, now=None, chunksize=500, known=None):
+    '''
+    Store a page of followers of a user.
+
+    Existing edges (the ones in `known`, an IdSet of the followers already
+    stored, or else looked up with one IN query per chunk) get their
+    timestamp updated, and the new ones are added in bulk.
+    Returns the number of new followers.
+    '''
+    if now is None:
+        now = int(time.time())
+    new = 0
+    for ids_chunk in chunk(ids, chunksize):
+        if known is not None:
+            existing = known.check(ids_chunk)
+        else:
+            existing = session.query(Following.follower).\
+                               filter(Following.isfollowed == uid).\
+                               filter(Following.follower.in_(ids_chunk))
+            existing = set(i for (i, ) in existing)
+        if existing:
+            session.query(Following).\
+                    filter(Following.isfollowed == uid).\
+                    filter(Following.follower.in_(existing)).\
+                    update({Following.created_at_stamp: now}, synchronize_session=False)
+        missing = list(dict.fromkeys(i for i in ids_chunk if i not in existing))
+        session.bulk_insert_mappings(Following, [{'isfollowed': uid,
+                                                  'follower': i,
+                                                  'created_at_stamp': now} for i in missing])
+        if known is not None:
+            known.update(missing)
+        new += len(missing)
+    return new
+
+
+def crawl_user(wq, session, user, entry=None, recursive=False, max_followers=50000, edges=None):
+    '''
+    Download the followers of a user, and store them in the followers table
+    or, if given, in an EdgeStore.
+    '''
 
     total_followers = user.followers_count
 
+    if not entry:
+        entry = session.query(ExtractorEntry).filter(ExtractorEntry.user==user.id).first() or \
+                ExtractorEntry(user=user.id, followers_count=total_followers)
+
+    # The user may have been updated since the entry was created
+    entry.followers_count = total_followers
+
     if total_followers > max_followers:
         entry.pending = False
         logger.info("Too many followers for user: %s" % user.screen_name)
@@ -290,8 +693,6 @@ def crawl_user(wq, session, user, entry=None, recursive=False, max_followers=500
         session.commit()
         return
 
-    if not entry:
-        entry = session.query(ExtractorEntry).filter(ExtractorEntry.user==user.id).first() or ExtractorEntry(user=user.id)
     session.add(entry)
     session.commit()
 
@@ -303,23 +704,34 @@ def crawl_user(wq, session, user, entry=None, recursive=False, max_followers=500
     logger.info("#"*20)
     logger.info("Getting %s - %s" % (uid, name))
     logger.info("Cursor %s" % cursor)
-    logger.info("Using account: %s" % wq.name)
-
-    _fetched_followers = 0
 
-    def fetched_followers():
-        return session.query(Following).filter(Following.isfollowed==uid).count()
+    # Count once, and keep a running count of the new followers
+    if edges is not None:
+        if cursor < 0:
+            # Starting from scratch
+            edges.reset(uid)
+        # Drop the pages appended after the last committed cursor (and any
+        # partial write), or they would be stored twice
+        fetched_followers = entry.edges = edges.truncate(uid, entry.edges)
+    else:
+        # Load the followers already stored once, instead of querying them for every page
+        known = IdSet.from_query(session.query(Following.follower).filter(Following.isfollowed==uid))
+        fetched_followers = len(known)
 
-    attempts = 0
-    while cursor > 0 or fetched_followers() < total_followers:
+    while cursor > 0 or (cursor < 0 and fetched_followers < total_followers):
         try:
             resp = wq.followers.ids(user_id=uid, cursor=cursor)
         except TwitterHTTPError as ex:
-            attempts += 1
-            if ex.e.code in (401, ) or attempts > 3:
+            if classify(ex) is not None:
+                # The queue gave up retrying it (e.g. an outage). The entry
+                # stays pending, and the cursor is kept (see WorkQueue.run)
+                raise
+            if ex.e.code in (401, ):
                 logger.info('Not authorized for user: {}'.format(uid))
-                entry.errors = ex.message
-                break
+            else:
+                logger.info('Could not get followers of {}: {}'.format(uid, ex))
+            entry.errors = str(ex)
+            break
         if 'ids' not in resp:
             logger.info("Error with id %s %s" % (uid, resp))
             entry.pending = False
@@ -328,29 +740,22 @@ def crawl_user(wq, session, user, entry=None, recursive=False, max_followers=500
 
         logger.info("New followers: %s" % len(resp['ids']))
         if recursive:
-            newusers = get_users(wq, resp)
+            newusers = get_users(wq, resp['ids'])
             for newuser in newusers:
                 add_user(session=session, user=newuser)
 
         if 'ids' not in resp or not resp['ids']:
             logger.info('NO IDS in response')
             break
-        for i in resp['ids']:
-            existing_user = session.query(Following).\
-                            filter(Following.isfollowed == uid).\
-                            filter(Following.follower == i).first()
-            now = int(time.time())
-            if existing_user:
-                existing_user.created_at_stamp = now
-            else:
-                f = Following(isfollowed=uid,
-                              follower=i,
-                              created_at_stamp=now)
-                session.add(f)
+        if edges is not None:
+            fetched_followers += edges.append(uid, resp['ids'])
+            entry.edges = fetched_followers
+        else:
+            fetched_followers += add_followers(session, uid, resp['ids'], known=known)
 
-        logger.info("Fetched: %s/%s followers" % (fetched_followers(),
+        logger.info("Fetched: %s/%s followers" % (fetched_followers,
                                                   total_followers))
-        entry.cursor = resp["next_cursor"]
+        cursor = entry.cursor = resp["next_cursor"]
 
         session.add(entry)
         session.commit()
@@ -376,15 +781,23 @@ def classify_user(id_or_name, screen_names, user_ids):
         screen_names.append(id_or_name.split('@')[-1])
 
 
-def extract(wq, recursive=False, user=None, initfile=None, dburi=None, extractor_name=None):
+def extract(wq, recursive=False, user=None, initfile=None, dburi=None, extractor_name=None, edges=None,
+            distributed=False, worker=None, lease=300, threads=None):
+    '''
+    Crawl the followers of the pending users of a database, in `threads`
+    threads.
+
+    Entries are claimed with leases (see bitter.workqueue). If distributed
+    is True, several processes can crawl the same database at the same
+    time. Otherwise, the entries left leased by previous runs on this host
+    that are no longer running are claimed again right away.
+    '''
     signal.signal(signal.SIGINT, signal_handler)
 
     if not dburi:
         dburi = 'sqlite:///%s.db' % extractor_name
 
     session = make_session(dburi)
-    session.query(ExtractorEntry).update({ExtractorEntry.busy: False})
-    session.commit()
 
 
     if not (user or initfile):
@@ -401,14 +814,11 @@ def extract(wq, recursive=False, user=None, initfile=None, dburi=None, extractor
                     user = line.strip().split(',')[0]
                     classify_user(user, screen_names, user_ids)
 
-        def missing_user(ix, column=User.screen_name):
-            res = session.query(User).filter(column == ix).count() == 0
-            if res:
-                logger.info("Missing user %s. Count: %s" % (ix, res))
-            return res
-
-        screen_names = list(filter(missing_user, screen_names))
-        user_ids = list(filter(partial(missing_user, column=User.id_str), user_ids))
+        # One query per batch of users, instead of one per user
+        known = existing_users(session, screen_names, column=User.screen_name)
+        screen_names = [i for i in screen_names if i not in known]
+        known = existing_users(session, [int(i) for i in user_ids])
+        user_ids = [i for i in user_ids if int(i) not in known]
         nusers = []
         logger.info("Missing user ids: %s" % user_ids)
         logger.info("Missing screen names: %s" % screen_names)
@@ -423,38 +833,57 @@ def extract(wq, recursive=False, user=None, initfile=None, dburi=None, extractor
     total_users = session.query(sqlalchemy.func.count(User.id)).scalar()
     logger.info('Total users: {}'.format(total_users))
 
-    de = partial(download_entry, wq, dburi=dburi)
-    pending = pending_entries(dburi)
+    de = partial(download_entry, wq, dburi=dburi, edges=edges)
     session.close()
 
-    with tqdm(parallel(de, pending), desc='Downloading users', total=total_users) as tq:
-        for i in tq: 
-            tq.write('Got {}'.format(i))
-            logger.info("Got %s" % i)
+    with WorkQueue(dburi, worker=worker, lease=lease) as work:
+        if not distributed:
+            work.recover()
+        logger.info('Crawling as worker {}'.format(work.worker))
+        with tqdm(work.run(de, threads=threads or multiprocessing.cpu_count()),
+                  desc='Downloading users', total=total_users) as tq:
+            for i in tq:
+                tq.write('Got {}'.format(i))
+                logger.info("Got %s" % i)
 
 
+def pending_entries(dburi, worker=None, lease=300):
+    '''
+    Claim the pending entries of a database, and yield their ids (see
+    bitter.workqueue). The leases are released when the generator is
+    closed.
+    '''
+    with WorkQueue(dburi, worker=worker, lease=lease) as work:
+        for entry_id in work.entries():
+            yield entry_id
+    logger.info("No more pending entries")
+
+def parse_shard(shard):
+    '''
+    Parse a shard ("I/N", the I-th of N shards, counting from 0) into (I, N).
+    None and empty values are returned as None.
+    '''
+    if not shard:
+        return None
+    if isinstance(shard, tuple):
+        index, total = shard
+    else:
+        try:
+            index, total = (int(i) for i in shard.split('/'))
+        except ValueError:
+            raise ValueError('Invalid shard: {}. Use I/N, e.g. 0/4'.format(shard))
+    if not 0 <= index < total:
+        raise ValueError('Invalid shard: {}/{}. I must be between 0 and N-1'.format(index, total))
+    return index, total
+
+
+def in_shard(oid, shard):
+    '''Whether an id (or anything that can be converted to int) belongs to a shard'''
+    if shard is None:
+        return True
+    index, total = shard
+    return int(oid) % total == index
 
-def pending_entries(dburi):
-    session = make_session(dburi)
-    while True:
-        candidate, entry = session.query(User, ExtractorEntry).\
-                        filter(ExtractorEntry.user == User.id).\
-                        filter(ExtractorEntry.pending == True).\
-                        filter(ExtractorEntry.busy == False).\
-                        order_by(User.followers_count).first()
-        if candidate:
-            entry.busy = True
-            session.add(entry)
-            session.commit()
-            yield int(entry.id)
-            continue
-        if session.query(ExtractorEntry).\
-            filter(ExtractorEntry.busy == True).count() > 0:
-            time.sleep(1)
-            continue
-        logger.info("No more pending entries")
-        break
-    session.close()
 
 def get_tweet(c, tid):
     return c.statuses.show(id=tid)
@@ -475,24 +904,37 @@ def get_user(c, user):
     except ValueError:
         return c.users.lookup(screen_name=user)[0]
 
-def download_tweet(wq, tweetid, cache=True, folder="downloaded_tweets", update=False):
-    tweet = cached_id(tweetid, folder)
-    if update or not tweet:
-        tweet = get_tweet(wq, tweetid)
-    if cache and update:
-        if tweet:
-            js = json.dumps(tweet)
-            write_json(js, folder)
+def download_tweet(wq, tweetid, cache=True, folder="downloaded_tweets", update=False, cache_backend=None):
+    '''Get a tweet from the cache of a folder (see bitter.cache), or download it'''
+    store = get_cache(folder, cache_backend)
+    try:
+        tweet = None if update else store.get(tweetid)
+        if not tweet:
+            tweet = get_tweet(wq, tweetid)
+            if cache:
+                dump_result(tweetid, tweet, store)
+    finally:
+        # Close (and commit) the store, unless it was given by the caller
+        if store is not folder:
+            store.close()
     yield tweet
 
 
-def download_user(wq, userid, cache=True, folder="downloaded_users", update=False):
-    user = cached_id(userid, folder)
-    if update or not user:
-        user = get_user(wq, userid)
-    if cache and update:
-        if user:
-            write_json(user, folder, aliases=[user['screen_name'], ])
+def download_user(wq, userid, cache=True, folder="downloaded_users", update=False, cache_backend=None):
+    '''Get a user (by id or screen name) from the cache of a folder, or download it'''
+    store = get_cache(folder, cache_backend)
+    try:
+        user = None if update else store.get(userid)
+        if not user:
+            user = get_user(wq, userid)
+            if cache:
+                dump_result(user['id'] if user else userid, user, store)
+                if user:
+                    # The user can also be found by screen name
+                    store.alias(user['screen_name'], user['id'])
+    finally:
+        if store is not folder:
+            store.close()
     yield user
 
 
@@ -537,6 +979,9 @@ def tweet_download_batch(wq, batch):
     for tid, tweet in tweets.items():
         yield tid, tweet
 
+# Endpoint used by the batch method (see download_list)
+tweet_download_batch.uriparts = ('statuses', 'lookup')
+
 def user_download_batch(wq, batch):
     screen_names = []
     user_ids = []
@@ -574,59 +1019,123 @@ def user_download_batch(wq, batch):
     for name in set(screen_names) - set(found_names):
         yield (name, None)
 
+user_download_batch.uriparts = ('users', 'lookup')
 
-def dump_result(oid, obj, folder, ignore_fails=True):
-    if obj:
-        try:
-            write_json(obj, folder=folder, oid=oid)
-            failed = fail_file(oid, folder)
-            if os.path.exists(failed):
-                os.remove(failed)
-        except Exception as ex:
-            logger.error('%s: %s' % (oid, ex))
-            if not ignore_fails:
-                raise
-    else:
-        logger.info('Object not recovered: {}'.format(oid))
-        with open(fail_file(oid, folder), 'w') as f:
-            print('Object not found', file=f)
+
+def dump_result(oid, obj, folder, ignore_fails=True, data=None):
+    '''Store an object (or mark it as failed) in a cache (or the folder of a legacy cache)'''
+    store = get_cache(folder)
+    with profiling.span('dump_result'):
+        if obj:
+            try:
+                store.put(oid, obj, data=data)
+            except Exception as ex:
+                logger.error('%s: %s' % (oid, ex))
+                if not ignore_fails:
+                    raise
+        else:
+            logger.info('Object not recovered: {}'.format(oid))
+            store.fail(oid)
 
 
 def download_list(wq, lst, folder, update=False, retry_failed=False, ignore_fails=False, cache=True,
-                  batch_method=tweet_download_batch):
+                  batch_method=tweet_download_batch, cache_backend=None, emit_cached=True,
+                  check_size=1000, on_skip=None, processes=0, ordered=True,
+                  batchsize=100, batch_timeout=1, max_threads=64, counter=None, max_pending=10000):
+    '''
+    Download a list of ids, skipping the ones already in the cache.
+    `folder` can be a path (with a cache_backend, see bitter.cache) or a Cache.
+
+    Ids are checked against the cache in batches of `check_size`. Cached
+    objects are only loaded if emit_cached is True. Otherwise, they are
+    not yielded at all, and on_skip (if given) is called with their id, in
+    the thread that consumes the results.
+
+    If processes is not 0, downloaded objects are encoded (and written, for
+    the folder caches) in a pool of that many processes (None for one per
+    CPU). Results are then yielded in the order they were downloaded if
+    ordered is True, or as soon as they are stored otherwise. Objects are
+    pickled to the pool, which costs about as much as encoding them, so it
+    only pays off with the folder caches, whose writes also move to the
+    pool. What the caller does with the results (e.g. serialized) still
+    happens in this process.
+
+    Ids are sent to batch_method in batches of `batchsize`. A batch that is
+    not full is sent anyway if no new ids arrive in `batch_timeout` seconds.
+    Batches are downloaded in as many threads as workers in wq can call the
+    endpoint of the batch method (its `uriparts` attribute), up to
+    max_threads. Calls and ids found are added to counter (a QuotaCounter).
+
+    Every stage waits when the next one falls behind: at most max_pending
+    ids wait to be downloaded, and max_pending results to be stored and
+    yielded, so memory use does not depend on the length of lst.
+    '''
+    store = get_cache(folder, cache_backend)
+    if counter is None:
+        counter = QuotaCounter(batchsize)
+
+    capacity = None
+    uriparts = getattr(batch_method, 'uriparts', None)
+    if uriparts and hasattr(wq, 'capacity'):
+        capacity = partial(wq.capacity, uriparts)
 
-    done = Queue()
+    # Bounded thread queues. Threads wait while they are full, and give up
+    # when stop is set (i.e. the generator is closed).
+    done = queue.Queue(max_pending)
 
-    down = Queue()
+    down = queue.Queue(max_pending)
 
+    stop = threading.Event()
+
+    metrics.track_queue('download_list', 'down', down)
+    metrics.track_queue('download_list', 'done', done)
 
     def filter_list(lst, done, down):
         print('filtering')
-        for oid in lst:
-            cached = cached_id(oid, folder)
-            if (cached and not update):
-                done.put((oid, cached))
-            elif (id_failed(oid, folder) and not retry_failed):
-                done.put((oid, None))
-            else:
-                down.put(oid)
-        down.put(None)
-
-    def download_results(batch_method, down, done):
-        def gen():
-            while True:
-                r = down.get()
-                if r is None:
-                    down.close()
-                    down.join_thread()
+        for batch in chunk(lst, check_size):
+            cached, failed = store.check(batch)
+            for oid in batch:
+                if oid in cached and not update:
+                    if not emit_cached:
+                        # on_skip is called by the consumer (see results)
+                        if on_skip and not put_until(done, (oid, None, None), stop):
+                            return
+                        continue
+                    obj = store.get(oid)
+                    if obj:
+                        if not put_until(done, (oid, obj, False), stop):
+                            return
+                        continue
+                elif oid in failed and not retry_failed:
+                    if not put_until(done, (oid, None, False), stop):
+                        return
+                    continue
+                if not put_until(down, oid, stop):
                     return
-                yield r
+        put_until(down, None, stop)
 
-        for t in parallel(batch_method, gen(), 100):
-            done.put(t)
+    def download_results(batch_method, down, done):
+        batches = coalesce(down, batchsize, batch_timeout, stop=stop)
+        results = parallel_batches(batch_method, batches, capacity=capacity, max_threads=max_threads)
+        for oid, obj in results:
+            if not put_until(done, (oid, obj, True), stop):
+                results.close()
+                return
+
+    def batch(ids):
+        try:
+            res = list(batch_method(wq, ids))
+        except Exception as ex:
+            # Reported as failed, instead of dropped, so that nobody waits
+            # for them (e.g. the journal of download_file)
+            logger.error('Could not download a batch of {} ids: {}'.format(len(ids), ex))
+            res = [(oid, None) for oid in ids]
+        counter.add(len(ids), sum(1 for (_, obj) in res if obj))
+        return res
 
-    def batch(*args, **kwargs):
-        return batch_method(wq, *args, **kwargs)
+    pool = None
+    if processes != 0:
+        pool = EncodingPool(processes, store=store, ordered=ordered)
 
     tc = threading.Thread(target=filter_list, args=(lst, done, down), daemon=True)
     tc.start()
@@ -636,25 +1145,79 @@ def download_list(wq, lst, folder, update=False, retry_failed=False, ignore_fail
     def check_threads(ts, done):
         for t in ts:
             t.join()
-        done.put(None)
+        put_until(done, None, stop)
 
     wait = threading.Thread(target=check_threads, args=([tc, td], done), daemon=True)
     wait.start()
 
-    while True:
-        rec = done.get()
-
-        if rec is None:
-            done.close()
-            done.join_thread()
-            break
+    processed = dict((stage, metrics.OBJECTS.labels('download_list', stage))
+                     for stage in ('downloaded', 'cached', 'failed'))
+
+    def results():
+        while True:
+            rec = done.get()
+            if rec is None:
+                return
+            oid, obj, downloaded = rec
+            if downloaded is None:
+                on_skip(oid)
+                continue
+            processed['failed' if not obj else 'downloaded' if downloaded else 'cached'].inc()
+            yield rec
+
+    def stored():
+        for oid, obj, downloaded in results():
+            if downloaded and (cache or (not obj)):
+                dump_result(oid, obj, store, ignore_fails)
+            yield oid, obj
+
+    def stored_parallel(pool):
+        # Only the encoded objects travel back from the pool
+        pending = {}
+        # The pool reads tasks as fast as it can. Limit the objects in it.
+        slots = threading.Semaphore(max_pending)
+
+        def tasks():
+            for seq, (oid, obj, downloaded) in enumerate(results()):
+                while not slots.acquire(timeout=0.5):
+                    if stop.is_set():
+                        return
+                pending[seq] = (oid, obj, downloaded)
+                yield seq, oid, (obj if downloaded and cache else None)
+
+        for seq, data, error in pool.imap(tasks()):
+            oid, obj, downloaded = pending.pop(seq)
+            slots.release()
+            if error:
+                logger.error('%s: %s' % (oid, error))
+                if not ignore_fails:
+                    raise Exception('Could not store {}: {}'.format(oid, error))
+            elif data is not None:
+                dump_result(oid, obj, store, ignore_fails, data=data)
+            elif downloaded and not obj:
+                dump_result(oid, obj, store, ignore_fails)
+            yield oid, obj
 
-        oid, obj = rec
-        if cache or (not obj):
-            dump_result(oid, obj, folder, ignore_fails)
-        yield rec
+    try:
+        if pool:
+            for rec in stored_parallel(pool):
+                yield rec
+            pool.close()
+        else:
+            for rec in stored():
+                yield rec
 
-    wait.join()
+        wait.join()
+        logger.info('Downloaded: {}'.format(counter))
+    finally:
+        stop.set()
+        # Stop reading lst before the caller closes it (e.g. download_file)
+        tc.join(5)
+        if pool:
+            pool.terminate()
+        store.flush()
+        metrics.untrack_queue('download_list', 'down', down)
+        metrics.untrack_queue('download_list', 'done', done)
 
 
 def download_tweets_file(*args, **kwargs):
@@ -669,24 +1232,69 @@ def download_users_file(*args, **kwargs):
 
 def download_file(wq, csvfile, folder, column=0, delimiter=',', skip=0, cache=True,
                   quotechar='"', commentchar=None, batch_method=tweet_download_batch,
-                  **kwargs):
-    with open(csvfile) as f:
-        if commentchar:
-            f = (line for line in f if not line.startswith('#'))
+                  cache_backend=None, journal=None, restart=False, **kwargs):
+    '''
+    Download the ids in a column of a CSV file (see download_list).
 
-        csvreader = csv.reader(f, delimiter=str(delimiter), quotechar=str(quotechar))
-        for n in range(skip):
-            next(csvreader)
+    If a journal (a Journal or the path to one) is given, progress is saved
+    to it, and the download resumes from the last checkpoint of the same
+    file and folder, unless restart is True.
+    '''
+    store = get_cache(folder, cache_backend)
+    job = None
+    offset = 0
+    if journal is not None:
+        if not isinstance(journal, Journal):
+            journal = Journal(journal)
+        job = journal.job(csvfile, getattr(store, 'folder', folder), restart=restart)
+        job.flush = store.flush
+        offset = job.offset
+
+    with open(csvfile, 'rb') as f:
+        f.seek(offset)
+        # End of the last line read by the CSV reader
+        position = [offset]
+
+        def lines():
+            for line in f:
+                position[0] += len(line)
+                line = line.decode('utf-8')
+                if commentchar and line.startswith(commentchar):
+                    continue
+                yield line
+
+        csvreader = csv.reader(lines(), delimiter=str(delimiter), quotechar=str(quotechar))
+        if not offset:
+            for n in range(skip):
+                next(csvreader)
 
         def reader(r):
             for row in csvreader:
                 if len(row) > column:
-                    yield row[column].strip()
+                    oid = row[column].strip()
+                    if job:
+                        job.issue(oid, position[0])
+                    yield oid
 
+        on_skip = None
+        if job:
+            on_skip = lambda oid: job.complete(oid, True)
 
-        for res in download_list(wq, reader(csvreader), folder, batch_method=batch_method, cache=cache,
-                                 **kwargs):
-            yield res
+        finished = False
+        try:
+            for res in download_list(wq, reader(csvreader), store, batch_method=batch_method, cache=cache,
+                                     on_skip=on_skip, **kwargs):
+                if job:
+                    job.complete(res[0], bool(res[1]))
+                yield res
+            finished = True
+        finally:
+            if job:
+                if finished:
+                    job.finish(position[0])
+                else:
+                    # Interrupted. Save the last checkpoint
+                    job.commit()
 
 
 def download_timeline(wq, user):
@@ -740,13 +1348,13 @@ def _tweets_control(func, apiargs, remaining=0, **kwargs):
     ''' Return a list of entries, the remaining '''
     
     resp = func(**apiargs)
-    if not resp:
-        return None, True
     # Update the arguments for the next call
     # Two options: either resp is a list, or a dict like:
     #    {'statuses': ... 'search_metadata': ...}
     if isinstance(resp, dict) and 'search_metadata' in resp:
         resp = resp['statuses']
+    if not resp:
+        return None, True
     max_id = min(s['id'] for s in resp) - 1
     apiargs['max_id'] = max_id
     return resp, False
@@ -788,6 +1396,7 @@ def serialized(it, outfile, outformat='csv', fields=[], header=None, ignore_miss
                 writer.writerow(values)
         elif outformat == 'jsonlines':
             for obj in it:
+                # Not encoding.dumps: the output should not depend on whether orjson is installed
                 print(json.dumps(obj, sort_keys=True), file=out)
         elif outformat == 'indented':
             for obj in it:
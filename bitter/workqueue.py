@@ -0,0 +1,396 @@
+'''
+Extractor entries shared by several processes, possibly on different
+machines, that crawl the same database.
+
+Every worker claims a batch of pending entries (the ones of users with
+fewest followers first), which are leased to it for `lease` seconds.
+Claims use an index on (pending, followers_count, lease_expires), so they
+do not scan the table. While the worker is alive, a background thread
+renews the leases of the entries it holds. When it is done with an entry,
+the lease is cleared. If a worker dies, its leases expire and the entries are claimed by
+someone else. A worker that waits for entries leased by others wakes up
+when they are released by its own threads, or when the first lease
+expires.
+
+On PostgreSQL and MySQL, entries are claimed with
+`SELECT ... FOR UPDATE SKIP LOCKED`, so that workers do not block each
+other. SQLite has no row locks: claims are serialized with a lock file next
+to the database instead, which only works for processes on the same
+machine.
+
+Leases are compared with the clock of each worker, which should be kept in
+sync (e.g. with NTP) across machines. E.g.:
+
+    with WorkQueue('postgresql://...') as work:
+        for entry_id in work.entries():
+            download_entry(wq, entry_id, dburi='postgresql://...')
+            work.done(entry_id)
+'''
+import os
+import time
+import queue
+import socket
+import logging
+import threading
+
+from contextlib import contextmanager
+
+from sqlalchemy import or_, func, select
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from twitter import TwitterHTTPError
+
+from bitter.models import ExtractorEntry, User, make_session
+from bitter.retry import classify
+
+logger = logging.getLogger(__name__)
+
+SKIP_LOCKED_DIALECTS = ('postgresql', 'mysql')
+
+
+def _alive(worker):
+    '''Whether a worker named hostname:pid (see default_worker) of this host is still running'''
+    try:
+        pid = int(worker.rsplit(':', 1)[1])
+    except (IndexError, ValueError):
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # e.g. owned by another user
+        pass
+    return True
+
+
+def default_worker():
+    '''hostname:pid'''
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class WorkQueue(object):
+    '''
+    Claims pending extractor entries for a worker (see the module
+    documentation).
+
+    - worker: name of the worker. It defaults to hostname:pid (see
+      default_worker).
+    - lease: seconds an entry is held without a renewal.
+    - batchsize: entries claimed at a time.
+    '''
+
+    def __init__(self, dburi, worker=None, lease=300, batchsize=10):
+        self.dburi = dburi
+        self.worker = worker or default_worker()
+        self.lease = lease
+        self.batchsize = batchsize
+        self.held = set()
+        # Entries that failed with a transient error, left for another run
+        self.skipped = set()
+        self.session = make_session(dburi)
+        self.dialect = self.session.bind.dialect.name
+        self.skip_locked = self.dialect in SKIP_LOCKED_DIALECTS
+        self.lockfile = None
+        if self.dialect == 'sqlite' and fcntl is not None:
+            database = self.session.bind.url.database
+            if database and database != ':memory:':
+                self.lockfile = database + '.lock'
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        # Incremented every time entries are given back, so that waiters
+        # do not miss a change made after they last looked
+        self._version = 0
+        self._stop = threading.Event()
+        self._heartbeat = None
+        self.backfill()
+
+    def backfill(self):
+        '''Copy the followers_count of the users to the entries that lack it'''
+        with self._lock:
+            count = select([User.followers_count]).where(User.id == ExtractorEntry.user).as_scalar()
+            updated = self.session.query(ExtractorEntry).\
+                                   filter(ExtractorEntry.followers_count == None).\
+                                   update({ExtractorEntry.followers_count: count},
+                                          synchronize_session=False)
+            self.session.commit()
+        if updated:
+            logger.debug('Copied the followers count of {} users'.format(updated))
+
+    def _pending(self):
+        # Entries without a followers count have no user, and cannot be crawled
+        q = self.session.query(ExtractorEntry).\
+                    filter(ExtractorEntry.pending == True).\
+                    filter(ExtractorEntry.followers_count != None)
+        if self.skipped:
+            q = q.filter(~ExtractorEntry.id.in_(self.skipped))
+        return q
+
+    @contextmanager
+    def _claiming(self):
+        with self._lock:
+            if self.lockfile is None:
+                yield
+                return
+            with open(self.lockfile, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def claim_query(self, n, now):
+        '''Query for the ids of the next n entries that can be claimed'''
+        q = self._pending().\
+                    with_entities(ExtractorEntry.id).\
+                    filter(or_(ExtractorEntry.lease_expires == None,
+                               ExtractorEntry.lease_expires < now)).\
+                    order_by(ExtractorEntry.followers_count).\
+                    limit(n)
+        if self.skip_locked:
+            q = q.with_for_update(skip_locked=True, of=ExtractorEntry)
+        return q
+
+    def claim(self, n=None):
+        '''Lease up to n (or batchsize) pending entries. Returns their ids.'''
+        n = n or self.batchsize
+        now = time.time()
+        with self._claiming():
+            try:
+                ids = [i for (i, ) in self.claim_query(n, now)]
+                if ids:
+                    self.session.query(ExtractorEntry).\
+                            filter(ExtractorEntry.id.in_(ids)).\
+                            update({ExtractorEntry.lease_owner: self.worker,
+                                    ExtractorEntry.lease_expires: now + self.lease,
+                                    ExtractorEntry.busy: True},
+                                   synchronize_session=False)
+                self.session.commit()
+            except Exception:
+                self.session.rollback()
+                raise
+            self.held.update(ids)
+        if ids:
+            logger.debug('{} claimed {} entries'.format(self.worker, len(ids)))
+        return ids
+
+    def _owned(self, ids):
+        return self.session.query(ExtractorEntry).\
+                    filter(ExtractorEntry.id.in_(ids)).\
+                    filter(ExtractorEntry.lease_owner == self.worker)
+
+    def renew(self):
+        '''Extend the leases of the entries held. Returns how many were renewed.'''
+        with self._lock:
+            ids = list(self.held)
+            if not ids:
+                return 0
+            owned = set(i for (i, ) in self._owned(ids).with_entities(ExtractorEntry.id))
+            if owned:
+                self._owned(owned).update({ExtractorEntry.lease_expires: time.time() + self.lease},
+                                          synchronize_session=False)
+            self.session.commit()
+            lost = self.held - owned
+            if lost:
+                logger.warning('{} lost the lease of {} entries'.format(self.worker, len(lost)))
+                self.held -= lost
+            return len(owned)
+
+    def done(self, entry_id, error=None):
+        '''Release an entry that has been crawled (or failed with error)'''
+        values = {ExtractorEntry.lease_owner: None,
+                  ExtractorEntry.lease_expires: None,
+                  ExtractorEntry.busy: False,
+                  ExtractorEntry.pending: False}
+        if error is not None:
+            values[ExtractorEntry.errors] = error
+        with self._lock:
+            self._owned([entry_id]).update(values, synchronize_session=False)
+            self.session.commit()
+            self.held.discard(entry_id)
+            self._notify()
+
+    def skip(self, entry_id, error=None):
+        '''
+        Give back an entry that failed with a transient error. It stays
+        pending, so it is crawled again by other workers or in the next
+        run, but not by this worker.
+        '''
+        values = {ExtractorEntry.lease_owner: None,
+                  ExtractorEntry.lease_expires: None,
+                  ExtractorEntry.busy: False}
+        if error is not None:
+            values[ExtractorEntry.errors] = error
+        with self._lock:
+            self._owned([entry_id]).update(values, synchronize_session=False)
+            self.session.commit()
+            self.held.discard(entry_id)
+            self.skipped.add(entry_id)
+            self._notify()
+
+    def release(self, ids=None):
+        '''Give back entries (all the ones held by default), so they can be claimed again'''
+        with self._lock:
+            ids = list(self.held if ids is None else ids)
+            if ids:
+                self._owned(ids).update({ExtractorEntry.lease_owner: None,
+                                         ExtractorEntry.lease_expires: None,
+                                         ExtractorEntry.busy: False},
+                                        synchronize_session=False)
+                self.session.commit()
+            self.held -= set(ids)
+            self._notify()
+
+    def recover(self):
+        '''
+        Release the entries leased by previous runs on this host that are
+        no longer running (e.g. interrupted), instead of waiting for the
+        leases to expire. Runs are told apart by the pid in the name of
+        their worker (see default_worker), so the leases of the ones that
+        are still alive are kept.
+        '''
+        host = socket.gethostname()
+        with self._lock:
+            owners = self.session.query(ExtractorEntry.lease_owner).\
+                                  filter(ExtractorEntry.lease_owner.like(host + ':%')).\
+                                  distinct()
+            dead = [o for (o, ) in owners if o != self.worker and o.rsplit(':', 1)[0] == host and not _alive(o)]
+            released = 0
+            if dead:
+                released = self.session.query(ExtractorEntry).\
+                                        filter(ExtractorEntry.lease_owner.in_(dead)).\
+                                        update({ExtractorEntry.lease_owner: None,
+                                                ExtractorEntry.lease_expires: None,
+                                                ExtractorEntry.busy: False},
+                                               synchronize_session=False)
+            self.session.commit()
+        if released:
+            logger.info('Released {} entries from previous runs: {}'.format(released, ', '.join(dead)))
+        return released
+
+    def pending(self):
+        '''Number of entries left, including the ones leased'''
+        with self._lock:
+            count = self._pending().count()
+            self.session.commit()
+            return count
+
+    def next_expiry(self):
+        '''When the first lease of a pending entry expires, or None'''
+        with self._lock:
+            expires = self._pending().with_entities(func.min(ExtractorEntry.lease_expires)).scalar()
+            self.session.commit()
+            return expires
+
+    def _notify(self):
+        with self._changed:
+            self._version += 1
+            self._changed.notify_all()
+
+    def _wait(self, poll, version):
+        with self._changed:
+            if self._stop.is_set() or self._version != version:
+                return
+            timeout = poll
+            expires = self.next_expiry()
+            if expires is not None:
+                timeout = min(timeout, max(0, expires - time.time()))
+            self._changed.wait(timeout)
+
+    def entries(self, poll=None):
+        '''
+        Claim entries and yield their ids, until there are no pending entries
+        left. While the rest are leased, it waits until an entry is
+        released by another thread or the first lease expires. Entries
+        leased by other processes are also checked every `poll` seconds (a
+        tenth of the lease by default), in case they are done.
+        '''
+        poll = poll or self.lease / 10.0
+        while not self._stop.is_set():
+            version = self._version
+            ids = self.claim()
+            if not ids:
+                if not self.pending():
+                    return
+                self._wait(poll, version)
+                continue
+            try:
+                for entry_id in ids:
+                    yield entry_id
+            finally:
+                # The entries that have not been processed are given back
+                self.release([i for i in ids if i in self.held])
+
+    def start(self):
+        '''Renew the leases every third of the lease time, in a background thread'''
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._beat, name='bitter-lease', daemon=True)
+        self._heartbeat.start()
+
+    def _beat(self):
+        while not self._stop.wait(self.lease / 3.0):
+            try:
+                self.renew()
+            except Exception as ex:
+                logger.warning('Could not renew leases: {}'.format(ex))
+
+    def stop(self):
+        self._stop.set()
+        self._notify()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        self.release()
+        self.session.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+        return False
+
+    def run(self, func, threads=4):
+        '''
+        Call func(entry_id) for every entry in `threads` threads, and yield
+        the ids processed. API errors that cannot be retried mark the entry
+        as done, with the error. Any other exception (e.g. an outage of the
+        API or of the database) leaves it pending (see skip).
+        '''
+        results = queue.Queue()
+
+        def crawl():
+            try:
+                for entry_id in self.entries():
+                    try:
+                        func(entry_id)
+                    except Exception as ex:
+                        logger.exception('Error crawling entry {}'.format(entry_id))
+                        if isinstance(ex, TwitterHTTPError) and classify(ex) is None:
+                            self.done(entry_id, error=str(ex))
+                        else:
+                            self.skip(entry_id, error=str(ex))
+                    else:
+                        self.done(entry_id)
+                    results.put(entry_id)
+            finally:
+                results.put(None)
+
+        workers = [threading.Thread(target=crawl, name='bitter-crawl-{}'.format(i), daemon=True)
+                   for i in range(threads)]
+        for t in workers:
+            t.start()
+        running = threads
+        while running:
+            entry_id = results.get()
+            if entry_id is None:
+                running -= 1
+                continue
+            yield entry_id
+        for t in workers:
+            t.join()
@@ -30,7 +30,13 @@ setup(
     install_requires=install_reqs,
     tests_require=test_reqs,
     extras_require = {
-        'server': ['flask', 'flask-oauthlib']
+        'server': ['flask', 'flask-oauthlib'],
+        'async': ['aiohttp'],
+        'lmdb': ['lmdb'],
+        'fast': ['orjson', 'numpy'],
+        'metrics': ['prometheus_client'],
+        'analysis': ['numpy', 'scipy'],
+        'zstd': ['zstandard'],
         },
     setup_requires=['pytest-runner',],
     include_package_data=True,
@@ -0,0 +1,60 @@
+from unittest import TestCase
+
+import time
+import asyncio
+
+import pytest
+
+pytest.importorskip('aiohttp')
+
+from twitter import TwitterHTTPError
+
+from bitter.fakeapi import FakeAPI
+from bitter.aiocrawlers import AsyncTwitterQueue
+
+
+class TestAsyncCrawlers(TestCase):
+
+    def setUp(self):
+        self.api = FakeAPI(latency=0.1).start()
+
+    def tearDown(self):
+        self.api.stop()
+
+    def run_queue(self, wq, coro):
+        async def wrapped():
+            async with wq:
+                return await coro
+        return asyncio.get_event_loop().run_until_complete(wrapped())
+
+    def test_lookup(self):
+        wq = AsyncTwitterQueue.from_config(config=self.api.config(workers=2))
+        resp = self.run_queue(wq, wq.users.lookup(user_id='1,2,3'))
+        assert sorted(u['id'] for u in resp) == [1, 2, 3]
+        assert int(resp.headers['X-Rate-Limit-Remaining']) < self.api.limit
+
+    def test_concurrent(self):
+        '''Several requests per credential should be in flight at the same time'''
+        wq = AsyncTwitterQueue.from_config(config=self.api.config(workers=2),
+                                           max_in_flight=10)
+        calls = [wq.statuses.lookup(_id=str(i), map=True) for i in range(20)]
+        tic = time.time()
+        resp = self.run_queue(wq, asyncio.gather(*calls))
+        toc = time.time()
+        assert len(resp) == 20
+        assert (toc - tic) < 20 * self.api.latency / 2
+
+    def test_limits(self):
+        self.api.limit = 3
+        self.api.window = 1
+        wq = AsyncTwitterQueue.from_config(config=self.api.config(workers=1))
+        calls = [wq.users.lookup(user_id=str(i)) for i in range(1, 6)]
+        resp = self.run_queue(wq, asyncio.gather(*calls))
+        assert [r[0]['id'] for r in resp] == [1, 2, 3, 4, 5]
+
+    def test_error(self):
+        self.api.missing = 1
+        wq = AsyncTwitterQueue.from_config(config=self.api.config(workers=1))
+        with pytest.raises(TwitterHTTPError) as ex:
+            self.run_queue(wq, wq.users.lookup(user_id='1'))
+        assert ex.value.e.code == 404
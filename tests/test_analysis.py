@@ -0,0 +1,112 @@
+from unittest import TestCase, skipIf
+
+import shutil
+import tempfile
+
+from bitter import analysis, utils
+from bitter.edges import EdgeStore
+from bitter.models import make_session, Following, NodeStats, FollowerOverlap
+
+
+# A triangle of users that follow each other (1, 2, 3), users 4 and 5
+# follow 1 and 2, and 6 follows 4.
+EDGES = [(1, 2), (2, 1), (2, 3), (3, 2), (1, 3), (3, 1),
+         (4, 1), (4, 2), (5, 1), (5, 2), (6, 4)]
+
+
+@skipIf(analysis.numpy is None or analysis.sparse is None, 'NumPy and SciPy are not installed')
+class TestAnalysis(TestCase):
+
+    def setUp(self):
+        self.session = make_session('sqlite:///:memory:')
+        for followed in set(t for (s, t) in EDGES):
+            utils.add_followers(self.session, followed, [s for (s, t) in EDGES if t == followed], now=1000)
+        # 4 follows 6 (and 6 follows 4 again) later. The self-loop and the
+        # duplicated edge are ignored.
+        utils.add_followers(self.session, 6, [6, 4], now=2000)
+        utils.add_followers(self.session, 4, [6], now=2000)
+        self.session.add(Following(isfollowed=1, follower=4, created_at_stamp=1000))
+        self.session.commit()
+
+    def load(self, **kwargs):
+        return analysis.Graph.load(lambda: analysis.edge_chunks(session=self.session, chunksize=3, **kwargs))
+
+    def test_load(self):
+        graph = self.load()
+        assert list(graph.nodes) == [1, 2, 3, 4, 5, 6]
+        assert graph.edges == len(EDGES) + 1
+        dense = graph.matrix.toarray()
+        assert dense[3, 0] and not dense[0, 3]
+        assert dense[3, 5] and dense[5, 3]
+        assert not dense[5, 5]
+
+    def test_since(self):
+        graph = self.load(since=1500)
+        assert list(graph.nodes) == [4, 6]
+        assert graph.edges == 2
+
+    def test_degrees(self):
+        graph = self.load()
+        in_degree, out_degree = analysis.degrees(graph)
+        assert list(in_degree) == [4, 4, 2, 1, 0, 1]
+        assert list(out_degree) == [2, 2, 2, 3, 2, 1]
+        bins = analysis.distribution(in_degree)
+        assert [b['count'] for b in bins] == [1, 2, 1, 2]
+
+    def test_reciprocity(self):
+        graph = self.load()
+        # The triangle, and 4 <-> 6
+        assert analysis.reciprocity(graph) == 8 / 12.0
+
+    def test_core(self):
+        graph = self.load()
+        core = analysis.core_number(graph)
+        assert list(core) == [4, 4, 4, 2, 2, 2]
+
+    def test_pagerank(self):
+        graph = self.load()
+        rank = analysis.pagerank(graph, tol=1e-10)
+        assert abs(rank.sum() - 1) < 1e-9
+        assert rank[0] == max(rank)
+        assert abs(rank[0] - rank[1]) < 1e-9
+        assert rank[4] == min(rank)
+
+    def test_overlaps(self):
+        graph = self.load()
+        pairs = analysis.overlaps(graph, top=3)
+        # 1 and 2 have 5 followers between them, and 4 and 5 follow both
+        assert pairs[0] == (1, 2, 3, 3 / 5.0)
+        assert (1, 3, 1, 1 / 5.0) in pairs
+        assert len(pairs) == 3
+
+    def test_save(self):
+        graph = self.load()
+        summary = analysis.analyze(graph, session=self.session, top=2)
+        assert summary['nodes'] == 6 and summary['edges'] == 12
+        assert summary['max_core'] == 4
+        assert summary['pagerank'][0][0] in (1, 2)
+        assert self.session.query(NodeStats).count() == 6
+        one = self.session.query(NodeStats).get(1)
+        assert (one.in_degree, one.out_degree, one.core) == (4, 2, 4)
+        assert self.session.query(FollowerOverlap).count() == 1
+        # Results are replaced
+        analysis.analyze(graph, session=self.session, top=2)
+        assert self.session.query(NodeStats).count() == 6
+
+    def test_edge_store(self):
+        folder = tempfile.mkdtemp()
+        try:
+            store = EdgeStore(folder)
+            for followed in set(t for (s, t) in EDGES):
+                store.append(followed, [s for (s, t) in EDGES if t == followed])
+            graph = analysis.Graph.load(lambda: analysis.edge_chunks(store=store, chunksize=4))
+            assert list(graph.nodes) == [1, 2, 3, 4, 5, 6]
+            assert graph.edges == len(EDGES)
+            assert list(analysis.core_number(graph)) == [4, 4, 4, 2, 2, 1]
+        finally:
+            shutil.rmtree(folder)
+
+    def test_empty(self):
+        graph = analysis.Graph.load(lambda: iter([]))
+        summary = analysis.analyze(graph)
+        assert summary['nodes'] == 0 and summary['edges'] == 0
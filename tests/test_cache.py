@@ -0,0 +1,166 @@
+from unittest import TestCase, skipIf
+
+import os
+import shutil
+import tempfile
+import threading
+
+from bitter import cache, utils
+
+try:
+    import lmdb
+except ImportError:
+    lmdb = None
+
+
+class CacheMixin(object):
+    backend = None
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = cache.get_cache(self.folder, self.backend)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.folder)
+
+    def test_put(self):
+        assert self.cache.get('1') is None
+        self.cache.put('1', {'id': 1})
+        self.cache.put(2, {'id': 2}, aliases=['two'])
+        assert self.cache.get('1') == {'id': 1}
+        assert self.cache.get('2') == {'id': 2}
+        assert self.cache.get('two') == {'id': 2}
+        assert '1' in self.cache
+        assert '3' not in self.cache
+        self.cache.flush()
+        assert sorted(self.cache.items()) == [('1', {'id': 1}), ('2', {'id': 2})]
+        assert list(self.cache.aliases()) == [('two', '2')]
+
+    def test_failed(self):
+        assert not self.cache.failed('1')
+        self.cache.fail('1')
+        assert self.cache.failed('1')
+        assert self.cache.get('1') is None
+        assert list(self.cache.failures()) == ['1']
+        self.cache.put('1', {'id': 1})
+        assert not self.cache.failed('1')
+        assert list(self.cache.failures()) == []
+
+    def test_check(self):
+        self.cache.put(1, {'id': 1}, aliases=['one'])
+        self.cache.fail(2)
+        assert self.cache.check(['1', '2', '3', 'one']) == (set(['1', 'one']), set(['2']))
+        # Changes after the first check
+        self.cache.put(3, {'id': 3})
+        self.cache.put(2, {'id': 2})
+        self.cache.fail(4)
+        assert self.cache.check(['1', '2', '3', '4']) == (set(['1', '2', '3']), set(['4']))
+
+    def test_migrate(self):
+        for i in range(50):
+            self.cache.put(i, {'id': i})
+        self.cache.alias('one', '1')
+        self.cache.fail('100')
+        for backend in ('folder', 'sharded', 'sqlite'):
+            target = os.path.join(self.folder, 'migrated-' + backend)
+            with cache.get_cache(target, backend) as dst:
+                assert cache.migrate(self.cache, dst) == 50
+                assert dst.get('49') == {'id': 49}
+                assert dst.get('one') == {'id': 1}
+                assert dst.failed('100')
+
+
+class TestFolderCache(CacheMixin, TestCase):
+    backend = 'folder'
+
+    def test_legacy(self):
+        '''The folder backend uses the same files as the old functions'''
+        utils.write_json({'id': 1}, self.folder, aliases=['one'])
+        assert self.cache.get('one') == {'id': 1}
+        self.cache.put(2, {'id': 2})
+        assert utils.cached_id(2, self.folder) == {'id': 2}
+        self.cache.fail(3)
+        assert utils.id_failed(3, self.folder)
+
+
+class TestShardedCache(CacheMixin, TestCase):
+    backend = 'sharded'
+
+    def test_layout(self):
+        self.cache.put(1, {'id': 1})
+        path = self.cache.path(1)
+        assert os.path.isfile(path)
+        assert os.path.relpath(path, self.folder).count(os.sep) == 2
+
+
+class TestSQLiteCache(CacheMixin, TestCase):
+    backend = 'sqlite'
+
+    def test_batches(self):
+        self.cache.batchsize = 10
+        for i in range(25):
+            self.cache.put(i, {'id': i})
+        assert self.cache._pending == 5
+        other = cache.get_cache(self.folder, 'sqlite')
+        assert other.get('19') == {'id': 19}
+        assert other.get('24') is None
+        self.cache.close()
+        assert other.get('24') == {'id': 24}
+        other.close()
+        self.cache = other
+
+
+@skipIf(lmdb is None, 'lmdb is not installed')
+class TestLMDBCache(CacheMixin, TestCase):
+    backend = 'lmdb'
+
+
+class TestDownloadList(TestCase):
+
+    def test_cache_backend(self):
+        from bitter.fakeapi import FakeAPI
+        from bitter.crawlers import TwitterQueue
+        folder = tempfile.mkdtemp()
+        try:
+            with FakeAPI(missing=0.1) as api:
+                wq = TwitterQueue.from_config(config=api.config(1), limits_cache='')
+                ids = list(str(i) for i in range(1, 201))
+                res = dict(utils.download_list(wq, ids, folder, cache_backend='sqlite'))
+                assert len(res) == 200
+                assert api.calls['statuses/lookup'] == 2
+                with cache.get_cache(folder, 'sqlite') as store:
+                    assert store.get('1') == res['1']
+                    assert store.failed('100')
+                res = dict(utils.download_list(wq, ids, folder, cache_backend='sqlite'))
+                assert len(res) == 200
+                assert api.calls['statuses/lookup'] == 2
+        finally:
+            shutil.rmtree(folder)
+
+    def test_emit_cached(self):
+        from bitter.fakeapi import FakeAPI
+        from bitter.crawlers import TwitterQueue
+        folder = tempfile.mkdtemp()
+        try:
+            store = cache.get_cache(folder)
+            for i in range(1, 101):
+                store.put(i, {'id': i, 'cached': True})
+            with FakeAPI() as api:
+                wq = TwitterQueue.from_config(config=api.config(1), limits_cache='')
+                ids = list(str(i) for i in range(1, 151))
+                skipped = []
+                on_skip = lambda oid: skipped.append((oid, threading.current_thread()))
+                res = dict(utils.download_list(wq, ids, folder, emit_cached=False, check_size=7,
+                                               on_skip=on_skip))
+                assert sorted(res, key=int) == ids[100:]
+                # Skipped ids are handled in the thread that reads the results
+                assert [oid for (oid, t) in skipped] == ids[:100]
+                assert all(t is threading.current_thread() for (oid, t) in skipped)
+                assert api.calls['statuses/lookup'] == 1
+                res = dict(utils.download_list(wq, ids, folder, check_size=7))
+                assert len(res) == 150
+                assert res['1'] == {'id': 1, 'cached': True}
+                assert api.calls['statuses/lookup'] == 1
+        finally:
+            shutil.rmtree(folder)
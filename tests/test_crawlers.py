@@ -1,6 +1,9 @@
 from unittest import TestCase
 
+import gc
 import os
+import shutil
+import tempfile
 import types
 import datetime
 import time
@@ -74,3 +77,134 @@ class TestCrawlers(TestCase):
         l2 = w1.get_limit(['friends', 'list'])
         assert self.wq.get_wait(['friends', 'list']) > (l2['reset']-time.time())
         assert self.wq.get_wait(['friends', 'list']) < (l2['reset']-time.time()+2)
+
+
+class TestFakeCrawlers(TestCase):
+
+    def setUp(self):
+        from bitter.fakeapi import FakeAPI
+        from bitter.crawlers import TwitterQueue
+        self.api = FakeAPI().start()
+        self.wq = TwitterQueue.from_config(config=self.api.config(workers=2))
+
+    def tearDown(self):
+        self.api.stop()
+
+    def test_call(self):
+        resp = self.wq.users.lookup(user_id='1,2')
+        assert sorted(u['id'] for u in resp) == [1, 2]
+
+    def test_retry_server_errors(self):
+        self.api.fail(503, times=2, endpoint='users/lookup')
+        resp = self.wq.users.lookup(user_id='1')
+        assert resp[0]['id'] == 1
+        assert self.api.calls['users/lookup'] == 3
+
+    def test_circuit_breaker(self):
+        from bitter.crawlers import TwitterQueue
+        from bitter.retry import RetryPolicy, CircuitOpen
+        policy = RetryPolicy(server_delay=0.01, threshold=3, reset_timeout=60, max_elapsed=1)
+        wq = TwitterQueue.from_config(config=self.api.config(workers=2), limits_cache='', retry=policy)
+        self.api.fail(500, times=10, endpoint='users/lookup')
+        failed = False
+        try:
+            wq.users.lookup(user_id='1')
+        except CircuitOpen:
+            failed = True
+        assert failed
+        # Calls stop once the circuit is open
+        assert self.api.calls['users/lookup'] == 3
+
+    def test_limits_from_headers(self):
+        self.wq.users.lookup(user_id='1')
+        remaining = min(w.get_limit(['users', 'lookup']).get('remaining', self.api.limit)
+                        for w in self.wq.queue)
+        assert remaining == self.api.limit - 1
+
+    def test_bootstrap(self):
+        self.wq._bootstrap.join()
+        for w in self.wq.queue:
+            assert w.get_limit(['statuses', 'lookup'])['remaining'] == self.api.limit
+
+    def test_limits_cache(self):
+        from bitter.crawlers import TwitterQueue
+        from bitter import crawlers
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        cache = os.path.join(folder, 'limits.json')
+        wq = TwitterQueue.from_config(config=self.api.config(workers=2), limits_cache=cache)
+        assert wq in crawlers._limits_queues
+        wq._bootstrap.join()
+        wq.users.lookup(user_id='1')
+        wq.save_limits()
+        calls = self.api.calls['application/rate_limit_status']
+        wq2 = TwitterQueue.from_config(config=self.api.config(workers=2), limits_cache=cache)
+        assert wq2._bootstrap is None
+        assert self.api.calls['application/rate_limit_status'] == calls
+        remaining = min(w.get_limit(['users', 'lookup'])['remaining'] for w in wq2.queue)
+        assert remaining == self.api.limit - 1
+        # Queues are not kept alive to save their limits at exit
+        del wq
+        gc.collect()
+        assert len([q for q in crawlers._limits_queues if q.limits_cache == cache]) == 1
+
+
+class TestScheduler(TestCase):
+
+    def setUp(self):
+        from bitter.crawlers import RestWorker, WorkerScheduler, RateLimitTable
+        self.scheduler = WorkerScheduler()
+        self.workers = []
+        for i in range(3):
+            w = RestWorker('worker{}'.format(i), {})
+            w._limits = RateLimitTable()
+            w.update_limits(['users', 'lookup'], remaining=10*i, reset=time.time()+100, limit=100)
+            self.workers.append(w)
+            self.scheduler.add(w)
+
+    def test_most_remaining_first(self):
+        first = self.scheduler.next(['users', 'lookup'])
+        second = self.scheduler.next(['users', 'lookup'])
+        assert first == self.workers[2]
+        assert second == self.workers[1]
+        failed = False
+        try:
+            self.scheduler.next(['users', 'lookup'])
+        except QueueException:
+            failed = True
+        assert failed
+        assert self.scheduler.get_wait(['users', 'lookup']) > 90
+
+    def test_busy(self):
+        workers = [self.scheduler.next(['statuses', 'lookup']) for i in range(3)]
+        assert self.scheduler.get_wait(['statuses', 'lookup']) is None
+        assert self.scheduler.get_wait(['users', 'lookup']) is None
+        self.scheduler.release(self.workers[1], ['statuses', 'lookup'])
+        assert self.scheduler.next(['users', 'lookup']) == self.workers[1]
+
+
+class TestRateLimitTable(TestCase):
+
+    def setUp(self):
+        from bitter.crawlers import RateLimitTable
+        self.table = RateLimitTable({'resources': {
+            'users': {'/users/lookup': {'limit': 900, 'remaining': 900, 'reset': 1},
+                      '/users/show/:id': {'limit': 900, 'remaining': 800, 'reset': 1}},
+        }})
+
+    def test_exact(self):
+        assert self.table.find(['users', 'lookup'])['remaining'] == 900
+        assert self.table.find('/users/lookup/')['remaining'] == 900
+        assert self.table.find(['users', 'missing']) is None
+
+    def test_template(self):
+        assert self.table.find(['users', 'show'])['remaining'] == 800
+        assert self.table.find(['users', 'show', '1234'])['remaining'] == 800
+        self.table.set(['users', 'show', '1234'], remaining=10)
+        assert self.table.find(['users', 'show'])['remaining'] == 10
+        assert len(self.table) == 2
+
+    def test_new_template(self):
+        assert self.table.find(['users', 'new', 'a']) is None
+        self.table.set('/users/new/:id', remaining=5)
+        assert self.table.find(['users', 'new', 'a']) == {'remaining': 5}
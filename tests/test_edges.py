@@ -0,0 +1,48 @@
+from unittest import TestCase
+
+import shutil
+import tempfile
+
+from bitter.edges import EdgeStore
+
+
+class TestEdges(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.store = EdgeStore(self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_append(self):
+        big = 2**62 + 5
+        assert self.store.append(1, [10, 11]) == 2
+        self.store.append(1, [big])
+        self.store.append(2, [10])
+        assert list(self.store.followers(1)) == [10, 11, big]
+        assert self.store.count(1) == 3
+        assert len(self.store) == 4
+        assert sorted(self.store.edges(chunksize=2)) == [(10, 1), (10, 2), (11, 1), (big, 1)]
+
+    def test_reset(self):
+        self.store.append(1, range(100))
+        self.store.reset(1)
+        assert self.store.count(1) == 0
+        assert len(self.store.followers(1)) == 0
+        assert list(self.store.users()) == []
+
+    def test_partial(self):
+        self.store.append(1, [10, 11, 12])
+        # An interrupted write
+        with open(self.store.path(1), 'ab') as f:
+            f.write(b'\x01\x02\x03')
+        assert list(self.store.followers(1)) == [10, 11, 12]
+        assert [list(d) for d in self.store.iter_followers(1, chunksize=2)] == [[10, 11], [12]]
+        assert self.store.count(1) == 3
+        assert self.store.truncate(1, 5) == 3
+        self.store.append(1, [13])
+        assert list(self.store.followers(1)) == [10, 11, 12, 13]
+        assert self.store.truncate(1, 2) == 2
+        assert list(self.store.followers(1)) == [10, 11]
+        assert self.store.truncate(2) == 0
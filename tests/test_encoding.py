@@ -0,0 +1,68 @@
+from unittest import TestCase
+
+import json
+import shutil
+import tempfile
+
+from bitter import encoding, cache, utils
+
+
+class TestEncoding(TestCase):
+
+    def test_dumps(self):
+        obj = {'b': 1, 'a': [1, 2, {'c': 'dñ'}]}
+        assert json.loads(encoding.dumps(obj)) == obj
+        assert encoding.loads(encoding.dumps(obj)) == obj
+        assert encoding.dumps(obj, sort_keys=True).index('"a"') < encoding.dumps(obj, sort_keys=True).index('"b"')
+        assert encoding.dumps(obj, indent=4) == json.dumps(obj, indent=4)
+
+    def test_bigint(self):
+        '''Objects that orjson cannot encode use the standard library'''
+        obj = {'id': 2**70}
+        assert encoding.loads(encoding.dumps(obj)) == obj
+
+
+class TestEncodingPool(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def run_pool(self, backend, ordered=True):
+        store = cache.get_cache(self.folder, backend)
+        tasks = list((i, str(i), {'id': i}) for i in range(200))
+        tasks.append((200, '200', None))
+        with encoding.EncodingPool(2, store=store, ordered=ordered, chunksize=7) as pool:
+            results = list(pool.imap(iter(tasks)))
+            pool.close()
+        return store, results
+
+    def test_folder(self):
+        store, results = self.run_pool('folder')
+        assert list(r[0] for r in results) == list(range(201))
+        assert all(data is None and error is None for (_, data, error) in results)
+        assert store.get('199') == {'id': 199}
+
+    def test_sqlite(self):
+        '''Objects are only encoded, since the cache cannot be written from other processes'''
+        store, results = self.run_pool('sqlite', ordered=False)
+        assert sorted(r[0] for r in results) == list(range(201))
+        for seq, data, error in results:
+            if seq < 200:
+                assert json.loads(data) == {'id': seq}
+        store.close()
+
+    def test_download_list(self):
+        from bitter.fakeapi import FakeAPI
+        from bitter.crawlers import TwitterQueue
+        with FakeAPI(missing=0.1) as api:
+            wq = TwitterQueue.from_config(config=api.config(1), limits_cache='')
+            ids = list(str(i) for i in range(1, 301))
+            for backend in ('folder', 'sqlite'):
+                with cache.get_cache(self.folder + '/' + backend, backend) as store:
+                    res = dict(utils.download_list(wq, ids, store, processes=2))
+                    assert len(res) == 300
+                    assert store.get('11') == res['11']
+                    assert store.failed('100')
@@ -0,0 +1,68 @@
+from unittest import TestCase
+
+import io
+import csv
+import json
+
+from bitter import export, utils
+from bitter.models import make_session, User
+
+
+class TestExport(TestCase):
+
+    def setUp(self):
+        self.session = make_session('sqlite:///:memory:')
+        utils.add_followers(self.session, 1, [10, 11, 12], now=1000)
+        utils.add_followers(self.session, 2, [10], now=2000)
+        self.session.add(User(id=1, screen_name='one', created_at_stamp='1000', entities='{"a": 1}'))
+        self.session.add(User(id=2, screen_name='two', created_at_stamp='2000', entities='{}'))
+        self.session.commit()
+
+    def edges(self, fmt, **kwargs):
+        out = io.StringIO()
+        export.write_edges(export.iter_edges(self.session, chunksize=2, **kwargs), out, fmt=fmt)
+        return out.getvalue()
+
+    def test_parse_since(self):
+        assert export.parse_since(None) is None
+        assert export.parse_since('1500') == 1500
+        assert export.parse_since('2018-01-01') == export.parse_since('2018-01-01T00:00:00')
+        with self.assertRaises(ValueError):
+            export.parse_since('yesterday')
+
+    def test_text(self):
+        lines = self.edges('text').splitlines()
+        assert sorted(lines) == ['10 -> 1', '10 -> 2', '11 -> 1', '12 -> 1']
+
+    def test_since(self):
+        assert self.edges('edgelist', since=1500) == '10 2\n'
+
+    def test_csv(self):
+        rows = list(csv.reader(io.StringIO(self.edges('csv'))))
+        assert rows[0] == ['source_id', 'target_id']
+        assert len(rows) == 5
+
+    def test_json(self):
+        edges = json.loads(self.edges('json'))
+        assert len(edges) == 4
+        assert {'source_id': 10, 'target_id': 2, 'following': True} in edges
+        lines = self.edges('jsonlines').splitlines()
+        assert sorted(json.loads(l)['source_id'] for l in lines) == [10, 10, 11, 12]
+
+    def test_graphml(self):
+        out = io.StringIO()
+        export.write_edges(export.iter_edges(self.session), out, fmt='graphml',
+                           nodes=export.iter_nodes(self.session))
+        data = out.getvalue()
+        assert data.count('<node ') == 5
+        assert data.count('<edge ') == 4
+
+    def test_users(self):
+        out = io.StringIO()
+        export.write_users(export.iter_users(self.session, chunksize=1), out, fmt='jsonlines')
+        users = list(json.loads(l) for l in out.getvalue().splitlines())
+        assert sorted(u['screen_name'] for u in users) == ['one', 'two']
+        assert users[0]['entities'] == {'a': 1}
+        out = io.StringIO()
+        export.write_users(export.iter_users(self.session, since=1500), out, fmt='json')
+        assert list(u['id'] for u in json.loads(out.getvalue())) == [2]
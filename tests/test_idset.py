@@ -0,0 +1,82 @@
+from unittest import TestCase
+
+import os
+import random
+import shutil
+import tempfile
+
+from bitter import idset
+from bitter.idset import IdSet
+
+
+class TestIdSet(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def check_set(self):
+        ids = random.sample(range(1, 2**62), 5000)
+        s = IdSet(ids[:4000], buffer=100)
+        for i in ids[4000:4500]:
+            s.add(i)
+        s.update(str(i) for i in ids[4500:])
+        s.add(ids[0])
+        assert len(s) == 5000
+        assert all(i in s for i in ids)
+        assert str(ids[10]) in s
+        assert 0 not in s and 2**63 - 1 not in s
+        assert list(s) == sorted(ids)
+        s.discard(ids[0])
+        s.discard(ids[4200])
+        assert ids[0] not in s and ids[4200] not in s
+        assert len(s) == 4998
+        s.add(ids[0])
+        assert ids[0] in s
+        assert s.check([ids[1], str(ids[2]), 3, ids[4200]]) == set([ids[1], str(ids[2])])
+
+    def test_ids(self):
+        self.check_set()
+
+    def test_without_numpy(self):
+        numpy, idset.numpy = idset.numpy, None
+        try:
+            self.check_set()
+        finally:
+            idset.numpy = numpy
+
+    def test_names(self):
+        s = IdSet(['1', 'balkian', '007'])
+        assert 1 in s and '1' in s
+        assert 'balkian' in s and '007' in s
+        assert 7 not in s
+        assert len(s) == 3
+        assert s.check(['balkian', 'other', 1]) == set(['balkian', 1])
+
+    def test_save_load(self):
+        path = os.path.join(self.folder, 'users.ids')
+        assert not len(IdSet.load(path))
+        s = IdSet([3, 1, 2, 2**60])
+        s.save(path)
+        assert os.path.getsize(path) == 4 * idset.ITEMSIZE
+        loaded = IdSet.load(path)
+        assert list(loaded) == [1, 2, 3, 2**60]
+        loaded.add(4)
+        assert 4 in loaded and 2 in loaded
+
+    def test_from_query(self):
+        from bitter.models import make_session, User
+        session = make_session('sqlite://')
+        for i in range(1, 101):
+            session.add(User(id=i * 1000))
+        session.commit()
+        s = IdSet.from_query(session.query(User.id), chunksize=7)
+        assert len(s) == 100
+        assert 5000 in s and 5001 not in s
+
+    def test_size(self):
+        s = IdSet(range(10**6))
+        assert len(s) == 10**6
+        assert s.nbytes() == 8 * 10**6
@@ -0,0 +1,112 @@
+from unittest import TestCase
+
+import os
+import shutil
+import tempfile
+
+from bitter import utils
+from bitter.journal import Journal
+
+
+class TestJournal(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.infile = os.path.join(self.folder, 'ids.csv')
+        with open(self.infile, 'w') as f:
+            f.write('id\n')
+            for i in range(1, 301):
+                f.write('{}\n'.format(i))
+        self.journal = Journal(os.path.join(self.folder, 'journal.db'))
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.folder)
+
+    def test_offset(self):
+        job = self.journal.job(self.infile, 'target')
+        assert job.offset == 0
+        for i, oid in enumerate(['a', 'B', 'c', 'a']):
+            job.issue(oid, (i + 1) * 10)
+        job.complete('b')
+        assert job.offset == 0
+        # Both copies of a are completed
+        job.complete('a')
+        assert job.offset == 20
+        job.complete('c')
+        assert job.offset == 40
+        job.issue('a', 50)
+        job.complete('a', False)
+        assert job.offset == 50
+        job.commit()
+        job = self.journal.job(self.infile, 'target')
+        assert job.offset == 50
+        assert job.done == 4 and job.failed == 1
+        # Only the last outcome of each id is kept
+        assert sorted(self.journal.outcomes(job.id)) == [('a', False), ('b', True), ('c', True)]
+        job = self.journal.job(self.infile, 'target', restart=True)
+        assert job.offset == 0
+        assert list(self.journal.outcomes(job.id)) == []
+
+    def test_resume(self):
+        from bitter.fakeapi import FakeAPI
+        from bitter.crawlers import TwitterQueue
+        tweets = os.path.join(self.folder, 'tweets')
+        with FakeAPI(missing=0.1) as api:
+            wq = TwitterQueue.from_config(config=api.config(1), limits_cache='')
+            results = utils.download_tweets_file(wq, self.infile, tweets, skip=1, journal=self.journal)
+            for ix, res in enumerate(results):
+                if ix == 150:
+                    break
+            results.close()
+            job = list(self.journal.jobs())[0]
+            assert not job['finished']
+            assert 0 < job['offset'] < job['size']
+            assert job['done'] + job['failed'] >= 100
+
+            resumed = dict(utils.download_tweets_file(wq, self.infile, tweets, skip=1, journal=self.journal))
+            assert '300' in resumed
+            assert len(resumed) < 300
+            job = list(self.journal.jobs())[0]
+            assert job['finished']
+            assert job['offset'] == job['size']
+            assert job['eta'] == 0
+            failed = set(oid for (oid, ok) in self.journal.outcomes(job['id'], ok=False))
+            assert failed == set(str(i) for i in range(1, 301) if i % 100 < 10)
+
+    def test_duplicates(self):
+        from bitter.fakeapi import FakeAPI
+        from bitter.crawlers import TwitterQueue
+        # An id repeated in the first batch
+        with open(self.infile, 'w') as f:
+            f.write('id\n')
+            for i in list(range(1, 11)) + [5] + list(range(11, 201)):
+                f.write('{}\n'.format(i))
+        size = os.path.getsize(self.infile)
+        tweets = os.path.join(self.folder, 'tweets')
+        with FakeAPI() as api:
+            wq = TwitterQueue.from_config(config=api.config(1), limits_cache='')
+            results = utils.download_tweets_file(wq, self.infile, tweets, skip=1, journal=self.journal,
+                                                 batch_timeout=0.1)
+            for ix, res in enumerate(results):
+                if ix == 150:
+                    break
+            results.close()
+            job = list(self.journal.jobs())[0]
+            # The first batch (100 lines) has been completed
+            assert job['offset'] > size / 2
+            assert job['done'] >= 100
+
+    def test_failed_batch(self):
+        from bitter.fakeapi import FakeAPI
+        from bitter.crawlers import TwitterQueue
+        tweets = os.path.join(self.folder, 'tweets')
+        with FakeAPI() as api:
+            wq = TwitterQueue.from_config(config=api.config(1), limits_cache='')
+            api.fail(403, times=1, endpoint='statuses/lookup')
+            results = dict(utils.download_tweets_file(wq, self.infile, tweets, skip=1, journal=self.journal))
+            assert len(results) == 300
+            assert sum(1 for obj in results.values() if obj is None) == 100
+            job = list(self.journal.jobs())[0]
+            assert job['finished']
+            assert job['failed'] == 100
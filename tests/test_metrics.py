@@ -0,0 +1,90 @@
+from unittest import TestCase, skipIf
+
+import shutil
+import tempfile
+
+from bitter import metrics, utils
+
+
+@skipIf(not metrics.ENABLED, 'prometheus_client is not installed')
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        from bitter.fakeapi import FakeAPI
+        from bitter.crawlers import TwitterQueue
+        self.api = FakeAPI().start()
+        self.wq = TwitterQueue.from_config(config=self.api.config(workers=2), limits_cache='')
+
+    def tearDown(self):
+        self.api.stop()
+
+    def value(self, name, **labels):
+        return metrics.REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_requests(self):
+        ok = self.value('bitter_requests_total', endpoint='users/lookup', outcome='ok')
+        server = self.value('bitter_requests_total', endpoint='users/lookup', outcome='server')
+        self.api.fail(503, endpoint='users/lookup')
+        self.wq.users.lookup(user_id='1')
+        self.wq.users.lookup(user_id='2')
+        assert self.value('bitter_requests_total', endpoint='users/lookup', outcome='ok') == ok + 2
+        assert self.value('bitter_requests_total', endpoint='users/lookup', outcome='server') == server + 1
+        stats = self.wq.metrics()
+        assert stats['requests']['users/lookup']['ok'] == ok + 2
+        assert stats['latency']['users/lookup']['count'] >= 3
+        assert stats['latency']['users/lookup']['sum'] > 0
+        assert stats['wait']['users/lookup']['backoff'] > 0
+        # Other tests may have used workers with the same names for other endpoints
+        remaining = list(stats['remaining'][w.name]['users/lookup']
+                         for w in self.wq.queue if 'users/lookup' in stats['remaining'].get(w.name, {}))
+        assert min(remaining) < self.api.limit
+
+    def test_pipeline(self):
+        folder = tempfile.mkdtemp()
+        try:
+            downloaded = self.value('bitter_objects_total', pipeline='download_list', stage='downloaded')
+            res = utils.download_list(self.wq, list(str(i) for i in range(1, 11)), folder, batch_timeout=0.1)
+            next(res)
+            assert self.value('bitter_queue_depth', pipeline='download_list', queue='done') >= 0
+            assert 'bitter_queue_depth{pipeline="download_list",queue="done"}' in metrics.render()
+            assert len(list(res)) == 9
+            assert self.value('bitter_objects_total', pipeline='download_list', stage='downloaded') == downloaded + 10
+            assert 'bitter_queue_depth{pipeline="download_list"' not in metrics.render()
+        finally:
+            shutil.rmtree(folder)
+
+    def test_concurrent_queues(self):
+        import queue
+        first, second = queue.Queue(), queue.Queue()
+        first.put(1)
+        second.put(1)
+        second.put(2)
+        metrics.track_queue('test', 'q', first)
+        metrics.track_queue('test', 'q', second)
+        assert self.value('bitter_queue_depth', pipeline='test', queue='q') == 3
+        metrics.untrack_queue('test', 'q', first)
+        assert self.value('bitter_queue_depth', pipeline='test', queue='q') == 2
+        metrics.untrack_queue('test', 'q', second)
+        assert 'bitter_queue_depth{pipeline="test"' not in metrics.render()
+
+    def test_commits(self):
+        from bitter.models import make_session, User
+        commits = self.value('bitter_db_commit_seconds_count')
+        session = make_session('sqlite://')
+        session.add(User(id=1))
+        session.commit()
+        assert self.value('bitter_db_commit_seconds_count') == commits + 1
+
+    def test_serve(self):
+        try:
+            from urllib.request import urlopen
+        except ImportError:
+            from urllib2 import urlopen
+        server, thread = metrics.serve(0, addr='127.0.0.1')
+        try:
+            self.wq.users.lookup(user_id='1')
+            body = urlopen('http://127.0.0.1:{}/metrics'.format(server.server_port)).read().decode('utf-8')
+            assert 'bitter_request_seconds_bucket{endpoint="users/lookup"' in body
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -21,3 +21,82 @@ class TestModels(TestCase):
         self.session.delete(fake_committed)
         self.session.commit()
         assert not list(self.session.execute('SELECT 1 from users where id=\'%s\'' % 1548))
+
+
+class TestEngines(TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.folder = tempfile.mkdtemp()
+        self.dburi = 'sqlite:///{}'.format(os.path.join(self.folder, 'test.db'))
+
+    def tearDown(self):
+        import shutil
+        dispose_engines()
+        shutil.rmtree(self.folder)
+
+    def test_shared(self):
+        from unittest import mock
+        with mock.patch.object(Base.metadata, 'create_all', wraps=Base.metadata.create_all) as create:
+            sessions = [make_session(self.dburi) for i in range(5)]
+        assert create.call_count == 1
+        assert len(set(s.bind for s in sessions)) == 1
+        assert get_engine(self.dburi) is sessions[0].bind
+
+    def test_memory(self):
+        one = make_session('sqlite://')
+        two = make_session('sqlite://')
+        assert one.bind is not two.bind
+        one.add(User(id=1))
+        one.commit()
+        assert not two.query(User).count()
+
+    def test_sqlite_pragmas(self):
+        session = make_session(self.dburi)
+        assert session.execute('PRAGMA journal_mode').scalar() == 'wal'
+        assert session.execute('PRAGMA synchronous').scalar() == 1
+
+    def test_scoped(self):
+        import threading
+        Session = make_scoped_session(self.dburi)
+        assert Session is make_scoped_session(self.dburi)
+        assert Session() is Session()
+        other = []
+        t = threading.Thread(target=lambda: other.append(Session()))
+        t.start()
+        t.join()
+        assert other[0] is not Session()
+        Session.remove()
+
+    def test_threads(self):
+        import threading
+
+        def add(start):
+            session = make_session(self.dburi)
+            for i in range(start, start + 50):
+                session.add(User(id=i))
+                session.commit()
+            session.close()
+
+        threads = [threading.Thread(target=add, args=(i * 50, )) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert make_session(self.dburi).query(User).count() == 200
+
+    def test_fork(self):
+        from bitter import models
+        engine = get_engine(self.dburi)
+        pid, shared = models._engines[self.dburi]
+        # As if the engine had been created by the parent of a forked process
+        models._engines[self.dburi] = (pid + 1, shared)
+        assert get_engine(self.dburi) is not engine
+
+    def test_upsert(self):
+        session = make_session(self.dburi)
+        upsert(session, User, [{'id': 1, 'screen_name': 'one'}, {'id': 2, 'screen_name': 'two'}])
+        upsert(session, User, [{'id': 1, 'screen_name': 'uno', 'unknown': True}])
+        session.commit()
+        assert session.query(User).count() == 2
+        assert session.query(User).filter(User.id == 1).first().screen_name == 'uno'
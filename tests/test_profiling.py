@@ -0,0 +1,70 @@
+from unittest import TestCase
+
+import os
+import json
+import time
+import pstats
+import tempfile
+import threading
+
+from bitter import profiling
+
+
+def busy(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        sum(range(100))
+
+
+class TestProfiling(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        profiling.stop(os.path.join(self.folder, 'leftover'), out=None)
+        for f in os.listdir(self.folder):
+            os.remove(os.path.join(self.folder, f))
+        os.rmdir(self.folder)
+
+    def test_disabled(self):
+        assert not profiling.ENABLED
+        with profiling.span('test') as s:
+            pass
+        assert s is profiling.span('other')
+        assert 'test' not in profiling.SPANS.stats
+
+    def test_spans(self):
+        profiling.start('sample')
+        for i in range(3):
+            with profiling.span('test'):
+                time.sleep(0.01)
+        calls, total, top = profiling.SPANS.stats['test']
+        assert calls == 3
+        assert total >= 0.03
+        assert 'test' in profiling.SPANS.summary()
+
+    def test_sample(self):
+        path = os.path.join(self.folder, 'profile.json')
+        profiling.start('sample', interval=0.001)
+        t = threading.Thread(target=busy, args=(0.2, ), name='busy-thread')
+        t.start()
+        t.join()
+        profiling.stop(path, out=None)
+        with open(path) as f:
+            data = json.load(f)
+        names = set(frame['name'] for frame in data['shared']['frames'])
+        assert 'busy' in names
+        profile = [p for p in data['profiles'] if p['name'] == 'busy-thread'][0]
+        assert len(profile['samples']) == len(profile['weights'])
+        assert sum(profile['weights']) > 0.05
+
+    def test_cprofile(self):
+        path = os.path.join(self.folder, 'profile.prof')
+        profiling.start('cprofile')
+        t = threading.Thread(target=busy, args=(0.05, ))
+        t.start()
+        t.join()
+        profiling.stop(path, out=None)
+        stats = pstats.Stats(path)
+        assert any(func[2] == 'busy' for func in stats.stats)
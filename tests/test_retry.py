@@ -0,0 +1,94 @@
+from unittest import TestCase
+
+import time
+
+from bitter.retry import RetryPolicy, CircuitBreaker, CircuitOpen, classify, LIMITED, SERVER, NETWORK
+
+
+def http_error(code):
+    from io import BytesIO
+    from urllib.error import HTTPError
+    from twitter import TwitterHTTPError
+    return TwitterHTTPError(HTTPError('http://x', code, 'error', {}, BytesIO(b'{}')), 'uri', 'json', '')
+
+
+class TestRetry(TestCase):
+
+    def test_classify(self):
+        from urllib.error import URLError
+        assert classify(http_error(429)) == LIMITED
+        assert classify(http_error(503)) == SERVER
+        assert classify(http_error(404)) is None
+        assert classify(URLError('refused')) == NETWORK
+        assert classify(ConnectionResetError()) == NETWORK
+        assert classify(ValueError()) is None
+
+    def test_backoff(self):
+        policy = RetryPolicy(server_delay=1, max_delay=10, jitter=False)
+        assert [policy.delay(SERVER, i) for i in range(1, 7)] == [1, 2, 4, 8, 10, 10]
+        policy = RetryPolicy(server_delay=1, max_delay=10)
+        for i in range(100):
+            assert 4 <= policy.delay(SERVER, 4) <= 8
+
+    def test_retry(self):
+        policy = RetryPolicy(server_delay=0.01, jitter=False, max_attempts=3)
+        retry = policy.start(['users', 'lookup'])
+        assert retry.failure(http_error(503))
+        assert 0 < retry.next_wait() <= 0.01
+        retry.wait()
+        assert retry.next_wait() == 0
+        assert retry.failure(http_error(503))
+        assert not retry.failure(http_error(503))
+        assert not retry.failure(http_error(404))
+        # Limits are not errors
+        retry = policy.start(['users', 'lookup'])
+        for i in range(10):
+            assert retry.failure(http_error(429))
+            assert retry.next_wait() == 0
+
+    def test_budget(self):
+        policy = RetryPolicy(server_delay=10, jitter=False, max_elapsed=5)
+        retry = policy.start(['users', 'lookup'])
+        assert not retry.failure(http_error(503))
+
+    def test_impatient(self):
+        policy = RetryPolicy()
+        retry = policy.start(['users', 'lookup'], patient=False)
+        assert not retry.failure(http_error(503))
+
+    def test_breaker(self):
+        breaker = CircuitBreaker(threshold=3, reset_timeout=0.2)
+        for i in range(2):
+            breaker.failure()
+        assert breaker.acquire() == 0
+        breaker.failure()
+        assert breaker.state == breaker.OPEN
+        assert 0.1 < breaker.acquire() <= 0.2
+        time.sleep(0.2)
+        # Only one trial at a time
+        assert breaker.acquire() == 0
+        assert breaker.state == breaker.HALF_OPEN
+        assert breaker.acquire() > 0
+        breaker.failure()
+        assert breaker.state == breaker.OPEN
+        assert 0.3 < breaker.acquire() <= 0.4
+        time.sleep(0.4)
+        assert breaker.acquire() == 0
+        breaker.success()
+        assert breaker.state == breaker.CLOSED
+        assert breaker.acquire() == 0
+
+    def test_open_circuit(self):
+        policy = RetryPolicy(server_delay=0, threshold=2, reset_timeout=10, max_elapsed=5)
+        retry = policy.start(['users', 'lookup'])
+        assert retry.failure(http_error(503))
+        assert retry.failure(http_error(503))
+        failed = False
+        try:
+            retry.wait()
+        except CircuitOpen:
+            failed = True
+        assert failed
+        # Every call to the endpoint is affected, but not other endpoints
+        assert policy.start(['users', 'lookup'], patient=False).breaker.acquire() > 0
+        assert policy.start(['users', 'show']).next_wait() == 0
@@ -0,0 +1,302 @@
+from unittest import TestCase, skipIf
+
+import os
+import gzip
+import json
+import time
+import shutil
+import tempfile
+import threading
+
+from urllib.error import URLError
+
+from bitter import streams
+from bitter.crawlers import StreamQueue, StreamWorker, QueueException
+from bitter.streams import StreamMultiplexer, StreamWriter, partition
+from bitter.retry import RetryPolicy
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class FakeStreamClient(object):
+    '''
+    Stream client that sends a tweet per keyword of the filter, and one
+    tweet (id 0) that matches every filter. Then it hangs up.
+    If error is given, it is raised the first `times` calls (or always).
+    '''
+
+    def __init__(self, error=None, times=None):
+        self.calls = []
+        self.error = error
+        self.times = times
+
+    def __getattr__(self, endpoint):
+        def call(**params):
+            self.calls.append((endpoint, params))
+            if self.error and (self.times is None or len(self.calls) <= self.times):
+                raise self.error
+            return self.messages(params)
+        return call
+
+    def messages(self, params):
+        yield {'id': 0, 'text': 'everyone'}
+        yield {'timeout': True}
+        for term in params.get('track', '').split(','):
+            yield {'id': int(term[1:]), 'text': term}
+        yield {'hangup': True}
+
+
+class BlockingStreamClient(FakeStreamClient):
+    '''Sends a tweet, and then waits for `gate` before the rest of the messages'''
+
+    def __init__(self):
+        super(BlockingStreamClient, self).__init__()
+        self.gate = threading.Event()
+
+    def messages(self, params):
+        yield {'id': 0, 'text': 'everyone'}
+        self.gate.wait()
+        for msg in super(BlockingStreamClient, self).messages(params):
+            yield msg
+
+
+def stream_queue(workers, error=None, times=None, wait=True, retry=None):
+    wq = StreamQueue(wait=wait, retry=retry)
+    clients = []
+    for i in range(workers):
+        worker = StreamWorker('worker{}'.format(i), {})
+        worker._client = FakeStreamClient(error=error, times=times)
+        clients.append(worker._client)
+        wq.ready(worker)
+    return wq, clients
+
+
+class TestStreams(TestCase):
+
+    def test_partition(self):
+        track = ['k{}'.format(i) for i in range(1000)]
+        follow = list(range(6000))
+        locations = ['-4.25,40.16,-3.40,40.75'] * 2 + [(i, i, i + 1, i + 1) for i in range(29)]
+        filters = partition(track=track, follow=follow, locations=locations)
+        assert len(filters) == 3
+        assert [len(f['track'].split(',')) for f in filters] == [400, 400, 200]
+        assert [len(f['follow'].split(',')) for f in filters[:2]] == [5000, 1000]
+        assert 'follow' not in filters[2]
+        assert len(filters[0]['locations'].split(',')) == 4 * 25
+        assert len(filters[1]['locations'].split(',')) == 4 * 5
+        assert sum((f['track'].split(',') for f in filters), []) == track
+
+    def test_split(self):
+        assert streams.split_terms(' a, b,,a ') == ['a', 'b']
+        assert streams.split_terms([1, 2, 2]) == ['1', '2']
+        assert partition(track='a,b', follow='1') == [{'track': 'a,b', 'follow': '1'}]
+        assert partition() == []
+        with self.assertRaises(ValueError):
+            streams.split_locations('1,2,3')
+
+    def test_recent_ids(self):
+        recent = streams.RecentIds(size=3)
+        assert not recent.seen(1)
+        assert recent.seen(1)
+        for i in range(2, 8):
+            assert not recent.seen(i)
+        # 1 is forgotten after 2 * size ids
+        assert not recent.seen(1)
+        assert recent.seen(7)
+
+    def test_multiplex(self):
+        wq, clients = stream_queue(3)
+        track = ['k{}'.format(i) for i in range(1, 901)]
+        tweets = []
+        stream = StreamMultiplexer(wq, track=track, reconnect=0.01, language='en')
+        reader = threading.Thread(target=lambda: tweets.extend(t['id'] for t in stream))
+        reader.start()
+        # Wait until the connections reconnect, and send everything again
+        deadline = time.time() + 10
+        while stream.stats['duplicates'] < 901 and time.time() < deadline:
+            time.sleep(0.01)
+        stream.stop()
+        reader.join()
+        assert stream.stats['reconnections'] >= 3
+        assert stream.stats['duplicates'] >= 901
+        assert sorted(tweets) == list(range(901))
+        calls = [params for c in clients for (endpoint, params) in c.calls]
+        assert all(endpoint == 'statuses/filter' for c in clients for (endpoint, params) in c.calls)
+        assert all(params['language'] == 'en' for params in calls)
+        assert set(params['track'] for params in calls) == set(p['track'] for p in partition(track=track))
+
+    def test_release(self):
+        wq, clients = stream_queue(1)
+        stream = StreamMultiplexer(wq, track='k1', reconnect=0.01)
+        it = iter(stream)
+        assert next(it)['id'] in (0, 1)
+        stream.stop()
+        assert list(it) in ([], [{'id': 1, 'text': 'k1'}])
+        for t in threading.enumerate():
+            if t.name.startswith('bitter-stream'):
+                t.join(1)
+        assert not any(w.busy for w in wq.queue)
+
+    def test_restart_busy(self):
+        wq, clients = stream_queue(1)
+        client = next(iter(wq.queue))._client = BlockingStreamClient()
+        stream = StreamMultiplexer(wq, track='k1', reconnect=0.01)
+        it = iter(stream)
+        assert next(it)['id'] == 0
+        # The connection is waiting for a message, and keeps its credential
+        stream.stop(timeout=0.1)
+        assert next(iter(wq.queue)).busy
+        tweets = []
+        reader = threading.Thread(target=lambda: tweets.extend(t['id'] for t in stream))
+        reader.start()
+        time.sleep(0.2)
+        # The new connection waits for the credential instead of failing
+        assert reader.is_alive() and stream._error is None
+        client.gate.set()
+        deadline = time.time() + 5
+        while 1 not in tweets and time.time() < deadline:
+            time.sleep(0.01)
+        stream.stop()
+        reader.join(5)
+        assert 1 in tweets
+        assert len(stream._threads) == 0
+        with self.assertRaises(RuntimeError):
+            stream.start()
+            stream.start()
+        stream.stop()
+
+    def test_credentials(self):
+        wq, clients = stream_queue(2)
+        with self.assertRaises(QueueException):
+            StreamMultiplexer(wq, track=['k{}'.format(i) for i in range(1000)])
+        with self.assertRaises(ValueError):
+            StreamMultiplexer(wq, track='')
+
+    def test_error(self):
+        wq, clients = stream_queue(2, error=ValueError('broken'), wait=False)
+        stream = StreamMultiplexer(wq, track='k1,k2', reconnect=0.01)
+        with self.assertRaises(ValueError):
+            list(stream)
+
+    def test_transient(self):
+        # The queue gives up right away, but the connection is reopened
+        error = URLError('connection reset')
+        wq, clients = stream_queue(1, error=error, times=2, retry=RetryPolicy(max_attempts=1))
+        stream = StreamMultiplexer(wq, track='k1', reconnect=0.01)
+        it = iter(stream)
+        assert next(it)['id'] in (0, 1)
+        stream.stop()
+        assert stream.stats['errors'] == 2
+        assert len(clients[0].calls) == 3
+
+    def test_restart(self):
+        wq, clients = stream_queue(1)
+        stream = StreamMultiplexer(wq, track='k1', reconnect=0.01)
+        it = iter(stream)
+        next(it)
+        stream.stop()
+        assert not any(t.is_alive() for t in threading.enumerate() if t.name.startswith('bitter-stream'))
+        assert not any(w.busy for w in wq.queue)
+        it = iter(stream)
+        assert next(it)['id'] in (0, 1)
+        stream.stop()
+
+
+class TestStreamWriter(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'tweets.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def tweets(self, n, start=0):
+        return [{'id': i, 'text': 'tweet {}'.format(i)} for i in range(start, start + n)]
+
+    def test_write(self):
+        with StreamWriter(self.path, batch=10) as writer:
+            for tweet in self.tweets(1000):
+                writer.put(tweet)
+            writer.put('{"id": 1000}')
+        assert writer.stats['written'] == 1001
+        assert writer.files == [self.path]
+        assert list(streams.read(self.path)) == self.tweets(1000) + [{'id': 1000}]
+        assert [e['offset'] for e in streams.read_index(self.path)] == [0]
+
+    def test_format(self):
+        tweet = {'id': 1, 'text': '\u00f1', 'entities': {'urls': []}}
+        with StreamWriter(self.path) as writer:
+            writer.put(tweet)
+        with open(self.path) as f:
+            assert f.read() == json.dumps(tweet) + '\n'
+
+    def test_rotate(self):
+        with StreamWriter(self.path, compression='gzip', rotate_size=1000, batch=10) as writer:
+            for tweet in self.tweets(1000):
+                writer.put(tweet)
+        assert len(writer.files) > 1
+        assert all(f.endswith('.jsonl.gz') for f in writer.files)
+        read = [t for f in writer.files for t in streams.read(f)]
+        assert read == self.tweets(1000)
+        with gzip.open(writer.files[0], 'rt') as f:
+            assert json.loads(f.readline())['id'] == 0
+
+    def check_hours(self, compression):
+        writer = StreamWriter(self.path, compression=compression)
+        hour = 1500000000 // 3600 * 3600
+        writer._write(self.tweets(10), now=hour + 10)
+        writer._write(self.tweets(10, start=10), now=hour + 20)
+        writer._write(self.tweets(10, start=20), now=hour + 3600 + 10)
+        writer._close()
+        path = writer.files[0]
+        index = streams.read_index(path)
+        assert [e['hour'] for e in index] == [hour, hour + 3600]
+        assert index[0]['offset'] == 0 and index[1]['offset'] > 0
+        assert list(streams.read(path)) == self.tweets(30)
+        assert list(streams.read(path, since=hour + 3600 + 100)) == self.tweets(10, start=20)
+        assert list(streams.read(path, since=hour + 100)) == self.tweets(30)
+
+    def test_hours(self):
+        self.check_hours(None)
+
+    def test_hours_gzip(self):
+        self.check_hours('gzip')
+
+    @skipIf(zstandard is None, 'zstandard is not installed')
+    def test_hours_zstd(self):
+        self.check_hours('zstd')
+
+    def test_drop(self):
+        writer = StreamWriter(self.path, maxsize=10, drop=True)
+        for tweet in self.tweets(15):
+            writer.put(tweet)
+        assert writer.stats['dropped'] == 5
+        writer.start()
+        writer.stop()
+        assert list(streams.read(self.path)) == self.tweets(10, start=5)
+
+    def test_block(self):
+        writer = StreamWriter(self.path, maxsize=2, flush_interval=0.01)
+        putter = threading.Thread(target=lambda: [writer.put(t) for t in self.tweets(5)])
+        putter.start()
+        putter.join(0.2)
+        # The buffer is full until the writer starts
+        assert putter.is_alive() and writer.qsize() == 2
+        with writer:
+            putter.join()
+        assert list(streams.read(self.path)) == self.tweets(5)
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            StreamWriter('-', compression='gzip')
+        with self.assertRaises(ValueError):
+            StreamWriter(self.path, compression='bz2')
+        writer = StreamWriter(os.path.join(self.folder, 'missing', 'tweets.jsonl'))
+        writer.start()
+        writer.put({'id': 1})
+        with self.assertRaises(IOError):
+            writer.stop()
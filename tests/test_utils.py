@@ -2,6 +2,8 @@ from unittest import TestCase
 
 import os
 import types
+import shutil
+import tempfile
 
 from bitter import utils
 from bitter import config as c
@@ -68,3 +70,332 @@ class TestUtilsEnv(TestUtils):
     def tearDown(self):
         if hasattr(self, 'oldenv'):
             os.environ['BITTER_CONFIG'] = self.oldenv
+
+
+class TestCrawlUser(TestCase):
+
+    def setUp(self):
+        from bitter.fakeapi import FakeAPI
+        from bitter.crawlers import TwitterQueue
+        from bitter.models import make_session
+        self.api = FakeAPI(followers={42: 12000}).start()
+        self.wq = TwitterQueue.from_config(config=self.api.config(workers=1))
+        self.session = make_session('sqlite://')
+
+    def tearDown(self):
+        self.api.stop()
+
+    def test_add_followers(self):
+        from bitter.models import Following
+        assert utils.add_followers(self.session, 1, range(1000)) == 1000
+        assert utils.add_followers(self.session, 1, range(500, 1500)) == 500
+        assert utils.add_followers(self.session, 2, [1, 1, 2]) == 2
+        self.session.commit()
+        assert self.session.query(Following).filter(Following.isfollowed == 1).count() == 1500
+
+    def test_add_followers_known(self):
+        from bitter.idset import IdSet
+        from bitter.models import Following
+        known = IdSet()
+        assert utils.add_followers(self.session, 1, range(1000), known=known) == 1000
+        assert utils.add_followers(self.session, 1, range(500, 1500), known=known) == 500
+        assert len(known) == 1500
+        self.session.commit()
+        assert self.session.query(Following).filter(Following.isfollowed == 1).count() == 1500
+
+    def test_crawl_user_resume(self):
+        from bitter.models import User, ExtractorEntry, Following
+        user = User(id=42, name='user42', screen_name='user42', followers_count=12000)
+        self.session.add(user)
+        # The first page was stored by a previous run
+        utils.add_followers(self.session, 42, range(1, 5001))
+        entry = ExtractorEntry(user=42, pending=True, cursor=5000)
+        self.session.commit()
+        utils.crawl_user(self.wq, self.session, user, entry)
+        assert self.session.query(Following).filter(Following.isfollowed == 42).count() == 12000
+        assert self.api.calls['followers/ids'] == 2
+
+    def test_crawl_user(self):
+        from bitter.models import User, ExtractorEntry, Following
+        user = User(id=42, name='user42', screen_name='user42', followers_count=12000)
+        entry = ExtractorEntry(user=42, pending=True)
+        self.session.add(user)
+        self.session.commit()
+        utils.crawl_user(self.wq, self.session, user, entry)
+        assert self.session.query(Following).filter(Following.isfollowed == 42).count() == 12000
+        assert entry.cursor == 0
+        assert not entry.pending
+        assert self.api.calls['followers/ids'] == 3
+
+    def test_crawl_user_edges(self):
+        import shutil
+        import tempfile
+        from bitter.edges import EdgeStore
+        from bitter.models import User, ExtractorEntry, Following
+        folder = tempfile.mkdtemp()
+        edges = EdgeStore(folder)
+        user = User(id=42, name='user42', screen_name='user42', followers_count=12000)
+        self.session.add(user)
+        self.session.commit()
+        utils.crawl_user(self.wq, self.session, user, edges=edges)
+        assert self.session.query(Following).count() == 0
+        assert edges.count(42) == 12000
+        assert list(edges.followers(42))[:3] == [1, 2, 3]
+        shutil.rmtree(folder)
+
+    def test_crawl_user_edges_resume(self):
+        import shutil
+        import tempfile
+        from bitter.edges import EdgeStore
+        from bitter.models import User, ExtractorEntry
+        folder = tempfile.mkdtemp()
+        edges = EdgeStore(folder)
+        user = User(id=42, name='user42', screen_name='user42', followers_count=12000)
+        self.session.add(user)
+        # The previous run committed the first page, and crashed while
+        # writing the second one
+        edges.append(42, range(1, 5001))
+        edges.append(42, range(5001, 6001))
+        with open(edges.path(42), 'ab') as f:
+            f.write(b'\0' * 3)
+        entry = ExtractorEntry(user=42, pending=True, cursor=5000, edges=5000)
+        self.session.commit()
+        utils.crawl_user(self.wq, self.session, user, entry, edges=edges)
+        assert edges.count(42) == 12000
+        assert list(edges.followers(42)) == list(range(1, 12001))
+        assert entry.edges == 12000
+        assert self.api.calls['followers/ids'] == 2
+        shutil.rmtree(folder)
+
+
+class TestFeeds(TestCase):
+
+    def test_consume_search(self):
+        from bitter.fakeapi import FakeAPI
+        from bitter.crawlers import TwitterQueue
+        with FakeAPI(results=250) as api:
+            wq = TwitterQueue.from_config(config=api.config(), limits_cache='')
+            tweets = list(utils.consume_tweets(wq['search/tweets'], q='test', count=100, max_count=-1))
+            assert [t['id'] for t in tweets] == list(range(250, 0, -1))
+            assert api.calls['search/tweets'] == 4
+
+
+class TestDownload(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_download_user(self):
+        from bitter import cache
+        from bitter.fakeapi import FakeAPI
+        from bitter.crawlers import TwitterQueue
+        with FakeAPI() as api:
+            wq = TwitterQueue.from_config(config=api.config(), limits_cache='')
+            user = next(utils.download_user(wq, 'user5', folder=self.folder, cache_backend='sqlite'))
+            assert user['id'] == 5
+            # From the cache, by id or screen name
+            assert next(utils.download_user(wq, '5', folder=self.folder, cache_backend='sqlite')) == user
+            assert next(utils.download_user(wq, 'user5', folder=self.folder, cache_backend='sqlite')) == user
+            assert api.calls['users/lookup'] == 1
+        with cache.get_cache(self.folder, 'sqlite') as store:
+            assert store.get(5) == user
+
+    def test_download_tweet(self):
+        from bitter import cache
+        with cache.get_cache(self.folder, 'sqlite') as store:
+            store.put(1, {'id': 1})
+        # Cached tweets are not downloaded
+        assert list(utils.download_tweet(None, 1, folder=self.folder, cache_backend='sqlite')) == [{'id': 1}]
+        # Stores given by the caller are not closed
+        with cache.get_cache(self.folder, 'sqlite') as store:
+            assert list(utils.download_tweet(None, 1, folder=store)) == [{'id': 1}]
+            assert store.get(1) == {'id': 1}
+
+    def test_download_closes(self):
+        from unittest import mock
+        from bitter import cache
+        closed = []
+
+        class Store(cache.SQLiteCache):
+            def close(self):
+                closed.append(self)
+                super(Store, self).close()
+
+        backends = dict(cache.BACKENDS, test=Store)
+        with mock.patch.object(cache, 'BACKENDS', backends):
+            with cache.get_cache(self.folder, 'sqlite') as store:
+                store.put(1, {'id': 1})
+            list(utils.download_tweet(None, 1, folder=self.folder, cache_backend='test'))
+        assert len(closed) == 1
+
+
+class TestSerialized(TestCase):
+
+    def test_jsonlines(self):
+        '''The output is the same with or without orjson'''
+        folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(folder, 'out.jsonl')
+            utils.serialized([{'t': u'\xf1', 'a': [1, 2]}], path, outformat='jsonlines')
+            with open(path) as f:
+                assert f.read() == '{"a": [1, 2], "t": "\\u00f1"}\n'
+        finally:
+            shutil.rmtree(folder)
+
+
+class TestBatches(TestCase):
+
+    def test_coalesce(self):
+        import queue
+        import threading
+        q = queue.Queue()
+        for i in range(250):
+            q.put(i)
+        batches = utils.coalesce(q, size=100, timeout=0.2)
+        assert len(next(batches)) == 100
+        assert len(next(batches)) == 100
+        # The last 50 ids are sent after the timeout
+        assert next(batches) == tuple(range(200, 250))
+        threading.Timer(0.1, q.put, args=(None, )).start()
+        assert list(batches) == []
+
+    def test_parallel_batches_error(self):
+        def batches():
+            yield [1, 2]
+            raise ValueError('broken input')
+
+        results = []
+        with self.assertRaises(ValueError):
+            for i in utils.parallel_batches(lambda batch: batch, batches()):
+                results.append(i)
+        # The batches read before the error are processed
+        assert results == [1, 2]
+
+    def test_parallel_batches(self):
+        import time
+        import threading
+        running = set()
+        seen = []
+
+        def func(batch):
+            running.add(threading.current_thread())
+            seen.append(len(running))
+            time.sleep(0.05)
+            return batch
+
+        batches = [(i, i+1) for i in range(0, 40, 2)]
+        capacity = iter(range(1, 100))
+        res = list(utils.parallel_batches(func, batches, capacity=lambda: next(capacity), max_threads=5))
+        assert sorted(res) == list(range(40))
+        assert max(seen) == 5
+
+    def test_backpressure(self):
+        import time
+        import tempfile
+        import shutil
+        read = [0]
+
+        def ids():
+            for i in range(100000):
+                read[0] += 1
+                yield str(i)
+
+        def batch(wq, oids):
+            time.sleep(0.01)
+            for oid in oids:
+                yield oid, {'id': int(oid)}
+
+        folder = tempfile.mkdtemp()
+        try:
+            res = utils.download_list(None, ids(), folder, batch_method=batch, cache=False,
+                                      batch_timeout=0.1, max_pending=500, check_size=100, max_threads=2)
+            for i in range(10):
+                next(res)
+            time.sleep(0.5)
+            # Ids in the queues, in the batches being downloaded and in the last check
+            assert read[0] < 2000
+            res.close()
+        finally:
+            shutil.rmtree(folder)
+
+    def test_quota_counter(self):
+        from bitter.fakeapi import FakeAPI
+        from bitter.crawlers import TwitterQueue
+        import tempfile
+        import shutil
+        folder = tempfile.mkdtemp()
+        try:
+            with FakeAPI(missing=0.1) as api:
+                wq = TwitterQueue.from_config(config=api.config(3), limits_cache='')
+                assert wq.capacity(['statuses', 'lookup']) == 3
+                counter = utils.QuotaCounter()
+                ids = list(str(i) for i in range(1, 251))
+                res = dict(utils.download_list(wq, ids, folder, counter=counter, batch_timeout=0.1))
+                assert len(res) == 250
+                assert counter.calls == api.calls['statuses/lookup'] == 3
+                assert counter.requested == 250
+                # 1-9, 100-109 and 200-209 are missing
+                assert counter.found == 221
+                assert round(counter.efficiency) == 74
+                assert round(counter.fill, 2) == 0.83
+        finally:
+            shutil.rmtree(folder)
+
+
+class TestCrawlUsers(TestCase):
+
+    def setUp(self):
+        import tempfile
+        from bitter.fakeapi import FakeAPI
+        from bitter.crawlers import TwitterQueue
+        from bitter.models import make_session, User, ExtractorEntry
+        self.folder = tempfile.mkdtemp()
+        self.dburi = 'sqlite:///{}'.format(os.path.join(self.folder, 'users.db'))
+        session = make_session(self.dburi)
+        for i in range(1, 101):
+            session.add(User(id=i, screen_name='old{}'.format(i)))
+        # An entry of a user that has not been downloaded yet
+        session.add(ExtractorEntry(user=300, pending=True))
+        session.commit()
+        session.close()
+        self.api = FakeAPI().start()
+        self.wq = TwitterQueue.from_config(config=self.api.config(2), limits_cache='')
+
+    def tearDown(self):
+        import shutil
+        from bitter.models import dispose_engines
+        self.api.stop()
+        dispose_engines()
+        shutil.rmtree(self.folder)
+
+    def check(self, **kwargs):
+        from bitter.models import make_session, User, ExtractorEntry
+        # Duplicates, blank lines and ids that are already in the database
+        ids = [str(i) for i in range(1, 501)] + ['', '250', '251']
+        stats = utils.crawl_users(self.wq, ids, self.dburi, threads=4, report=0.1, **kwargs)
+        assert stats['collected'] == 402
+        assert stats['skipped'] == 101
+        session = make_session(self.dburi)
+        assert session.query(User).count() == 500
+        # Existing users are not downloaded again
+        assert session.query(User).filter(User.id == 50).first().screen_name == 'old50'
+        assert session.query(User).filter(User.id == 250).first().screen_name == 'user250'
+        assert self.api.calls['users/lookup'] < 20
+        # The followers count is copied to the entry
+        count = session.query(User).filter(User.id == 300).first().followers_count
+        assert session.query(ExtractorEntry).filter(ExtractorEntry.user == 300).first().followers_count == count
+
+    def test_crawl(self):
+        self.check(batchsize=50, filter_batch=30)
+
+    def test_preload(self):
+        self.check(preload=True)
+
+    def test_errors(self):
+        from twitter import TwitterHTTPError
+        self.api.fail(403, times=1, endpoint='users/lookup')
+        with self.assertRaises(TwitterHTTPError):
+            utils.crawl_users(self.wq, [str(i) for i in range(101, 201)], self.dburi, threads=2, report=0.1)
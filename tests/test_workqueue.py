@@ -0,0 +1,287 @@
+from unittest import TestCase
+
+import os
+import time
+import shutil
+import socket
+import tempfile
+import subprocess
+import threading
+import multiprocessing
+
+from sqlalchemy import inspect
+from sqlalchemy.dialects import postgresql
+
+from bitter import utils
+from bitter.models import make_session, dispose_engines, User, ExtractorEntry
+from bitter.workqueue import WorkQueue
+
+
+def fill(dburi, n=20):
+    session = make_session(dburi)
+    for i in range(n):
+        session.add(User(id=i, followers_count=n - i))
+        session.add(ExtractorEntry(id=i + 1, user=i, pending=True))
+    session.commit()
+    session.close()
+
+
+def claim_all(dburi, worker):
+    work = WorkQueue(dburi, worker=worker, batchsize=3)
+    claimed = []
+    for entry_id in work.entries(poll=0.01):
+        claimed.append(entry_id)
+        work.done(entry_id)
+    return claimed
+
+
+class TestWorkQueue(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.dburi = 'sqlite:///{}'.format(os.path.join(self.folder, 'users.db'))
+        fill(self.dburi)
+
+    def tearDown(self):
+        dispose_engines()
+        shutil.rmtree(self.folder)
+
+    def test_claims_are_disjoint(self):
+        one = WorkQueue(self.dburi, worker='one')
+        two = WorkQueue(self.dburi, worker='two')
+        first = one.claim(5)
+        second = two.claim(5)
+        assert len(first) == len(second) == 5
+        assert not set(first) & set(second)
+        # Users with fewer followers go first
+        session = make_session(self.dburi)
+        entry = session.query(ExtractorEntry).filter(ExtractorEntry.id == first[0]).first()
+        assert entry.user == 19
+        assert entry.lease_owner == 'one'
+        assert entry.busy
+
+    def test_lease_expires(self):
+        one = WorkQueue(self.dburi, worker='one', lease=0.2)
+        two = WorkQueue(self.dburi, worker='two')
+        first = one.claim(20)
+        assert len(first) == 20
+        assert not two.claim()
+        time.sleep(0.3)
+        assert sorted(two.claim(20)) == sorted(first)
+        # The lease is gone. It cannot be renewed, nor marked as done.
+        assert one.renew() == 0
+        assert not one.held
+        one.done(first[0])
+        session = make_session(self.dburi)
+        assert session.query(ExtractorEntry).filter(ExtractorEntry.pending == True).count() == 20
+
+    def test_renew(self):
+        one = WorkQueue(self.dburi, worker='one', lease=0.5)
+        two = WorkQueue(self.dburi, worker='two')
+        ids = one.claim(20)
+        time.sleep(0.3)
+        assert one.renew() == 20
+        time.sleep(0.3)
+        assert not two.claim()
+
+    def test_done_and_release(self):
+        work = WorkQueue(self.dburi, worker='one')
+        ids = work.claim(4)
+        work.done(ids[0])
+        work.done(ids[1], error='Failed')
+        work.release()
+        assert not work.held
+        assert work.pending() == 18
+        session = make_session(self.dburi)
+        failed = session.query(ExtractorEntry).filter(ExtractorEntry.id == ids[1]).first()
+        assert failed.errors == 'Failed'
+        assert not failed.pending
+        assert failed.lease_owner is None
+        assert sorted(work.claim(20)) == sorted(set(range(1, 21)) - set(ids[:2]))
+
+    def test_entries(self):
+        claimed = claim_all(self.dburi, 'one')
+        assert sorted(claimed) == list(range(1, 21))
+        assert not WorkQueue(self.dburi).pending()
+
+    def test_entries_wait_for_leases(self):
+        one = WorkQueue(self.dburi, worker='one', lease=0.2)
+        one.claim(20)
+        start = time.time()
+        claimed = claim_all(self.dburi, 'two')
+        assert sorted(claimed) == list(range(1, 21))
+        assert time.time() - start >= 0.15
+
+    def test_run(self):
+        seen = []
+        with WorkQueue(self.dburi, worker='one', batchsize=2) as work:
+            done = list(work.run(seen.append, threads=3))
+        assert sorted(done) == sorted(seen) == list(range(1, 21))
+
+    def test_run_errors(self):
+        from io import BytesIO
+        from urllib.error import HTTPError
+        from twitter import TwitterHTTPError
+        from bitter.retry import CircuitOpen
+
+        def crawl(entry_id):
+            if entry_id == 1:
+                raise TwitterHTTPError(HTTPError('http://x', 404, 'error', {}, BytesIO(b'{}')), 'uri', 'json', '')
+            if entry_id == 2:
+                raise CircuitOpen('users/lookup')
+
+        with WorkQueue(self.dburi, worker='one') as work:
+            done = list(work.run(crawl, threads=2))
+        assert sorted(done) == list(range(1, 21))
+        session = make_session(self.dburi)
+        entries = dict((e.id, e) for e in session.query(ExtractorEntry))
+        # Errors that cannot be retried are final
+        assert not entries[1].pending and entries[1].errors
+        # The rest leave the entry pending, for the next run
+        assert entries[2].pending and entries[2].lease_owner is None
+        assert 'users/lookup' in entries[2].errors
+        assert WorkQueue(self.dburi, worker='two').claim(20) == [2]
+
+    def test_processes(self):
+        pool = multiprocessing.Pool(4)
+        results = pool.starmap(claim_all, [(self.dburi, 'worker{}'.format(i)) for i in range(4)])
+        pool.close()
+        pool.join()
+        claimed = [i for r in results for i in r]
+        assert sorted(claimed) == list(range(1, 21))
+
+    def test_skip_locked(self):
+        work = WorkQueue(self.dburi)
+        work.skip_locked = True
+        query = work.claim_query(10, time.time())
+        sql = str(query.statement.compile(dialect=postgresql.dialect()))
+        assert 'FOR UPDATE OF "extractor-cursor" SKIP LOCKED' in sql
+
+    def test_upgrade_schema(self):
+        dbpath = os.path.join(self.folder, 'old.db')
+        import sqlite3
+        conn = sqlite3.connect(dbpath)
+        conn.execute('CREATE TABLE "extractor-cursor" (id INTEGER PRIMARY KEY, user INTEGER, '
+                     'cursor INTEGER, pending BOOLEAN, errors TEXT, busy BOOLEAN)')
+        conn.execute('INSERT INTO "extractor-cursor" (id, user, pending) VALUES (1, 1, 1)')
+        conn.commit()
+        conn.close()
+        session = make_session('sqlite:///{}'.format(dbpath))
+        entry = session.query(ExtractorEntry).first()
+        assert entry.lease_owner is None
+        assert entry.lease_expires is None
+        indexes = inspect(session.bind).get_indexes('extractor-cursor')
+        assert 'ix_extractor_claim' in [i['name'] for i in indexes]
+
+    def test_claim_uses_index(self):
+        work = WorkQueue(self.dburi)
+        query = work.claim_query(10, time.time())
+        compiled = query.statement.compile(work.session.bind, compile_kwargs={'literal_binds': True})
+        plan = work.session.execute('EXPLAIN QUERY PLAN {}'.format(compiled)).fetchall()
+        plan = ' '.join(str(row[-1]) for row in plan)
+        assert 'ix_extractor_claim' in plan
+        assert 'TEMP B-TREE' not in plan
+
+    def test_backfill(self):
+        session = make_session(self.dburi)
+        assert not session.query(ExtractorEntry).filter(ExtractorEntry.followers_count != None).count()
+        session.add(ExtractorEntry(id=100, user=100, pending=True))
+        session.commit()
+        work = WorkQueue(self.dburi)
+        entry = session.query(ExtractorEntry).filter(ExtractorEntry.id == 20).first()
+        assert entry.followers_count == 1
+        # Entries without a user cannot be claimed
+        assert work.pending() == 20
+        assert 100 not in work.claim(30)
+
+    def test_notify(self):
+        one = WorkQueue(self.dburi, worker='one', lease=60)
+        ids = one.claim(20)
+        claimed = []
+
+        def crawl():
+            for entry_id in one.entries():
+                claimed.append(entry_id)
+                one.done(entry_id)
+
+        waiting = threading.Thread(target=crawl)
+        start = time.time()
+        waiting.start()
+        time.sleep(0.1)
+        one.release(ids)
+        waiting.join(5)
+        assert not waiting.is_alive()
+        assert time.time() - start < 5
+        assert sorted(claimed) == list(range(1, 21))
+
+    def test_recover(self):
+        host = socket.gethostname()
+        # A run of this host that died, one that is still running, and one
+        # of another host
+        dead = subprocess.Popen(['true'])
+        dead.wait()
+        WorkQueue(self.dburi, worker='{}:{}'.format(host, dead.pid), lease=60).claim(5)
+        WorkQueue(self.dburi, worker='{}:{}'.format(host, os.getppid()), lease=60).claim(5)
+        WorkQueue(self.dburi, worker='other:{}'.format(dead.pid), lease=60).claim(5)
+        restarted = WorkQueue(self.dburi, lease=60)
+        assert restarted.worker == '{}:{}'.format(host, os.getpid())
+        assert restarted.recover() == 5
+        assert len(restarted.claim(20)) == 10
+
+    def test_extract(self):
+        from bitter.fakeapi import FakeAPI
+        from bitter.crawlers import TwitterQueue
+        from bitter.models import Following
+        api = FakeAPI(followers=dict((i, 3) for i in range(20))).start()
+        try:
+            wq = TwitterQueue.from_config(config=api.config(workers=2), limits_cache='')
+            utils.extract(wq, dburi=self.dburi, distributed=True, lease=5, threads=2)
+        finally:
+            api.stop()
+        session = make_session(self.dburi)
+        assert not session.query(ExtractorEntry).filter(ExtractorEntry.pending == True).count()
+        assert not session.query(ExtractorEntry).filter(ExtractorEntry.lease_owner != None).count()
+        assert session.query(Following).count() == 60
+
+    def test_add_user(self):
+        utils.add_user({'id': 100, 'followers_count': 5, 'entities': {}}, dburi=self.dburi)
+        # Existing users are only replaced with update
+        utils.add_user({'id': 100, 'followers_count': 50, 'entities': {}}, dburi=self.dburi)
+        session = make_session(self.dburi)
+        entry = session.query(ExtractorEntry).filter(ExtractorEntry.user == 100).first()
+        assert entry.pending
+        assert entry.followers_count == 5
+        utils.add_user({'id': 100, 'followers_count': 50, 'entities': {}}, dburi=self.dburi, update=True)
+        session.expire_all()
+        assert session.query(ExtractorEntry).filter(ExtractorEntry.user == 100).first().followers_count == 50
+
+
+class TestShards(TestCase):
+
+    def test_parse(self):
+        assert utils.parse_shard('1/4') == (1, 4)
+        assert utils.parse_shard(None) is None
+        for wrong in ('4/4', '1', 'a/b', '-1/2'):
+            with self.assertRaises(ValueError):
+                utils.parse_shard(wrong)
+
+    def test_in_shard(self):
+        ids = ['1', '2', '3', '4', '5', '6']
+        shards = [[i for i in ids if utils.in_shard(i, (s, 3))] for s in range(3)]
+        assert shards == [['3', '6'], ['1', '4'], ['2', '5']]
+
+    def test_credentials(self):
+        from bitter.fakeapi import FakeAPI
+        from bitter.crawlers import TwitterQueue
+        api = FakeAPI().start()
+        try:
+            config = api.config(workers=5)
+            names = set()
+            for i in range(2):
+                wq = TwitterQueue.from_config(config=config, shard=(i, 2), limits_cache='')
+                shard = set(w.name for w in wq.queue)
+                assert not names & shard
+                names |= shard
+            assert len(names) == 5
+        finally:
+            api.stop()